@@ -0,0 +1,61 @@
+#!/usr/bin/env python
+import json
+import os
+from typing import Dict, Optional
+
+from mqtt2kasa import log
+
+logger = log.getLogger()
+
+
+class AliasCache:
+    """Remembers where devices located by alias were last found.
+
+    Entries are kept in a small json file, so a restart can reach those
+    devices directly instead of broadcasting a discovery.
+    """
+
+    def __init__(self, filename: Optional[str]):
+        self.filename = filename
+        self.entries: Dict[str, Dict[str, str]] = {}
+        self._load()
+
+    def _load(self):
+        if not self.filename or not os.path.exists(self.filename):
+            return
+        try:
+            with open(self.filename, "r") as cache_file:
+                entries = json.load(cache_file)
+        except (OSError, ValueError) as e:
+            logger.warning(f"Ignoring alias cache {self.filename}: {e}")
+            return
+        if not isinstance(entries, dict):
+            logger.warning(f"Ignoring alias cache {self.filename}: not a mapping")
+            return
+        self.entries = {
+            alias: entry
+            for alias, entry in entries.items()
+            if isinstance(entry, dict) and entry.get("host")
+        }
+        logger.info(f"Loaded {len(self.entries)} entries from {self.filename}")
+
+    def host(self, alias: str) -> Optional[str]:
+        entry = self.entries.get(alias)
+        return entry["host"] if entry else None
+
+    def set(self, alias: str, host: str, mac: Optional[str]):
+        self.entries[alias] = {"host": host, "mac": mac}
+
+    def discard(self, alias: str):
+        self.entries.pop(alias, None)
+
+    def save(self):
+        if not self.filename:
+            return
+        tmp_filename = f"{self.filename}.tmp"
+        try:
+            with open(tmp_filename, "w") as cache_file:
+                json.dump(self.entries, cache_file, indent=2, sort_keys=True)
+            os.replace(tmp_filename, self.filename)
+        except OSError as e:
+            logger.warning(f"Unable to save alias cache {self.filename}: {e}")
@@ -3,6 +3,8 @@ import collections
 import os
 import sys
 from collections import namedtuple
+from types import MappingProxyType
+from typing import Dict, List, Mapping, NamedTuple, Optional, Tuple, Union
 
 import yaml
 
@@ -10,7 +12,157 @@ from mqtt2kasa import const
 from mqtt2kasa import log
 
 CFG_FILENAME = os.path.dirname(os.path.abspath(const.__file__)) + "/../data/config.yaml"
-Info = namedtuple("Info", "mqtt knobs cfg_globals locations keep_alives raw_cfg")
+Info = namedtuple(
+    "Info", "mqtt knobs cfg_globals settings locations keep_alives groups raw_cfg"
+)
+
+NUMBER = (int, float)
+OPTIONAL_MAPPING = (Mapping, type(None))  # a section with only comments is None
+SECTIONS = {
+    "mqtt": OPTIONAL_MAPPING,
+    "knobs": OPTIONAL_MAPPING,
+    "globals": OPTIONAL_MAPPING,
+    "locations": Mapping,
+    "keep_alives": OPTIONAL_MAPPING,
+    "groups": OPTIONAL_MAPPING,
+}
+MQTT_ATTRS = {
+    "host": str,
+    "client_id": str,
+    "username": str,
+    "password": str,
+    "retain": bool,
+    "qos": int,
+    "reconnect_interval": NUMBER,
+    "publish_rate": NUMBER,
+    "publish_burst": int,
+    "publish_max_inflight": int,
+    "dedup_window": NUMBER,
+    "telemetry_queue_size": int,
+    "wildcard_subscriptions": bool,
+}
+KNOBS_ATTRS = {
+    "log_to_console": bool,
+    "log_level_debug": bool,
+    "instrumentation": bool,
+    "instrumentation_slow_threshold": NUMBER,
+    "instrumentation_lag_interval": NUMBER,
+    "instrumentation_topic": str,
+}
+# settings of a location that default to the one in globals
+LOCATION_DEFAULT_ATTRS = {
+    "poll_interval": NUMBER,
+    "max_poll_interval": NUMBER,
+    "emeter_poll_interval": NUMBER,
+    "emeter_deadband": Mapping,
+    "emeter_max_age": NUMBER,
+    "emeter_windows": list,
+    "throttle_rate_limit": NUMBER,
+    "throttle_period": NUMBER,
+    "brightness_debounce": NUMBER,
+    "receive_queue_size": int,  # deprecated, ignored
+}
+GLOBALS_ATTRS = {
+    **LOCATION_DEFAULT_ATTRS,
+    "topic_format": str,
+    "keep_alive_task_interval": NUMBER,
+    "max_concurrent_polls": int,
+    "init_concurrency": int,
+    "group_concurrency": int,
+    "init_timeout": NUMBER,
+    "init_retry_interval": NUMBER,
+    "alias_cache_file": (str, type(None)),
+    "metrics_host": str,
+    "metrics_port": int,
+}
+LOCATION_ATTRS = {
+    **LOCATION_DEFAULT_ATTRS,
+    "host": str,
+    "alias": str,
+    "topic": str,
+    "strip": str,
+    "outlet": (int, str),
+}
+KEEP_ALIVE_ATTRS = {
+    "interval": int,
+    "timeout": int,
+    "publish_topic": str,
+    "subscribe_topic": str,
+}
+GROUP_ATTRS = {
+    "members": list,
+    "topic": str,
+}
+DEPRECATED_ATTRS = {"receive_queue_size"}
+# globals that are read every time they are used
+RELOADABLE_GLOBALS_ATTRS = {"topic_format", "group_concurrency"}
+# the levels under a device topic that the bridge itself uses
+DEVICE_SUBTOPICS = {"status", "brightness", "emeter"}
+
+
+class ConfigError(ValueError):
+    def __init__(self, errors: List[str]):
+        super().__init__("Invalid config:\n  " + "\n  ".join(errors))
+        self.errors = errors
+
+
+class Location(NamedTuple):
+    """A location, with every setting resolved from globals and defaults."""
+
+    name: str
+    topic: str
+    host: Optional[str]
+    alias: Optional[str]
+    strip: Optional[str]  # name of the location of the strip this outlet is on
+    outlet: Union[int, str, None]  # index or alias of the outlet on the strip
+    poll_interval: float
+    max_poll_interval: float
+    emeter_poll_interval: float
+    emeter_deadband: Mapping[str, float]
+    emeter_max_age: float
+    emeter_windows: Tuple[float, ...]  # [seconds] aggregation windows
+    throttle_rate_limit: float
+    throttle_period: float
+    brightness_debounce: float
+
+
+class Group(NamedTuple):
+    """Locations that are switched together, from a topic of their own."""
+
+    name: str
+    topic: str
+    members: Tuple[str, ...]
+
+
+class Settings(NamedTuple):
+    """The mqtt, knobs and globals sections, with every default resolved."""
+
+    mqtt_host: str
+    mqtt_client_id: str
+    mqtt_username: Optional[str]
+    mqtt_password: Optional[str]
+    mqtt_retain: bool
+    mqtt_qos: int
+    reconnect_interval: float
+    mqtt_publish_rate: float
+    mqtt_publish_burst: int
+    mqtt_publish_max_inflight: int
+    mqtt_dedup_window: float
+    mqtt_telemetry_queue_size: int
+    mqtt_wildcard_subscriptions: bool
+    instrumentation: bool
+    instrumentation_slow_threshold: float
+    instrumentation_lag_interval: float
+    instrumentation_topic: Optional[str]
+    keep_alive_task_interval: float
+    init_concurrency: int
+    group_concurrency: int
+    init_timeout: float
+    init_retry_interval: float
+    max_concurrent_polls: int
+    alias_cache_file: Optional[str]
+    metrics_host: str
+    metrics_port: int
 
 
 class Cfg:
@@ -21,149 +173,147 @@ class Cfg:
 
     @property
     def mqtt_host(self):
-        attr = self._get_info().mqtt
-        if isinstance(attr, collections.abc.Mapping):
-            return attr.get("host", const.MQTT_DEFAULT_BROKER_IP)
-        return const.MQTT_DEFAULT_BROKER_IP
+        return self._get_info().settings.mqtt_host
 
     @property
     def mqtt_client_id(self):
-        attr = self._get_info().mqtt
-        if isinstance(attr, collections.abc.Mapping):
-            return attr.get("client_id", const.MQTT_DEFAULT_CLIENT_ID)
-        return const.MQTT_DEFAULT_CLIENT_ID
+        return self._get_info().settings.mqtt_client_id
 
     @property
     def mqtt_username(self):
-        attr = self._get_info().mqtt
-        if isinstance(attr, collections.abc.Mapping):
-            return attr.get("username", None)
-        return None
+        return self._get_info().settings.mqtt_username
 
     @property
     def mqtt_password(self):
-        attr = self._get_info().mqtt
-        if isinstance(attr, collections.abc.Mapping):
-            return attr.get("password", None)
-        return None
+        return self._get_info().settings.mqtt_password
 
     @property
     def mqtt_retain(self):
-        attr = self._get_info().mqtt
-        if isinstance(attr, collections.abc.Mapping):
-            return attr.get("retain", False)
-        return False
+        return self._get_info().settings.mqtt_retain
 
     @property
     def mqtt_qos(self):
-        attr = self._get_info().mqtt
-        if isinstance(attr, collections.abc.Mapping):
-            return attr.get("qos", 0)
-        return 0
+        return self._get_info().settings.mqtt_qos
 
     @property
     def reconnect_interval(self):
-        attr = self._get_info().mqtt
-        if isinstance(attr, collections.abc.Mapping):
-            return attr.get("reconnect_interval", const.MQTT_DEFAULT_RECONNECT_INTERVAL)
-        return const.MQTT_DEFAULT_RECONNECT_INTERVAL
+        return self._get_info().settings.reconnect_interval
+
+    @property
+    def mqtt_publish_rate(self):
+        return self._get_info().settings.mqtt_publish_rate
+
+    @property
+    def mqtt_publish_burst(self):
+        return self._get_info().settings.mqtt_publish_burst
+
+    @property
+    def mqtt_publish_max_inflight(self):
+        return self._get_info().settings.mqtt_publish_max_inflight
+
+    @property
+    def mqtt_dedup_window(self):
+        return self._get_info().settings.mqtt_dedup_window
+
+    @property
+    def mqtt_telemetry_queue_size(self):
+        return self._get_info().settings.mqtt_telemetry_queue_size
+
+    @property
+    def mqtt_wildcard_subscriptions(self):
+        return self._get_info().settings.mqtt_wildcard_subscriptions
 
     @property
     def knobs(self):
         return self._get_info().knobs
 
-    def mqtt_topic(self, location_name):
-        locations = self._get_info().locations
-        if isinstance(locations, collections.abc.Mapping):
-            location_attributes = locations.get(location_name, {})
-            if location_attributes.get("topic"):
-                return location_attributes["topic"].format(location_name)
-        cfg_globals = self._get_info().cfg_globals
-        topic_format = cfg_globals.get("topic_format")
-        return (
-            topic_format.format(location_name)
-            if topic_format
-            else const.MQTT_DEFAULT_CLIENT_TOPIC_FORMAT.format(location_name)
-        )
+    @property
+    def instrumentation(self):
+        return self._get_info().settings.instrumentation
 
     @property
-    def keep_alive_task_interval(self):
-        cfg_globals = self._get_info().cfg_globals
-        return float(
-            cfg_globals.get("keep_alive_task_interval")
-            or const.KEEP_ALIVE_DEFAULT_TASK_INTERVAL
-        )
+    def instrumentation_slow_threshold(self):
+        return self._get_info().settings.instrumentation_slow_threshold
 
-    def poll_interval(self, location_name):
-        locations = self._get_info().locations
-        if isinstance(locations, collections.abc.Mapping):
-            location_attributes = locations.get(location_name, {})
-            if location_attributes.get("poll_interval"):
-                return float(location_attributes["poll_interval"])
-        cfg_globals = self._get_info().cfg_globals
-        return float(
-            cfg_globals.get("poll_interval") or const.KASA_DEFAULT_POLL_INTERVAL
-        )
+    @property
+    def instrumentation_lag_interval(self):
+        return self._get_info().settings.instrumentation_lag_interval
 
-    def emeter_poll_interval(self, location_name):
-        locations = self._get_info().locations
-        if isinstance(locations, collections.abc.Mapping):
-            location_attributes = locations.get(location_name, {})
-            if location_attributes.get("emeter_poll_interval"):
-                return float(location_attributes["emeter_poll_interval"])
-        cfg_globals = self._get_info().cfg_globals
-        return float(
-            cfg_globals.get("emeter_poll_interval")
-            or const.KASA_DEFAULT_EMETER_POLL_INTERVAL
-        )
+    @property
+    def instrumentation_topic(self):
+        return self._get_info().settings.instrumentation_topic
 
-    def throttle_rate_limit(self, location_name):
-        locations = self._get_info().locations
-        if isinstance(locations, collections.abc.Mapping):
-            location_attributes = locations.get(location_name, {})
-            if "throttle_rate_limit" in location_attributes:
-                return float(location_attributes["throttle_rate_limit"])
+    @property
+    def keep_alive_task_interval(self):
+        return self._get_info().settings.keep_alive_task_interval
 
-        cfg_globals = self._get_info().cfg_globals
-        if "throttle_rate_limit" in cfg_globals:
-            return float(cfg_globals["throttle_rate_limit"])
+    @property
+    def init_concurrency(self):
+        return self._get_info().settings.init_concurrency
 
-        return float(const.KASA_DEFAULT_THROTTLE_RATE_LIMIT)
+    @property
+    def group_concurrency(self):
+        return self._get_info().settings.group_concurrency
 
-    def throttle_period(self, location_name):
-        locations = self._get_info().locations
-        if isinstance(locations, collections.abc.Mapping):
-            location_attributes = locations.get(location_name, {})
-            if "throttle_period" in location_attributes:
-                return float(location_attributes["throttle_period"])
+    @property
+    def init_timeout(self):
+        return self._get_info().settings.init_timeout
 
-        cfg_globals = self._get_info().cfg_globals
-        if "throttle_period" in cfg_globals:
-            return float(cfg_globals["throttle_period"])
+    @property
+    def init_retry_interval(self):
+        return self._get_info().settings.init_retry_interval
 
-        return float(const.KASA_DEFAULT_THROTTLE_PERIOD)
+    @property
+    def max_concurrent_polls(self):
+        return self._get_info().settings.max_concurrent_polls
 
-    def receive_queue_size(self, location_name):
-        locations = self._get_info().locations
-        if isinstance(locations, collections.abc.Mapping):
-            location_attributes = locations.get(location_name, {})
-            if "receive_queue_size" in location_attributes:
-                return float(location_attributes["receive_queue_size"])
+    @property
+    def alias_cache_file(self):
+        return self._get_info().settings.alias_cache_file
 
-        cfg_globals = self._get_info().cfg_globals
-        if "receive_queue_size" in cfg_globals:
-            return float(cfg_globals["receive_queue_size"])
+    @property
+    def metrics_host(self):
+        return self._get_info().settings.metrics_host
 
-        return float(const.KASA_DEFAULT_RECEIVE_QUEUE_SIZE)
+    @property
+    def metrics_port(self):
+        return self._get_info().settings.metrics_port
 
     @property
-    def locations(self):
+    def locations(self) -> Dict[str, Location]:
         return self._get_info().locations
 
     @property
     def keep_alives(self):
         return self._get_info().keep_alives
 
+    @property
+    def groups(self) -> Dict[str, Group]:
+        return self._get_info().groups
+
+    def startup_settings_changed(self, old_info: Info) -> List[str]:
+        """Settings that differ from old_info, but are only read at startup."""
+        new_info = self._get_info()
+        changed = []
+        for section_name in ("mqtt", "knobs"):
+            old = getattr(old_info, section_name)
+            new = getattr(new_info, section_name)
+            changed += [
+                f"{section_name}.{attr}"
+                for attr in sorted(set(old) | set(new))
+                if old.get(attr) != new.get(attr)
+            ]
+        old, new = old_info.cfg_globals, new_info.cfg_globals
+        changed += [
+            f"globals.{attr}"
+            for attr in sorted(set(old) | set(new))
+            # the ones that locations default to are applied with the locations
+            if attr not in LOCATION_DEFAULT_ATTRS
+            and attr not in RELOADABLE_GLOBALS_ATTRS
+            and old.get(attr) != new.get(attr)
+        ]
+        return changed
+
     @classmethod
     def _get_config_filename(cls):
         if len(sys.argv) > 1:
@@ -181,24 +331,405 @@ class Cfg:
         return cls._info
 
     @classmethod
-    def _parse_raw_cfg(cls, raw_cfg):
-        cfg_globals = raw_cfg.get("globals", {})
-        assert isinstance(cfg_globals, dict)
-        locations = raw_cfg.get("locations")
-        assert isinstance(locations, dict)
-        keep_alives = raw_cfg.get("keep_alives", {})
-        assert isinstance(keep_alives, dict)
+    def reload(cls) -> Info:
+        """Load the config file again and return the config it replaced.
+
+        When the file cannot be loaded, the config in use is kept and the
+        error is raised.
+        """
+        old_info = cls._get_info()
+        cls._info = None
+        try:
+            cls._get_info()
+        except Exception:
+            cls._info = old_info
+            raise
+        return old_info
 
+    @classmethod
+    def _parse_raw_cfg(cls, raw_cfg):
+        """Validate the whole config and resolve every location.
+
+        Raises ConfigError listing all the problems found.
+        """
+        errors = []
+        if not isinstance(raw_cfg, collections.abc.Mapping):
+            raise ConfigError(["config must be a mapping"])
+        check_attrs(errors, "config", raw_cfg, SECTIONS)
+        mqtt, _ = section(errors, raw_cfg, "mqtt", MQTT_ATTRS)
+        if is_type(mqtt.get("qos"), int) and mqtt["qos"] not in (0, 1, 2):
+            errors.append("mqtt.qos: must be 0, 1 or 2")
+        knobs, knobs_valid = section(errors, raw_cfg, "knobs", KNOBS_ATTRS)
+        cfg_globals, globals_valid = section(errors, raw_cfg, "globals", GLOBALS_ATTRS)
+        raw_locations, _ = section(errors, raw_cfg, "locations", {})
+        raw_keep_alives, _ = section(errors, raw_cfg, "keep_alives", {})
+        raw_groups, _ = section(errors, raw_cfg, "groups", {})
+        if not raw_locations:
+            errors.append("locations: at least one location is needed")
+
+        # when globals are not valid, locations are still checked, against
+        # the defaults
+        location_globals = cfg_globals if globals_valid else {}
+        locations = {}
+        for name, attrs in raw_locations.items():
+            location = compile_location(errors, str(name), attrs, location_globals)
+            if location:
+                locations[location.name] = location
+        named_locations = {str(name): attrs for name, attrs in raw_locations.items()}
+        for location in locations.values():
+            check_strip(errors, location, named_locations)
+        keep_alives = {}
+        for name, attrs in raw_keep_alives.items():
+            where = f"keep_alives.{name}"
+            if name not in raw_locations:
+                errors.append(f"{where}: there is no location named {name}")
+            if check_attrs(errors, where, attrs, KEEP_ALIVE_ATTRS, required=True):
+                keep_alives[name] = dict(attrs)
+
+        groups = {}
+        for name, attrs in raw_groups.items():
+            group = compile_group(errors, str(name), attrs, named_locations, location_globals)
+            if group:
+                groups[group.name] = group
+
+        topics = {}
+        for location in locations.values():
+            check_unique_topic(errors, topics, location.topic, location.name)
+        for group in groups.values():
+            check_unique_topic(errors, topics, group.topic, f"group {group.name}")
+        device_topics = dict(topics)
+        for name, attrs in keep_alives.items():
+            check_unique_topic(errors, topics, attrs["subscribe_topic"], name)
+        if knobs_valid and knobs.get("instrumentation"):
+            topic = knobs.get("instrumentation_topic")
+            if topic:
+                check_unique_topic(errors, topics, topic, "knobs")
+        check_subtopics(errors, topics, device_topics)
+        if errors:
+            raise ConfigError(errors)
+
+        settings = compile_settings(mqtt, knobs, cfg_globals, cls._get_config_filename())
         cls._info = Info(
-            raw_cfg.get("mqtt"),
-            raw_cfg.get("knobs", {}),
-            cfg_globals,
-            locations,
-            keep_alives,
-            raw_cfg,
+            mqtt, knobs, cfg_globals, settings, locations, keep_alives, groups, raw_cfg
         )
 
 
+def is_type(value, attr_type) -> bool:
+    # bool is an int, but true is not a number of seconds
+    if isinstance(value, bool) and attr_type is not bool:
+        return False
+    return isinstance(value, attr_type)
+
+
+def type_name(attr_type) -> str:
+    if attr_type is NUMBER:
+        return "a number"
+    types = attr_type if isinstance(attr_type, tuple) else (attr_type,)
+    return " or ".join(
+        "a mapping" if t is Mapping else t.__name__
+        for t in types
+        if t is not type(None)
+    )
+
+
+def check_attrs(
+    errors: List[str], where: str, attrs, expected: Dict, required: bool = False
+) -> bool:
+    """Check that attrs only has the expected attributes, of the expected types."""
+    if not isinstance(attrs, collections.abc.Mapping):
+        errors.append(f"{where}: must be a mapping")
+        return False
+    valid = True
+    for attr, value in attrs.items():
+        if attr not in expected:
+            errors.append(f"{where}: unknown attribute {attr}")
+            valid = False
+        elif not is_type(value, expected[attr]):
+            errors.append(f"{where}.{attr}: must be {type_name(expected[attr])}")
+            valid = False
+        elif expected[attr] in (int, NUMBER) and value < 0:
+            errors.append(f"{where}.{attr}: must not be negative")
+            valid = False
+        elif attr in DEPRECATED_ATTRS:
+            logger.warning(f"{where}.{attr} is no longer used")
+    if required:
+        for attr in expected:
+            if attr not in attrs:
+                errors.append(f"{where}: missing attribute {attr}")
+                valid = False
+    return valid
+
+
+def section(errors: List[str], raw_cfg: Mapping, name: str, expected: Dict):
+    """A top level section and whether it is valid.
+
+    A section that is missing or only has comments is empty. One that is not
+    a mapping is reported by the check of the top level.
+    """
+    attrs = raw_cfg.get(name)
+    if not isinstance(attrs, collections.abc.Mapping):
+        return {}, attrs is None
+    if not expected:
+        return attrs, True
+    valid = check_attrs(errors, name, attrs, expected)
+    # checked even when the attributes are not, to list every error
+    valid = check_deadband(errors, name, attrs) and valid
+    valid = check_windows(errors, name, attrs) and valid
+    return attrs, valid
+
+
+def check_deadband(errors: List[str], where: str, attrs: Mapping) -> bool:
+    deadband = attrs.get("emeter_deadband")
+    if not isinstance(deadband, collections.abc.Mapping):
+        return True  # not there, or reported as not being a mapping
+    valid = True
+    for field, threshold in deadband.items():
+        if not is_type(threshold, NUMBER):
+            errors.append(f"{where}.emeter_deadband.{field}: must be a number")
+            valid = False
+    return valid
+
+
+def check_windows(errors: List[str], where: str, attrs: Mapping) -> bool:
+    windows = attrs.get("emeter_windows")
+    if not isinstance(windows, list):
+        return True  # not there, or reported as not being a list
+    valid = True
+    for window in windows:
+        if not is_type(window, NUMBER) or window <= 0:
+            errors.append(f"{where}.emeter_windows: {window} is not a number of seconds")
+            valid = False
+    return valid
+
+
+def check_unique_topic(errors: List[str], topics: Dict, topic: str, owner: str):
+    if topic in topics:
+        errors.append(
+            f"topic {topic} is used by both {topics[topic]} and {owner}"
+        )
+    else:
+        topics[topic] = owner
+
+
+def check_subtopics(errors: List[str], topics: Dict, device_topics: Dict):
+    # the bridge publishes and listens under each device topic, e.g. an
+    # outlet named status on a strip would get the status of the strip
+    for topic, owner in topics.items():
+        levels = topic.split("/")
+        for i in range(1, len(levels)):
+            parent = "/".join(levels[:i])
+            if parent in device_topics and levels[i] in DEVICE_SUBTOPICS:
+                errors.append(
+                    f"topic {topic} of {owner} collides with the {levels[i]}"
+                    f" topic of {device_topics[parent]}"
+                )
+
+
+def compile_location(
+    errors: List[str], name: str, attrs, cfg_globals: Mapping
+) -> Optional[Location]:
+    where = f"locations.{name}"
+    if not isinstance(attrs, collections.abc.Mapping):
+        errors.append(f"{where}: must be a mapping")
+        return None
+    valid = check_attrs(errors, where, attrs, LOCATION_ATTRS)
+    valid = check_deadband(errors, where, attrs) and valid
+    valid = check_windows(errors, where, attrs) and valid
+    if "strip" in attrs:
+        if attrs.get("host") or attrs.get("alias"):
+            errors.append(f"{where}: an outlet takes host and alias from its strip")
+            valid = False
+        if "outlet" not in attrs:
+            errors.append(f"{where}: needs the outlet on strip {attrs['strip']}")
+            valid = False
+    elif "outlet" in attrs:
+        errors.append(f"{where}: outlet needs the strip it is on")
+        valid = False
+    elif not attrs.get("host") and not attrs.get("alias"):
+        errors.append(f"{where}: needs a host or an alias")
+        valid = False
+    if not valid:
+        return None
+
+    def setting(attr, default, unset_when_zero=False):
+        # a location setting, else the global one, else the default. Some
+        # settings have always treated 0 as not set
+        for source in (attrs, cfg_globals):
+            if attr in source and not (unset_when_zero and not source[attr]):
+                return float(source[attr])
+        return float(default)
+
+    if attrs.get("topic"):
+        topic = attrs["topic"].format(name)
+    else:
+        topic_format = (
+            cfg_globals.get("topic_format") or const.MQTT_DEFAULT_CLIENT_TOPIC_FORMAT
+        )
+        # outlets are nested under their strip, e.g. /kasa/device/strip/lamp
+        topic = topic_format.format(
+            f"{attrs['strip']}/{name}" if "strip" in attrs else name
+        )
+    deadband = {}
+    for source in (cfg_globals, attrs):
+        if isinstance(source.get("emeter_deadband"), collections.abc.Mapping):
+            deadband.update(source["emeter_deadband"])
+    poll_interval = setting("poll_interval", const.KASA_DEFAULT_POLL_INTERVAL, True)
+    max_poll_interval = setting(
+        "max_poll_interval", const.KASA_DEFAULT_MAX_POLL_INTERVAL, True
+    )
+    windows = attrs.get("emeter_windows", cfg_globals.get("emeter_windows", []))
+    return Location(
+        name=name,
+        topic=topic,
+        host=attrs.get("host"),
+        alias=attrs.get("alias"),
+        strip=attrs.get("strip"),
+        outlet=attrs.get("outlet"),
+        poll_interval=poll_interval,
+        max_poll_interval=max(poll_interval, max_poll_interval),
+        emeter_poll_interval=setting(
+            "emeter_poll_interval", const.KASA_DEFAULT_EMETER_POLL_INTERVAL, True
+        ),
+        emeter_deadband=MappingProxyType(
+            {field: float(threshold) for field, threshold in deadband.items()}
+        ),
+        emeter_max_age=setting("emeter_max_age", const.KASA_DEFAULT_EMETER_MAX_AGE),
+        emeter_windows=tuple(sorted(set(map(float, windows)))),
+        throttle_rate_limit=setting(
+            "throttle_rate_limit", const.KASA_DEFAULT_THROTTLE_RATE_LIMIT
+        ),
+        throttle_period=setting("throttle_period", const.KASA_DEFAULT_THROTTLE_PERIOD),
+        brightness_debounce=setting(
+            "brightness_debounce", const.KASA_DEFAULT_BRIGHTNESS_DEBOUNCE
+        ),
+    )
+
+
+def compile_settings(
+    mqtt: Mapping, knobs: Mapping, cfg_globals: Mapping, config_filename: str
+) -> Settings:
+    def number(attrs, attr, default, cast=float, minimum=None):
+        # settings that have always treated 0 as not set
+        value = cast(attrs.get(attr) or default)
+        return value if minimum is None else max(minimum, value)
+
+    if "alias_cache_file" in cfg_globals:
+        alias_cache_file = cfg_globals["alias_cache_file"] or None
+    else:
+        config_dir = os.path.dirname(os.path.abspath(config_filename))
+        alias_cache_file = os.path.join(
+            config_dir, const.KASA_DEFAULT_ALIAS_CACHE_FILENAME
+        )
+    return Settings(
+        mqtt_host=mqtt.get("host", const.MQTT_DEFAULT_BROKER_IP),
+        mqtt_client_id=mqtt.get("client_id", const.MQTT_DEFAULT_CLIENT_ID),
+        mqtt_username=mqtt.get("username"),
+        mqtt_password=mqtt.get("password"),
+        mqtt_retain=mqtt.get("retain", False),
+        mqtt_qos=mqtt.get("qos", 0),
+        reconnect_interval=mqtt.get(
+            "reconnect_interval", const.MQTT_DEFAULT_RECONNECT_INTERVAL
+        ),
+        mqtt_publish_rate=float(
+            mqtt.get("publish_rate", const.MQTT_DEFAULT_PUBLISH_RATE)
+        ),
+        mqtt_publish_burst=int(
+            mqtt.get("publish_burst", const.MQTT_DEFAULT_PUBLISH_BURST)
+        ),
+        mqtt_publish_max_inflight=max(
+            1,
+            int(mqtt.get("publish_max_inflight", const.MQTT_DEFAULT_PUBLISH_MAX_INFLIGHT)),
+        ),
+        mqtt_dedup_window=float(
+            mqtt.get("dedup_window", const.MQTT_DEFAULT_DEDUP_WINDOW)
+        ),
+        mqtt_telemetry_queue_size=max(
+            1,
+            int(mqtt.get("telemetry_queue_size", const.MQTT_DEFAULT_TELEMETRY_QUEUE_SIZE)),
+        ),
+        mqtt_wildcard_subscriptions=mqtt.get("wildcard_subscriptions", True),
+        instrumentation=bool(knobs.get("instrumentation", False)),
+        instrumentation_slow_threshold=float(
+            knobs.get(
+                "instrumentation_slow_threshold",
+                const.INSTRUMENTATION_DEFAULT_SLOW_THRESHOLD,
+            )
+        ),
+        instrumentation_lag_interval=number(
+            knobs,
+            "instrumentation_lag_interval",
+            const.INSTRUMENTATION_DEFAULT_LAG_INTERVAL,
+        ),
+        instrumentation_topic=knobs.get("instrumentation_topic") or None,
+        keep_alive_task_interval=number(
+            cfg_globals,
+            "keep_alive_task_interval",
+            const.KEEP_ALIVE_DEFAULT_TASK_INTERVAL,
+        ),
+        init_concurrency=number(
+            cfg_globals, "init_concurrency", const.KASA_DEFAULT_INIT_CONCURRENCY, int, 1
+        ),
+        group_concurrency=number(
+            cfg_globals, "group_concurrency", const.KASA_DEFAULT_GROUP_CONCURRENCY, int, 1
+        ),
+        init_timeout=number(cfg_globals, "init_timeout", const.KASA_DEFAULT_INIT_TIMEOUT),
+        init_retry_interval=number(
+            cfg_globals, "init_retry_interval", const.KASA_DEFAULT_INIT_RETRY_INTERVAL
+        ),
+        max_concurrent_polls=number(
+            cfg_globals,
+            "max_concurrent_polls",
+            const.KASA_DEFAULT_MAX_CONCURRENT_POLLS,
+            int,
+            1,
+        ),
+        alias_cache_file=alias_cache_file,
+        metrics_host=cfg_globals.get("metrics_host") or const.METRICS_DEFAULT_HOST,
+        metrics_port=number(cfg_globals, "metrics_port", const.METRICS_DEFAULT_PORT, int),
+    )
+
+
+def compile_group(
+    errors: List[str], name: str, attrs, named_locations: Mapping, cfg_globals: Mapping
+) -> Optional[Group]:
+    where = f"groups.{name}"
+    if isinstance(attrs, list):
+        attrs = {"members": attrs}
+    if not check_attrs(errors, where, attrs, GROUP_ATTRS):
+        return None
+    members = tuple(str(member) for member in attrs.get("members") or ())
+    valid = True
+    if not members:
+        errors.append(f"{where}: needs at least one member")
+        valid = False
+    for member in members:
+        if member not in named_locations:
+            errors.append(f"{where}: there is no location named {member}")
+            valid = False
+    if name in named_locations:
+        errors.append(f"{where}: there is a location with the same name")
+        valid = False
+    if not valid:
+        return None
+    topic_format = (
+        attrs.get("topic")
+        or cfg_globals.get("topic_format")
+        or const.MQTT_DEFAULT_CLIENT_TOPIC_FORMAT
+    )
+    return Group(name=name, topic=topic_format.format(name), members=members)
+
+
+def check_strip(errors: List[str], location: Location, raw_locations: Mapping):
+    if location.strip is None:
+        return
+    where = f"locations.{location.name}.strip"
+    strip = raw_locations.get(location.strip)
+    if strip is None:
+        errors.append(f"{where}: there is no location named {location.strip}")
+    elif isinstance(strip, collections.abc.Mapping) and "strip" in strip:
+        errors.append(f"{where}: {location.strip} is an outlet itself")
+
+
 # =============================================================================
 
 
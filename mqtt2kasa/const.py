@@ -4,9 +4,36 @@ MQTT_DEFAULT_CLIENT_ID = "mqtt2kasa"
 MQTT_DEFAULT_CLIENT_TOPIC_FORMAT = "/kasa/device/{}"
 MQTT_DEFAULT_BROKER_IP = "192.168.10.238"
 MQTT_DEFAULT_RECONNECT_INTERVAL = 13  # [seconds]
+MQTT_DEFAULT_PUBLISH_RATE = 20  # [messages per second] 0 == disabled
+MQTT_DEFAULT_PUBLISH_BURST = 40  # [messages]
+MQTT_DEFAULT_PUBLISH_MAX_INFLIGHT = 8
+MQTT_PUBLISH_STATS_INTERVAL = 300  # [seconds]
+MQTT_DEFAULT_DEDUP_WINDOW = 5  # [seconds] 0 == disabled
+MQTT_DEFAULT_TELEMETRY_QUEUE_SIZE = 128  # [messages]
 KASA_DEFAULT_POLL_INTERVAL = 10  # [seconds]
+KASA_DEFAULT_MAX_POLL_INTERVAL = 0  # [seconds] 0 == same as poll interval
+KASA_POLL_BACKOFF_FACTOR = 1.5
+KASA_DEFAULT_MAX_CONCURRENT_POLLS = 8  # devices queried by polls at once
+KASA_POLL_SLIP_WARNING = 1.0  # [seconds]
+KASA_POLL_STATS_INTERVAL = 300  # [seconds]
 KASA_DEFAULT_EMETER_POLL_INTERVAL = 0  # [seconds] 0 == disabled
+KASA_DEFAULT_EMETER_MAX_AGE = 900  # [seconds] 0 == no heartbeat
+EVENTS_QUEUE_SIZE = 64  # per device
 KEEP_ALIVE_DEFAULT_TASK_INTERVAL = 1.5  # [seconds]
 KASA_DEFAULT_THROTTLE_RATE_LIMIT = 4  # 0 == disabled
 KASA_DEFAULT_THROTTLE_PERIOD = 60
-KASA_DEFAULT_RECEIVE_QUEUE_SIZE = 4  # 0 == queue is disabled
+KASA_DEFAULT_BRIGHTNESS_DEBOUNCE = 0  # [seconds] 0 == disabled
+KASA_DEFAULT_INIT_CONCURRENCY = 16  # devices initialized at the same time
+KASA_DEFAULT_GROUP_CONCURRENCY = 8  # devices of a group commanded at once
+KASA_GROUP_APPLY_TIMEOUT = 10  # [seconds] for a member to apply a group command
+KASA_DEFAULT_INIT_TIMEOUT = 20  # [seconds]
+KASA_DEFAULT_INIT_RETRY_INTERVAL = 30  # [seconds] doubles on every failure
+KASA_MAX_INIT_RETRY_INTERVAL = 600  # [seconds]
+KASA_DEFAULT_ALIAS_CACHE_FILENAME = "alias_cache.json"  # next to config file
+KASA_ALIAS_REDISCOVER_FAILS = 3  # failed queries before locating alias again
+KASA_RECONNECT_BACKOFF = 2  # [seconds] doubles on every failed request
+KASA_MAX_RECONNECT_BACKOFF = 120  # [seconds]
+METRICS_DEFAULT_HOST = "127.0.0.1"
+METRICS_DEFAULT_PORT = 0  # 0 == disabled
+INSTRUMENTATION_DEFAULT_SLOW_THRESHOLD = 0.1  # [seconds]
+INSTRUMENTATION_DEFAULT_LAG_INTERVAL = 1.0  # [seconds]
@@ -0,0 +1,177 @@
+#!/usr/bin/env python
+import math
+import time
+from array import array
+from collections import namedtuple
+from typing import Dict, List, Optional, Sequence, Tuple
+
+
+class EmeterReading(namedtuple("EmeterReading", "power voltage current total")):
+    """One emeter reading, in W, V, A and kWh."""
+
+    __slots__ = ()
+
+    @classmethod
+    def from_status(cls, emeter_status) -> "EmeterReading":
+        return cls(
+            power=emeter_status.power,
+            voltage=emeter_status.voltage,
+            current=emeter_status.current,
+            total=emeter_status.total,
+        )
+
+    def __str__(self):
+        # same format python-kasa uses for EmeterStatus
+        return (
+            f"<EmeterStatus power={self.power} voltage={self.voltage}"
+            f" current={self.current} total={self.total}>"
+        )
+
+
+class EmeterFilter:
+    """Decides which emeter fields are worth publishing.
+
+    A field listed in deadband is only published when it moved by more than
+    its threshold since it was last published, or when it was last published
+    max_age seconds ago. Fields that are not listed are always published.
+    """
+
+    def __init__(self, deadband: Dict[str, float], max_age: float):
+        self.deadband = deadband
+        self.max_age = max_age
+        self.last_values: Dict[str, Optional[float]] = {}
+        self.last_ts: Dict[str, float] = {}
+        self.published = 0
+        self.suppressed = 0
+
+    def changed_fields(
+        self, reading: EmeterReading, now: Optional[float] = None
+    ) -> List[str]:
+        now = time.monotonic() if now is None else now
+        fields = []
+        for field, value in zip(reading._fields, reading):
+            if self._is_within_deadband(field, value, now):
+                self.suppressed += 1
+                continue
+            self.last_values[field] = value
+            self.last_ts[field] = now
+            self.published += 1
+            fields.append(field)
+        return fields
+
+    def _is_within_deadband(self, field: str, value: Optional[float], now: float):
+        threshold = self.deadband.get(field)
+        if threshold is None or field not in self.last_values:
+            return False
+        if self.max_age and now - self.last_ts[field] >= self.max_age:
+            return False
+        last_value = self.last_values[field]
+        if value is None or last_value is None:
+            return value is last_value
+        return abs(value - last_value) <= threshold
+
+
+def window_label(window: float) -> str:
+    """e.g. 60 -> 1m, 900 -> 15m, 3600 -> 1h, 90 -> 90s"""
+    for unit, seconds in (("h", 3600), ("m", 60)):
+        if window >= seconds and window % seconds == 0:
+            return f"{int(window // seconds)}{unit}"
+    return f"{window:g}s"
+
+
+class EmeterRing:
+    """The most recent emeter readings, in fixed size arrays of doubles.
+
+    Timestamps and every field of the readings are kept in columns, so
+    each reading costs 40 bytes. Missing values are kept as NaN. Once full,
+    a new reading overwrites the oldest one.
+    """
+
+    __slots__ = ("capacity", "ts", "columns", "start", "count")
+
+    def __init__(self, capacity: int):
+        self.capacity = capacity
+        self.ts = array("d", [0.0]) * capacity
+        self.columns = {
+            field: array("d", [math.nan]) * capacity for field in EmeterReading._fields
+        }
+        self.start = 0
+        self.count = 0
+
+    def __len__(self):
+        return self.count
+
+    def append(self, ts: float, reading: EmeterReading):
+        i = (self.start + self.count) % self.capacity
+        if self.count == self.capacity:
+            self.start = (self.start + 1) % self.capacity
+        else:
+            self.count += 1
+        self.ts[i] = ts
+        for field, value in zip(reading._fields, reading):
+            self.columns[field][i] = math.nan if value is None else value
+
+    def positions(self) -> List[int]:
+        """Array positions of the readings, oldest first."""
+        return [(self.start + n) % self.capacity for n in range(self.count)]
+
+
+class EmeterWindows:
+    """Aggregates the readings of a device over fixed windows of time.
+
+    Windows are aligned to the epoch, e.g. a 60 second window covers a
+    whole minute. A window is aggregated by the first reading that falls
+    after it. The ring holds enough readings, at the given poll interval,
+    for the longest window.
+    """
+
+    AVERAGED = ("power", "voltage", "current")
+
+    def __init__(self, windows: Sequence[float], poll_interval: float):
+        self.windows = sorted(windows)
+        self.ring = EmeterRing(int(self.windows[-1] / poll_interval) + 2)
+        self.window_ends: Dict[float, Optional[float]] = dict.fromkeys(self.windows)
+
+    def add(self, ts: float, reading: EmeterReading) -> List[Tuple[str, Dict]]:
+        """Keep reading, and return the (label, aggregate) of windows it closed."""
+        closed = []
+        for window in self.windows:
+            end = self.window_ends[window]
+            if end is not None and ts < end:
+                continue
+            if end is not None:
+                aggregate = self.aggregate(end - window, end)
+                if aggregate:
+                    closed.append((window_label(window), aggregate))
+            self.window_ends[window] = (ts // window + 1) * window
+        self.ring.append(ts, reading)
+        return closed
+
+    def aggregate(self, start: float, end: float) -> Optional[Dict]:
+        ring = self.ring
+        before, inside = None, []
+        for i in ring.positions():
+            if ring.ts[i] < start:
+                before = i
+            elif ring.ts[i] < end:
+                inside.append(i)
+        if not inside:
+            return None
+        aggregate = {"start": int(start), "end": int(end), "samples": len(inside)}
+        for field in self.AVERAGED:
+            column = ring.columns[field]
+            values = [column[i] for i in inside if not math.isnan(column[i])]
+            if values:
+                aggregate[field] = {
+                    "min": min(values),
+                    "max": max(values),
+                    "avg": round(math.fsum(values) / len(values), 3),
+                }
+        # energy used in the window: total is a running kWh count. The last
+        # reading before the window, if still kept, is where it started from
+        total = ring.columns["total"]
+        first = inside[0] if before is None else before
+        energy = total[inside[-1]] - total[first]
+        if not math.isnan(energy):
+            aggregate["energy"] = round(energy, 6)
+        return aggregate
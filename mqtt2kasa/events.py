@@ -1,52 +1,72 @@
 #!/usr/bin/env python
-from collections import namedtuple
+import time
 
 
 class BaseEvent:
-    def __init__(self, expected_attrs, attrs):
-        self.event = self.__class__.__name__
-        self.attrs = self._dict_to_attrs(attrs)
-        self._check_expected_attrs(expected_attrs)
-
-    def __getattr__(self, attr):
-        try:
-            return getattr(self.attrs, attr)
-        except AttributeError as e:
-            raise AttributeError(
-                f"{self.event} object is missing {attr} attribute"
-            ) from e
-
-    def _check_expected_attrs(self, expected_attrs):
-        if expected_attrs:
-            for attr in expected_attrs:
-                getattr(self, attr)
-
-    @staticmethod
-    def _dict_to_attrs(params_dict):
-        cls = namedtuple("Attrs", params_dict)
-        cls.__new__.__defaults__ = tuple(params_dict.values())
-        return cls()
+    # Events are created for every mqtt message and every device change, so
+    # they are kept as plain fixed-slot objects: no per-instance dict and no
+    # per-instance class.
+    __slots__ = ("created",)
+
+    def __init__(self):
+        self.created = time.monotonic()
+
+    @property
+    def event(self) -> str:
+        return self.__class__.__name__
+
+    def __repr__(self):
+        attrs = ", ".join(
+            f"{attr}={getattr(self, attr)!r}" for attr in self.__class__.__slots__
+        )
+        return f"{self.event}({attrs})"
+
+
+# Classes of outbound mqtt messages. Lower values are published first
+PRIORITY_CONTROL = 0  # device state and replies to commands
+PRIORITY_KEEP_ALIVE = 1
+PRIORITY_TELEMETRY = 2  # emeter readings; dropped when publishing falls behind
+PRIORITY_NAMES = ("control", "keep_alive", "telemetry")
 
 
 class MqttMsgEvent(BaseEvent):
-    def __init__(self, **attrs):
-        expected_attrs = "topic", "payload"
-        super().__init__(expected_attrs, attrs)
+    __slots__ = ("topic", "payload", "priority")
+
+    def __init__(self, topic, payload, priority=PRIORITY_CONTROL):
+        super().__init__()
+        self.topic = topic
+        self.payload = payload
+        self.priority = priority
 
 
 class KasaStateEvent(BaseEvent):
-    def __init__(self, **attrs):
-        expected_attrs = "name", "state"
-        super().__init__(expected_attrs, attrs)
+    __slots__ = ("name", "state", "old_state", "applied")
+
+    def __init__(self, name, state, old_state=None, applied=None):
+        super().__init__()
+        self.name = name
+        self.state = state
+        self.old_state = old_state
+        # optional future, done once the device handled the event or a newer
+        # one replaced it
+        self.applied = applied
 
 
 class KasaBrightnessEvent(BaseEvent):
-    def __init__(self, **attrs):
-        expected_attrs = "name", "brightness"
-        super().__init__(expected_attrs, attrs)
+    __slots__ = ("name", "brightness", "applied")
+
+    def __init__(self, name, brightness, applied=None):
+        super().__init__()
+        self.name = name
+        self.brightness = brightness
+        # as for KasaStateEvent
+        self.applied = applied
 
 
 class KasaEmeterEvent(BaseEvent):
-    def __init__(self, **attrs):
-        expected_attrs = "name", "emeter_status"
-        super().__init__(expected_attrs, attrs)
+    __slots__ = ("name", "emeter")
+
+    def __init__(self, name, emeter):
+        super().__init__()
+        self.name = name
+        self.emeter = emeter
@@ -0,0 +1,59 @@
+#!/usr/bin/env python
+import asyncio
+from typing import Dict, List, Optional
+
+from mqtt2kasa.events import KasaStateEvent
+from mqtt2kasa.kasa_wrapper import Kasa
+
+STATE_MIXED = "mixed"
+
+
+def group_command(kasas: List[Kasa], payload: str) -> Optional[bool]:
+    """The state a group command asks for, or None when it makes no sense.
+
+    Toggling a group turns it off when any member is on.
+    """
+    if Kasa.state_is_toggle(payload):
+        return not any(kasa.curr_state for kasa in kasas)
+    if Kasa.state_is_on(payload):
+        return True
+    if Kasa.state_is_off(payload):
+        return False
+    return None
+
+
+async def fan_out(
+    kasas: List[Kasa], state: bool, concurrency: int, timeout: float
+) -> List[Kasa]:
+    """Ask the devices for state, at most concurrency of them at a time.
+
+    The command goes through the command queue of each device like any other
+    command: it replaces an older pending one, and it is read back once
+    written. Devices that have not started are skipped. Returns the devices
+    that handled it within timeout seconds.
+    """
+    limit = asyncio.Semaphore(concurrency)
+    loop = asyncio.get_running_loop()
+
+    async def apply(kasa: Kasa) -> bool:
+        if not kasa.started:
+            return False
+        async with limit:
+            event = KasaStateEvent(
+                name=kasa.name, state=state, applied=loop.create_future()
+            )
+            kasa.recv_q.put_nowait(event)
+            done, _ = await asyncio.wait([event.applied], timeout=timeout)
+        return bool(done)
+
+    handled = await asyncio.gather(*[apply(kasa) for kasa in kasas])
+    return [kasa for kasa, kasa_handled in zip(kasas, handled) if kasa_handled]
+
+
+def group_status(name: str, kasas: List[Kasa]) -> Dict:
+    states = {kasa.curr_state for kasa in kasas}
+    return {
+        "name": name,
+        "state": Kasa.state_name(states.pop()) if len(states) == 1 else STATE_MIXED,
+        "members": {kasa.name: Kasa.state_name(kasa.curr_state) for kasa in kasas},
+    }
@@ -0,0 +1,154 @@
+#!/usr/bin/env python
+import asyncio
+import logging
+import re
+import signal
+import time
+from typing import Callable, Dict, Optional
+
+from mqtt2kasa import log
+
+logger = log.getLogger()
+
+# e.g. <Task pending name='Task-5' coro=<handle_main_events() running at ...>>
+_CORO_NAME = re.compile(r"coro=<([\w.<>]+)\(")
+
+
+class TimingStats:
+    __slots__ = ("count", "total", "max")
+
+    def __init__(self):
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def record(self, elapsed: float):
+        self.count += 1
+        self.total += elapsed
+        if elapsed > self.max:
+            self.max = elapsed
+
+    def as_dict(self) -> Dict:
+        return {
+            "count": self.count,
+            "avg_ms": round(self.total / max(1, self.count) * 1000, 3),
+            "max_ms": round(self.max * 1000, 3),
+            "total_ms": round(self.total * 1000, 3),
+        }
+
+
+class _SlowCallbackHandler(logging.Handler):
+    """Collects the slow callbacks that asyncio debug mode reports."""
+
+    def __init__(self, instrumentation: "Instrumentation"):
+        super().__init__()
+        self.instrumentation = instrumentation
+
+    def emit(self, record: logging.LogRecord):
+        # asyncio logs: 'Executing %s took %.3f seconds', handle, seconds
+        if not isinstance(record.msg, str) or not record.msg.startswith("Executing"):
+            return
+        if not isinstance(record.args, tuple) or len(record.args) != 2:
+            return
+        handle, elapsed = record.args
+        handle = str(handle)
+        match = _CORO_NAME.search(handle)
+        self.instrumentation.record_slow(match.group(1) if match else handle, elapsed)
+
+
+class Instrumentation:
+    """Opt-in timing of handlers and of the event loop itself.
+
+    When enabled, it records how long every handler takes per event type,
+    samples how late the event loop wakes up from a periodic sleep, and uses
+    asyncio debug mode to learn which coroutines held the loop for longer
+    than slow_threshold seconds. dump() logs the worst offenders.
+    """
+
+    def __init__(self):
+        self.enabled = False
+        self.slow_threshold = 0.1
+        self.lag_interval = 1.0
+        self.handlers: Dict[Callable, TimingStats] = {}
+        self.slow: Dict[str, TimingStats] = {}
+        self.lag = TimingStats()
+
+    def configure(self, enabled: bool, slow_threshold: float, lag_interval: float):
+        self.enabled = enabled
+        self.slow_threshold = slow_threshold
+        self.lag_interval = lag_interval
+
+    def start(self) -> Optional[float]:
+        return time.perf_counter() if self.enabled else None
+
+    def handler_done(self, handler: Callable, started: Optional[float]):
+        if started is None:
+            return
+        stats = self.handlers.get(handler)
+        if stats is None:
+            stats = self.handlers[handler] = TimingStats()
+        stats.record(time.perf_counter() - started)
+
+    def record_slow(self, name: str, elapsed: float):
+        stats = self.slow.get(name)
+        if stats is None:
+            stats = self.slow[name] = TimingStats()
+        stats.record(elapsed)
+
+    def report(self, top: int = 10) -> Dict:
+        def worst(stats: Dict, key: Callable) -> Dict:
+            ranked = sorted(stats.items(), key=lambda item: item[1].total, reverse=True)
+            return {key(name): s.as_dict() for name, s in ranked[:top]}
+
+        return {
+            "handlers": worst(self.handlers, lambda handler: handler.__name__),
+            "slow_coroutines": worst(self.slow, str),
+            "loop_lag": self.lag.as_dict(),
+        }
+
+    def dump(self, top: int = 10) -> Dict:
+        report = self.report(top)
+        lag = report["loop_lag"]
+        logger.info(
+            f"Loop lag: samples:{lag['count']} avg:{lag['avg_ms']}ms"
+            f" max:{lag['max_ms']}ms"
+        )
+        for section in ("handlers", "slow_coroutines"):
+            for name, stats in report[section].items():
+                logger.info(
+                    f"{section} {name}: count:{stats['count']}"
+                    f" avg:{stats['avg_ms']}ms max:{stats['max_ms']}ms"
+                    f" total:{stats['total_ms']}ms"
+                )
+        return report
+
+    async def run(self):
+        if not self.enabled:
+            return
+        loop = asyncio.get_running_loop()
+        # debug mode is what reports slow callbacks, but it also checks every
+        # callback and tracks where each coroutine was created, process wide
+        loop.set_debug(True)
+        loop.slow_callback_duration = self.slow_threshold
+        handler = _SlowCallbackHandler(self)
+        logging.getLogger("asyncio").addHandler(handler)
+        loop.add_signal_handler(signal.SIGUSR1, self.dump)
+        logger.info(
+            f"Instrumentation enabled. Slow threshold:{self.slow_threshold}s"
+            f" lag probe interval:{self.lag_interval}s. Send SIGUSR1 to dump"
+        )
+        try:
+            while True:
+                expected = time.monotonic() + self.lag_interval
+                await asyncio.sleep(self.lag_interval)
+                lag = time.monotonic() - expected
+                self.lag.record(lag)
+                if lag > self.slow_threshold:
+                    logger.warning(f"Event loop lagged {lag * 1000:.0f}ms")
+        finally:
+            loop.remove_signal_handler(signal.SIGUSR1)
+            logging.getLogger("asyncio").removeHandler(handler)
+            loop.set_debug(False)
+
+
+instrumentation = Instrumentation()
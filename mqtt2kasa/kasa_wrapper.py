@@ -1,18 +1,29 @@
 #!/usr/bin/env python
 import asyncio
-import random
-from typing import Optional
+import time
+from collections import OrderedDict, namedtuple
+from typing import Awaitable, Callable, Dict, Optional
 
 from asyncio_throttle import Throttler
-from kasa import Discover, EmeterStatus
+from kasa import Discover
 from kasa.smartdevice import SmartDevice, SmartDeviceException
 
+from mqtt2kasa import const
 from mqtt2kasa import log
-from mqtt2kasa.config import Cfg
+from mqtt2kasa.alias_cache import AliasCache
+from mqtt2kasa.config import Cfg, Location
+from mqtt2kasa.emeter import EmeterFilter, EmeterReading, EmeterWindows
 from mqtt2kasa.events import KasaStateEvent, KasaBrightnessEvent, KasaEmeterEvent
+from mqtt2kasa.instrumentation import instrumentation
+from mqtt2kasa.metrics import DeviceMetrics, MeteredQueue
 
 logger = log.getLogger()
 
+# Immutable record of everything a single device.update() tells us. All the
+# device properties exposed by Kasa are read from the most recent one of these,
+# so a poll cycle costs exactly one round-trip to the device.
+KasaState = namedtuple("KasaState", "is_on brightness is_dimmable has_emeter emeter")
+
 
 class NoThrottler:
     async def __aenter__(self):
@@ -22,32 +33,190 @@ class NoThrottler:
         pass
 
 
+class TimedThrottler:
+    """Throttler that records how long each caller waited to get through."""
+
+    def __init__(self, throttler: Throttler, histogram):
+        self.throttler = throttler
+        self.histogram = histogram
+
+    async def __aenter__(self):
+        started = time.monotonic()
+        await self.throttler.__aenter__()
+        self.histogram.observe(time.monotonic() - started)
+
+    async def __aexit__(self, exc_type, exc, tb):
+        await self.throttler.__aexit__(exc_type, exc, tb)
+
+
+def event_done(event):
+    """Complete the applied future of event, if anyone waits on it."""
+    applied = getattr(event, "applied", None)
+    if applied is not None and not applied.done():
+        applied.set_result(None)
+
+
+class CoalescingQueue(MeteredQueue):
+    """Queue that keeps only the latest item of each kind.
+
+    Putting an item while one of the same type is still pending replaces it,
+    so a burst of commands for a device collapses into the last intended
+    on/off and the last intended brightness. Whoever waits on a replaced
+    item is told it is done.
+    """
+
+    def _init(self, maxsize):
+        self._queue = OrderedDict()
+        self.coalesced = 0
+
+    def _put(self, item):
+        key = type(item)
+        if key in self._queue:
+            self.coalesced += 1
+            event_done(self._queue.pop(key))
+            # the replaced item will never be gotten, so it is done as well.
+            # put_nowait counts the new one
+            self._unfinished_tasks -= 1
+        self._queue[key] = item
+
+    def _get(self):
+        return self._queue.popitem(last=False)[1]
+
+    def pending(self, key) -> bool:
+        return key in self._queue
+
+
 class Kasa:
     STATE_ON = "on"
     STATE_OFF = "off"
 
-    _discovered_devices = None
-
-    def __init__(self, name: str, topic: str, config: dict):
-        self.name = name
-        self.topic = topic
-        self.host = config.get("host")
-        self.alias = config.get("alias")
-        self.poll_interval = Cfg().poll_interval(name)
-        self.emeter_poll_interval = Cfg().emeter_poll_interval(name)
-        self.recv_q = asyncio.Queue(maxsize=Cfg().receive_queue_size(name))
-        rate_limit = Cfg().throttle_rate_limit(name)
-        if rate_limit > 0:
-            self.throttler = Throttler(
-                rate_limit=Cfg().throttle_rate_limit(name),
-                period=Cfg().throttle_period(name),
-            )
-        else:
-            self.throttler = NoThrottler()
-        self.curr_state = None
+    # alias lookups are shared by all instances: one discovery broadcast resolves
+    # every alias that still needs to be located, and the results are
+    # remembered in the alias cache
+    _aliases = set()  # of the devices that are not located yet
+    _devices_by_alias = {}  # found by a broadcast, for devices not located yet
+    _discovery_lock = None
+    _alias_cache = None
+
+    def __init__(self, location: Location):
+        self.name = location.name
+        self.host = location.host
+        self.alias = location.alias
+        self.poll_job = None  # set once the PollScheduler runs the polls
+        self.emeter_job = None
+        self.poll_fails = 0
+        self.emeter_poll_fails = 0
+        self.recv_q = CoalescingQueue()
+        self.metrics = DeviceMetrics(self)
+        self.configure(location)
+        self._curr_state = None
+        # set while the device is started, i.e. ready to take commands
+        self.ready = asyncio.Event()
+        # called with this device when curr_state changes
+        self.on_state_change: Optional[Callable[["Kasa"], None]] = None
         self.curr_brightness = None
+        self.state: Optional[KasaState] = None
+        self.queries = 0  # total device round-trips issued
+        self.poll_queries = 0  # device round-trips made by the last poll cycle
+        self.fails = 0  # consecutive failed device queries
+        # an outlet is queried through its strip. A strip query takes the
+        # snapshot of all its outlets
+        self.strip: Optional["Kasa"] = None
+        self.outlets: Dict[str, "Kasa"] = {}
+        self.polling = False  # set once the polls of the device are scheduled
+        # the device and its open connection are kept across requests
+        self.connected = False
+        self.sessions = 0  # sessions opened to the device
+        self.served = 0  # requests answered by the device
+        self._reconnect_at = 0.0
+        self._device = None
+        self._by_alias = not self.host and not location.strip
+        assert self.host or self.alias or location.strip
+        if self._by_alias:
+            self._aliases.add(self.alias)
+
+    def configure(self, location: Location):
+        """Apply the settings of location that can change without a restart.
+
+        The throttler, the emeter filter and the emeter windows are only built
+        again when their own settings change, so they keep what they hold.
+        """
+        old = getattr(self, "location", None)
+
+        def changed(*attrs) -> bool:
+            return old is None or any(
+                getattr(old, attr) != getattr(location, attr) for attr in attrs
+            )
+
+        self.location = location
+        self.topic = location.topic
+        self.poll_interval = location.poll_interval
+        self.max_poll_interval = location.max_poll_interval
+        if changed("poll_interval", "max_poll_interval"):
+            # polls back off from poll_interval towards max_poll_interval while
+            # the device is idle
+            self.effective_poll_interval = self.poll_interval
+        self.emeter_poll_interval = location.emeter_poll_interval
+        if changed("emeter_deadband", "emeter_max_age"):
+            self.emeter_filter = EmeterFilter(
+                location.emeter_deadband, location.emeter_max_age
+            )
+        if changed("emeter_windows", "emeter_poll_interval"):
+            self.emeter_windows = None
+            if location.emeter_windows and location.emeter_poll_interval:
+                self.emeter_windows = EmeterWindows(
+                    location.emeter_windows, location.emeter_poll_interval
+                )
+        self.brightness_debounce = location.brightness_debounce
+        if changed("throttle_rate_limit", "throttle_period"):
+            if location.throttle_rate_limit > 0:
+                self.throttler = TimedThrottler(
+                    Throttler(
+                        rate_limit=location.throttle_rate_limit,
+                        period=location.throttle_period,
+                    ),
+                    self.metrics.throttle_wait_seconds,
+                )
+            else:
+                self.throttler = NoThrottler()
+
+    def attach(self, strip: "Kasa"):
+        """Make this the outlet of strip, which may replace a previous one."""
+        if self.strip:
+            self.strip.outlets.pop(self.name, None)
+        self.strip = strip
+        strip.outlets[self.name] = self
+        self._update_ready()
+
+    @property
+    def _owner(self) -> "Kasa":
+        # outlets share the device, session and throttler of their strip
+        return self.strip or self
+
+    def _outlet_of(self, device: SmartDevice) -> SmartDevice:
+        outlet = self.location.outlet
+        if isinstance(outlet, int):
+            return device.get_plug_by_index(outlet)
+        return device.get_plug_by_name(outlet)
+
+    async def stop(self):
+        """Let go of the device once its location is no longer configured."""
+        DeviceMetrics.remove(self.name)
+        if self.strip:
+            self.strip.outlets.pop(self.name, None)
+        if self._by_alias:
+            self._located(self.alias)
+        await self._close_session()
         self._device = None
-        assert self.host or self.alias
+        self._update_ready()
+
+    async def _close_session(self):
+        self.connected = False
+        if self._device:
+            try:
+                await self._device.disconnect()
+            except (SmartDeviceException, OSError) as e:
+                logger.debug(f"{self.name} did not disconnect cleanly: {e}")
 
     async def _get_device(self) -> SmartDevice:
         if not self._device:
@@ -65,105 +234,320 @@ class Kasa:
             )
         return self._device
 
+    @property
+    def curr_state(self) -> Optional[bool]:
+        return self._curr_state
+
+    @curr_state.setter
+    def curr_state(self, state: Optional[bool]):
+        changed = state != self._curr_state
+        self._curr_state = state
+        self._update_ready()
+        if changed and self.on_state_change:
+            self.on_state_change(self)
+
     @property
     def started(self):
-        return self._device and isinstance(self.curr_state, bool)
+        return self._owner._device and isinstance(self.curr_state, bool)
+
+    def _update_ready(self):
+        if self.started:
+            self.ready.set()
+        else:
+            self.ready.clear()
+        for outlet in self.outlets.values():
+            outlet._update_ready()
 
     @classmethod
-    async def _find_by_alias(cls, name, alias, retry=0):
-        if not cls._discovered_devices:
-            cls._discovered_devices = await Discover.discover()
+    def _get_alias_cache(cls) -> AliasCache:
+        if cls._alias_cache is None:
+            cls._alias_cache = AliasCache(Cfg().alias_cache_file)
+        return cls._alias_cache
+
+    @staticmethod
+    def _discovered_alias(device: SmartDevice) -> Optional[str]:
         try:
-            for addr, device in cls._discovered_devices.items():
-                await device.update()
-                if device.alias == alias:
-                    return addr, device
-        except SmartDeviceException as e:
-            logger.warning(
-                f"Discovering device with alias {alias} did not go well: {e}"
-            )
+            return device.alias
+        except SmartDeviceException:
+            return None
+
+    @classmethod
+    def _located(cls, alias):
+        # a broadcast must not record the device from now on, as it would be
+        # stale by the time the device needs to be located again
+        cls._aliases.discard(alias)
+        cls._devices_by_alias.pop(alias, None)
 
-        if retry < 3:
-            cls._discovered_devices = None
-            return await cls._find_by_alias(name, alias, retry + 1)
+    @classmethod
+    async def _find_by_alias(cls, name, alias):
+        alias_cache = cls._get_alias_cache()
+        host = alias_cache.host(alias)
+        if host:
+            try:
+                device = await Discover.discover_single(host)
+                if device.alias == alias:
+                    cls._located(alias)
+                    return host, device
+                logger.info(
+                    f"Cached host {host} for {name} is now '{device.alias}',"
+                    f" not '{alias}'"
+                )
+            except SmartDeviceException as e:
+                logger.info(f"Cached host {host} for {name} is unreachable: {e}")
+            alias_cache.discard(alias)
+
+        if cls._discovery_lock is None:
+            cls._discovery_lock = asyncio.Lock()
+        async with cls._discovery_lock:
+            # another location may have broadcast while we waited for the lock
+            for _ in range(4):
+                if alias not in cls._devices_by_alias:
+                    await cls._discover_aliases()
+                if alias in cls._devices_by_alias:
+                    host_device = cls._devices_by_alias[alias]
+                    cls._located(alias)
+                    return host_device
         raise RuntimeError(f"Unable to locate {name} from alias {alias}")
 
-    @property
-    async def is_on(self) -> Optional[bool]:
-        try:
-            device = await self._get_device()
-            await device.update()
-            return device.is_on
-        except SmartDeviceException as e:
-            logger.error(f"{self.host} unable to fetch is_on: {e}")
-        # implicit return None
+    @classmethod
+    async def _discover_aliases(cls):
+        wanted = cls._aliases - set(cls._devices_by_alias)
+        logger.info(f"Broadcasting discovery to locate aliases: {sorted(wanted)}")
+        discovered = await Discover.discover()
+
+        # discovery replies normally carry the alias. Devices that do not say
+        # need an update, and those are all done concurrently
+        unnamed = {
+            addr: device
+            for addr, device in discovered.items()
+            if cls._discovered_alias(device) is None
+        }
+        if unnamed:
+            results = await asyncio.gather(
+                *[device.update() for device in unnamed.values()],
+                return_exceptions=True,
+            )
+            for addr, result in zip(unnamed, results):
+                if isinstance(result, Exception):
+                    logger.warning(f"Unable to fetch alias of {addr}: {result}")
+
+        alias_cache = cls._get_alias_cache()
+        for addr, device in discovered.items():
+            alias = cls._discovered_alias(device)
+            if alias in wanted:
+                cls._devices_by_alias[alias] = addr, device
+                alias_cache.set(alias, addr, device.mac)
+        alias_cache.save()
+
+    def _device_failed(self):
+        self.fails += 1
+        self._reconnect_at = time.monotonic() + min(
+            const.KASA_MAX_RECONNECT_BACKOFF,
+            const.KASA_RECONNECT_BACKOFF * 2 ** (self.fails - 1),
+        )
+        if self._by_alias and self.fails >= const.KASA_ALIAS_REDISCOVER_FAILS:
+            # the device may have moved to another address. Locate it again
+            logger.info(f"{self.name} will be rediscovered from alias {self.alias}")
+            self._get_alias_cache().discard(self.alias)
+            self._aliases.add(self.alias)
+            # the host was only learnt from the alias
+            self.host = None
+            self._device = None
+            self.fails = 0
+            self._update_ready()
 
     @property
-    async def is_dimmable(self) -> Optional[bool]:
+    def backing_off(self) -> bool:
+        """Whether the device is waiting out the backoff after a failure."""
+        owner = self._owner
+        return not owner.connected and time.monotonic() < owner._reconnect_at
+
+    async def _request(
+        self,
+        action: str,
+        call: Callable[[SmartDevice], Awaitable],
+        wait_backoff: bool = True,
+    ) -> bool:
+        """Make one request to the device, on the session kept open for it.
+
+        A failed request closes the session, and the next request opens a
+        new one. Until the backoff that follows a failure has passed,
+        requests that wait_backoff are not sent at all.
+        """
+        if self.strip:
+            return await self.strip._request(
+                f"{action} {self.name}",
+                lambda d: call(self._outlet_of(d)),
+                wait_backoff,
+            )
+        if wait_backoff and self.backing_off:
+            self.metrics.requests_skipped.inc()
+            return False
         try:
             device = await self._get_device()
-            await device.update()
-            return device.is_dimmable
+            if not self.connected:
+                self.connected = True
+                self.sessions += 1
+                self.metrics.sessions_opened.inc()
+            self.queries += 1
+            await call(device)
         except SmartDeviceException as e:
-            logger.error(f"{self.host} unable to fetch is_dimmable: {e}")
-        # implicit return None
+            logger.error(f"{self.host} unable to {action}: {e}")
+            self.metrics.requests_failed.inc()
+            await self._close_session()
+            self._device_failed()
+            return False
+        except RuntimeError as e:
+            # the alias was not found. Back off before broadcasting again
+            logger.error(f"{self.name} unable to {action}: {e}")
+            self.metrics.requests_failed.inc()
+            self._device_failed()
+            return False
+        self.fails = 0
+        self.served += 1
+        self.metrics.requests_served.inc()
+        return True
+
+    async def refresh(
+        self, wait_backoff: bool = True, emeter: bool = False
+    ) -> Optional[KasaState]:
+        """Query the device once and replace the current state snapshot.
+
+        A strip is queried without its outlets, and the snapshots of its
+        outlets are taken from the same reply. The emeter of each outlet
+        takes a query of its own, so it is only read when emeter is asked.
+        """
+        if self.strip:
+            if not emeter:
+                if await self.strip.refresh(wait_backoff) is None:
+                    return None
+                return self.state
+            if not await self._request("update emeter", lambda d: d.update(), wait_backoff):
+                return None
+            self.state = self._snapshot(self._outlet_of(self.strip._device), True)
+            return self.state
+
+        if not await self._request(
+            "update", lambda d: d.update(update_children=emeter), wait_backoff
+        ):
+            return None
+        device = self._device
+        self.state = self._snapshot(device, emeter or not device.children)
+        for outlet in self.outlets.values():
+            try:
+                outlet.state = self._snapshot(outlet._outlet_of(device), emeter)
+            except SmartDeviceException as e:
+                logger.error(f"{self.name} has no outlet for {outlet.name}: {e}")
+                outlet.state = None
+        return self.state
 
-    @property
-    async def brightness(self) -> Optional[int]:
+    @staticmethod
+    def _snapshot(device: SmartDevice, with_emeter: bool) -> KasaState:
+        is_dimmable = device.is_dimmable
+        has_emeter = device.has_emeter
+        return KasaState(
+            is_on=device.is_on,
+            brightness=device.brightness if is_dimmable else None,
+            is_dimmable=is_dimmable,
+            has_emeter=has_emeter,
+            emeter=(
+                EmeterReading.from_status(device.emeter_realtime)
+                if has_emeter and with_emeter
+                else None
+            ),
+        )
+
+    def poll_done(self, changed: bool):
+        if changed:
+            self.effective_poll_interval = self.poll_interval
+        else:
+            self.effective_poll_interval = min(
+                self.max_poll_interval,
+                self.effective_poll_interval * const.KASA_POLL_BACKOFF_FACTOR,
+            )
+
+    def tighten_polling(self):
+        """Poll at the base interval again, starting with the current wait."""
+        if self.strip:
+            self.strip.tighten_polling()
+            return
+        self.effective_poll_interval = self.poll_interval
+        if self.poll_job:
+            self.poll_job.reschedule(self.poll_interval)
+
+    async def start(self, timeout: float) -> Optional[KasaState]:
+        """Locate the device and take its first snapshot, within timeout seconds."""
+        if self.strip and self.state is not None:
+            # taken by a query of the strip
+            return self.state
         try:
-            device = await self._get_device()
-            await device.update()
-            return device.brightness
-        except SmartDeviceException as e:
-            logger.error(f"{self.host} unable to fetch brightness: {e}")
+            return await asyncio.wait_for(self.refresh(wait_backoff=False), timeout)
+        except asyncio.TimeoutError:
+            logger.warning(f"{self.name} did not respond within {timeout} seconds")
         # implicit return None
 
-    async def set_brightness(self, brightness):
-        async with self.throttler:
-            try:
-                device = await self._get_device()
-                await device.set_brightness(brightness)
-                self.curr_brightness = brightness
-            except SmartDeviceException as e:
-                logger.error(f"{self.host} unable to set brightness: {e}")
+    async def _get_state(self) -> Optional[KasaState]:
+        if self.state is None:
+            return await self.refresh()
+        return self.state
 
-    async def turn_on(self):
-        async with self.throttler:
-            try:
-                device = await self._get_device()
-                await device.turn_on()
-                self.curr_state = True
-            except SmartDeviceException as e:
-                logger.error(f"{self.host} unable to turn_on: {e}")
+    @property
+    async def is_on(self) -> Optional[bool]:
+        state = await self._get_state()
+        return state.is_on if state else None
 
-    async def turn_off(self):
-        async with self.throttler:
-            try:
-                device = await self._get_device()
-                await device.turn_off()
-                self.curr_state = False
-            except SmartDeviceException as e:
-                logger.error(f"{self.host} unable to turn_off: {e}")
+    @property
+    async def is_dimmable(self) -> Optional[bool]:
+        state = await self._get_state()
+        return state.is_dimmable if state else None
+
+    @property
+    async def brightness(self) -> Optional[int]:
+        state = await self._get_state()
+        return state.brightness if state else None
+
+    async def set_brightness(self, brightness) -> bool:
+        async with self._owner.throttler:
+            # commands are always sent, even while polls back off
+            if not await self._request(
+                "set brightness",
+                lambda d: d.set_brightness(brightness),
+                wait_backoff=False,
+            ):
+                return False
+            self.curr_brightness = brightness
+            self.tighten_polling()
+            return True
+
+    async def turn_on(self) -> bool:
+        async with self._owner.throttler:
+            if not await self._request(
+                "turn_on", lambda d: d.turn_on(), wait_backoff=False
+            ):
+                return False
+            self.curr_state = True
+            self.tighten_polling()
+            return True
+
+    async def turn_off(self) -> bool:
+        async with self._owner.throttler:
+            if not await self._request(
+                "turn_off", lambda d: d.turn_off(), wait_backoff=False
+            ):
+                return False
+            self.curr_state = False
+            self.tighten_polling()
+            return True
 
     @property
     async def has_emeter(self) -> Optional[bool]:
-        try:
-            device = await self._get_device()
-            await device.update()
-            return device.has_emeter
-        except SmartDeviceException as e:
-            logger.error(f"{self.host} unable to get has_emeter: {e}")
-        # implicit return None
+        state = await self._get_state()
+        return state.has_emeter if state else None
 
     @property
-    async def emeter_realtime(self) -> Optional[EmeterStatus]:
-        try:
-            device = await self._get_device()
-            await device.update()
-            return device.emeter_realtime
-        except SmartDeviceException as e:
-            logger.error(f"{self.host} unable to fetch emeter: {e}")
-        # implicit return None
+    async def emeter_realtime(self) -> Optional[EmeterReading]:
+        state = await self._get_state()
+        return state.emeter if state else None
 
     @classmethod
     def state_from_name(cls, is_on: Optional[str]) -> bool:
@@ -216,118 +600,186 @@ class Kasa:
         raise ValueError(f"cannot translate {payload}")
 
 
-async def handle_kasa_poller(kasa: Kasa, main_events_q: asyncio.Queue):
-    fails = 0
-    while True:
-        # chatty
-        # logger.debug(f"Polling {kasa.name} now. Interval is {kasa.poll_interval} seconds")
-        new_state = await kasa.is_on
-        if kasa.curr_state != new_state or fails:
-            if new_state is None:
-                fails += 1
-                logger.error(f"Polling {kasa.name} ({kasa.host}) failed {fails} times")
-            else:
-                fails = 0
-                await main_events_q.put(
-                    KasaStateEvent(
-                        name=kasa.name, state=new_state, old_state=kasa.curr_state
-                    )
-                )
-                kasa.curr_state = new_state
-
-        is_dimmable = await kasa.is_dimmable
-        if is_dimmable:
-            new_brightness = await kasa.brightness
-            if kasa.curr_brightness != new_brightness or fails:
-                if new_brightness is None:
-                    fails += 1
-                    logger.error(
-                        f"Polling {kasa.name} ({kasa.host}) failed {fails} times"
-                    )
-                else:
-                    fails = 0
-                    await main_events_q.put(
-                        KasaBrightnessEvent(name=kasa.name, brightness=new_brightness)
-                    )
-                    kasa.curr_brightness = new_brightness
-
-        await _sleep_with_jitter(kasa.poll_interval)
-
-
-async def handle_kasa_emeter_poller(kasa: Kasa, main_events_q: asyncio.Queue):
-    fails = 0
-    while True:
-        # chatty
-        # logger.debug(f"Polling {kasa.name} emeter now. Interval is {kasa.emeter_poll_interval} seconds")
-        if await kasa.has_emeter == False:
-            logger.info(f"{kasa.name} has no emeter. no emeter polling is needed")
-            break
-
-        emeter_status = await kasa.emeter_realtime
-        if emeter_status is None:
-            fails += 1
-            logger.error(
-                f"Polling {kasa.name} emeter ({kasa.host}) failed {fails} times"
+async def poll_kasa(kasa: Kasa, main_events) -> float:
+    """Poll a device, and the outlets of a strip with the same query.
+
+    main_events takes the events of every device polled, e.g. EventShards.
+    """
+    # chatty
+    # logger.debug(
+    #     f"Polling {kasa.name} now. Interval is {kasa.effective_poll_interval} seconds"
+    # )
+    if kasa.backing_off:
+        # no query is sent, so this is neither a failure nor a success
+        kasa.metrics.requests_skipped.inc()
+        return kasa.effective_poll_interval
+    queries = kasa.queries
+    started = time.monotonic()
+    state = await kasa.refresh()
+    kasa.metrics.poll_seconds.observe(time.monotonic() - started)
+    kasa.poll_queries = kasa.queries - queries
+    if state is None:
+        kasa.metrics.poll_failures.inc()
+        kasa.poll_fails += 1
+        logger.error(
+            f"Polling {kasa.name} ({kasa.host}) failed {kasa.poll_fails} times"
+        )
+        kasa.poll_done(changed=True)
+        return kasa.effective_poll_interval
+
+    recovered, kasa.poll_fails = kasa.poll_fails, 0
+    changed = await apply_polled_states(kasa, main_events, force=bool(recovered))
+    kasa.poll_done(changed)
+    return kasa.effective_poll_interval
+
+
+async def apply_polled_states(kasa: Kasa, main_events, force: bool = False) -> bool:
+    """Apply the snapshots of a device, and of the outlets of a strip.
+
+    Events are put for what changed, or for everything when forced.
+    Returns whether anything changed.
+    """
+    changed = await apply_polled_state(kasa, kasa.state, main_events, force)
+    for outlet in kasa.outlets.values():
+        if outlet.state is not None:
+            changed |= await apply_polled_state(
+                outlet, outlet.state, main_events, force
             )
-        else:
-            fails = 0
-            await main_events_q.put(
-                KasaEmeterEvent(name=kasa.name, emeter_status=str(emeter_status))
+    return changed
+
+
+async def apply_polled_state(
+    kasa: Kasa, state: KasaState, main_events, force: bool
+) -> bool:
+    changed = kasa.curr_state != state.is_on or (
+        state.is_dimmable and kasa.curr_brightness != state.brightness
+    )
+    if kasa.curr_state != state.is_on or force:
+        await main_events.put(
+            KasaStateEvent(name=kasa.name, state=state.is_on, old_state=kasa.curr_state)
+        )
+        kasa.curr_state = state.is_on
+
+    if state.is_dimmable:
+        if kasa.curr_brightness != state.brightness or force:
+            await main_events.put(
+                KasaBrightnessEvent(name=kasa.name, brightness=state.brightness)
             )
-        await _sleep_with_jitter(kasa.emeter_poll_interval)
+            kasa.curr_brightness = state.brightness
+    return changed
+
+
+async def poll_kasa_emeter(
+    kasa: Kasa, main_events_q: asyncio.Queue
+) -> Optional[float]:
+    # chatty
+    # logger.debug(
+    #     f"Polling {kasa.name} emeter now. Interval is {kasa.emeter_poll_interval} seconds"
+    # )
+    if kasa.backing_off:
+        kasa.metrics.requests_skipped.inc()
+        return kasa.emeter_poll_interval
+    started = time.monotonic()
+    state = await kasa.refresh(emeter=True)
+    kasa.metrics.emeter_poll_seconds.observe(time.monotonic() - started)
+    if state and not state.has_emeter:
+        logger.info(f"{kasa.name} has no emeter. no emeter polling is needed")
+        return None
+
+    if state is None or state.emeter is None:
+        kasa.metrics.emeter_poll_failures.inc()
+        kasa.emeter_poll_fails += 1
+        logger.error(
+            f"Polling {kasa.name} emeter ({kasa.host}) failed"
+            f" {kasa.emeter_poll_fails} times"
+        )
+    else:
+        kasa.emeter_poll_fails = 0
+        await main_events_q.put(
+            KasaEmeterEvent(name=kasa.name, emeter=state.emeter)
+        )
+    return kasa.emeter_poll_interval
 
 
-async def _sleep_with_jitter(interval):
-    await asyncio.sleep(interval)
+async def confirm_write(kasa: Kasa, main_events):
+    """Read the device back right after a write, and publish what it reports.
 
-    # In order to avoid all processes sleeping and waking up at the same time,
-    # add a little jitter. Pick a value between 0 and 1.2 seconds
-    jitter = random.randint(99, 1201)
-    jitterSleep = float(jitter) / 1000
-    await asyncio.sleep(jitterSleep)
+    The state is published even when it is what was asked for, so the
+    confirmation does not have to wait for the next poll.
+    """
+    owner = kasa.strip or kasa
+    if await owner.refresh(wait_backoff=False) is None:
+        return
+    if kasa.state is not None:
+        await apply_polled_state(kasa, kasa.state, main_events, force=True)
+    # a write to an outlet may change its strip, and the other way around
+    await apply_polled_states(owner, main_events)
 
 
-async def handle_kasa_requests(kasa: Kasa):
+async def handle_kasa_requests(kasa: Kasa, main_events):
     handlers = {
-        "KasaStateEvent": handle_kasa_request_state,
-        "KasaBrightnessEvent": handle_kasa_request_brightness,
+        KasaStateEvent: handle_kasa_request_state,
+        KasaBrightnessEvent: handle_kasa_request_brightness,
     }
+    # trailing debounce: a brightness is held until it stops changing for
+    # brightness_debounce seconds. Other commands are handled meanwhile
+    held, held_until = None, 0.0
 
     while True:
         if not kasa.started:
-            logger.debug(f"{kasa.name} waiting to get started by poller")
-            await asyncio.sleep(3)
+            logger.debug(f"{kasa.name} waiting to get started")
+            await kasa.ready.wait()
             continue
 
-        kasa_event = await kasa.recv_q.get()
+        try:
+            timeout = max(0.0, held_until - time.monotonic()) if held else None
+            kasa_event = await asyncio.wait_for(kasa.recv_q.get(), timeout)
+        except asyncio.TimeoutError:
+            kasa_event, held = held, None
+        else:
+            if isinstance(kasa_event, KasaBrightnessEvent):
+                if held:
+                    # superseded
+                    event_done(held)
+                    kasa.recv_q.task_done()
+                    held = None
+                if kasa.brightness_debounce:
+                    held = kasa_event
+                    held_until = time.monotonic() + kasa.brightness_debounce
+                    continue
+
         logger.debug(f"Handling {kasa_event.event}...")
-        handler = handlers.get(kasa_event.event)
+        handler = handlers.get(type(kasa_event))
         if handler:
-            await handler(kasa, kasa_event)
+            started = instrumentation.start()
+            written = await handler(kasa, kasa_event)
+            instrumentation.handler_done(handler, started)
+            if written:
+                await confirm_write(kasa, main_events)
         else:
             logger.error(f"No handler found for {kasa_event.event}")
 
+        event_done(kasa_event)
         kasa.recv_q.task_done()
 
 
-async def handle_kasa_request_state(kasa: Kasa, event: KasaStateEvent):
+async def handle_kasa_request_state(kasa: Kasa, event: KasaStateEvent) -> bool:
     wanted_state = event.state
     if wanted_state != kasa.curr_state:
         logger.info(f"{kasa.name} changing state to {kasa.state_name(wanted_state)}")
         if wanted_state:
-            await kasa.turn_on()
-        else:
-            await kasa.turn_off()
-    else:
-        logger.debug(f"{kasa.name} state unchanged as {kasa.state_name(wanted_state)}")
+            return await kasa.turn_on()
+        return await kasa.turn_off()
+    logger.debug(f"{kasa.name} state unchanged as {kasa.state_name(wanted_state)}")
+    return False
 
 
-async def handle_kasa_request_brightness(kasa: Kasa, event: KasaBrightnessEvent):
+async def handle_kasa_request_brightness(
+    kasa: Kasa, event: KasaBrightnessEvent
+) -> bool:
     wanted_brightness = event.brightness
     if wanted_brightness != kasa.curr_brightness:
         logger.info(f"{kasa.name} changing brightness to {wanted_brightness}")
-
-        await kasa.set_brightness(wanted_brightness)
-
-    else:
-        logger.debug(f"{kasa.name} brightness unchanged as {wanted_brightness}")
+        return await kasa.set_brightness(wanted_brightness)
+    logger.debug(f"{kasa.name} brightness unchanged as {wanted_brightness}")
+    return False
@@ -1,58 +1,189 @@
 #!/usr/bin/env python
 import asyncio
-from collections import namedtuple
-from datetime import datetime
-from typing import Dict
+import heapq
+import itertools
+import time
+from typing import Dict, Optional
 
 from mqtt2kasa import log
 from mqtt2kasa.config import Cfg
-from mqtt2kasa.events import MqttMsgEvent, KasaStateEvent
+from mqtt2kasa.events import MqttMsgEvent, KasaStateEvent, PRIORITY_KEEP_ALIVE
 from mqtt2kasa.kasa_wrapper import Kasa
 
 logger = log.getLogger()
 
 
 class KeepAlive:
-    def __init__(self, **attrs):
-        self.attrs = self._dict_to_attrs(attrs)
-        self._check_expected_attrs()
-        self.keep_alives_counter = 0
-        self.last_send_ts = datetime.now()
-        self.last_receive_ts = datetime.now()
-        self.last_receive_value = None
+    EXPECTED_ATTRS = (
+        ("location_name", str),
+        ("interval", int),
+        ("timeout", int),
+        ("publish_topic", str),
+        ("subscribe_topic", str),
+    )
+    __slots__ = tuple(attr for attr, _ in EXPECTED_ATTRS) + (
+        "keep_alives_counter",
+        "last_send_ts",
+        "last_receive_ts",
+        "last_receive_value",
+        "due",
+        "engine",
+    )
 
-    def __getattr__(self, attr):
-        try:
-            return getattr(self.attrs, attr)
-        except AttributeError as e:
-            raise AttributeError(f"KeepAlive object is missing {attr} attribute") from e
-
-    def _check_expected_attrs(self):
-        expected_attrs = [
-            ("location_name", str),
-            ("interval", int),
-            ("timeout", int),
-            ("publish_topic", str),
-            ("subscribe_topic", str),
-        ]
-        for attr, attr_type in expected_attrs:
-            val = getattr(self, attr)
+    def __init__(self, **attrs):
+        for attr, attr_type in self.EXPECTED_ATTRS:
+            if attr not in attrs:
+                raise AttributeError(f"KeepAlive object is missing {attr} attribute")
+            val = attrs[attr]
             if not isinstance(val, attr_type):
                 raise AttributeError(f"{attr} attribute is not type {attr_type}")
-
-    @staticmethod
-    def _dict_to_attrs(params_dict):
-        cls = namedtuple("Attrs", params_dict)
-        cls.__new__.__defaults__ = tuple(params_dict.values())
-        return cls()
+            setattr(self, attr, val)
+        self.keep_alives_counter = 0
+        self.last_send_ts = time.monotonic()
+        self.last_receive_ts = self.last_send_ts
+        self.last_receive_value = None
+        self.due: Optional[float] = None  # None while the device is not on
+        self.engine: Optional["KeepAliveEngine"] = None
+
+
+class KeepAliveEngine:
+    """Sends keep alives and expires them, for devices that are on.
+
+    The next deadline of every keep alive, either to send a ping or to give
+    up waiting for an answer, is kept in a heap on the monotonic clock. The
+    engine sleeps until the earliest one, so nothing runs while nothing is due.
+    """
+
+    def __init__(self):
+        self.keep_alives: Dict[str, KeepAlive] = {}
+        self.kasas: Dict[str, Kasa] = {}
+        self.task_interval = Cfg().keep_alive_task_interval
+        self._heap = []
+        self._seq = itertools.count()
+        self._head_changed = asyncio.Event()
+
+    def add(self, ka: KeepAlive, kasa: Kasa):
+        ka.engine = self
+        self.keep_alives[ka.location_name] = ka
+        self.kasas[ka.location_name] = kasa
+        kasa.on_state_change = self.state_changed
+        if kasa.curr_state:
+            self.reschedule(ka)
+
+    def remove(self, ka: KeepAlive):
+        name = ka.location_name
+        del self.keep_alives[name]
+        kasa = self.kasas.pop(name)
+        if kasa.on_state_change == self.state_changed:
+            kasa.on_state_change = None
+        # its heap entry is skipped once it is popped
+        ka.due = None
+        ka.engine = None
+
+    def send_interval(self, ka: KeepAlive) -> float:
+        return max(self.task_interval * 2, ka.interval)
+
+    def next_due(self, ka: KeepAlive) -> float:
+        due = ka.last_send_ts + self.send_interval(ka)
+        if ka.keep_alives_counter:
+            due = min(due, ka.last_receive_ts + ka.timeout)
+        return due
+
+    def reschedule(self, ka: KeepAlive):
+        self._push(ka, max(time.monotonic(), self.next_due(ka)))
+
+    def state_changed(self, kasa: Kasa):
+        ka = self.keep_alives.get(kasa.name)
+        if not ka:
+            return
+        if kasa.curr_state:
+            self.reschedule(ka)
+            return
+        # if device is not on, we are not interested in it. Its heap
+        # entry is skipped once it is popped
+        ka.keep_alives_counter = 0
+        ka.due = None
+
+    def _push(self, ka: KeepAlive, due: float):
+        ka.due = due
+        heapq.heappush(self._heap, (due, next(self._seq), ka))
+        if self._heap[0][2] is ka:
+            self._head_changed.set()
+
+    async def run(self, mqtt_send_q: asyncio.Queue):
+        if not self.keep_alives:
+            # a config reload may add some
+            logger.info("No keep alives to monitor based on config")
+
+        while True:
+            now = time.monotonic()
+            while self._heap and self._heap[0][0] <= now:
+                due, _, ka = heapq.heappop(self._heap)
+                if ka.due != due:
+                    # rescheduled or parked since this entry was pushed
+                    continue
+                ka.due = None
+                await self._fire(ka, mqtt_send_q)
+
+            timeout = self._heap[0][0] - time.monotonic() if self._heap else None
+            self._head_changed.clear()
+            try:
+                await asyncio.wait_for(self._head_changed.wait(), timeout)
+            except asyncio.TimeoutError:
+                pass
+
+    async def _fire(self, ka: KeepAlive, mqtt_send_q: asyncio.Queue):
+        name = ka.location_name
+        kasa = self.kasas[name]
+        if not kasa.curr_state:
+            ka.keep_alives_counter = 0
+            return
+
+        now = time.monotonic()
+        # see if it is time to poke keep alive watchdog topic
+        send_due = ka.last_send_ts + self.send_interval(ka)
+        if now >= send_due:
+            if ka.publish_topic:
+                await mqtt_send_q.put(
+                    MqttMsgEvent(
+                        topic=ka.publish_topic,
+                        payload=ka.last_receive_value,
+                        priority=PRIORITY_KEEP_ALIVE,
+                    )
+                )
+            ka.last_send_ts = time.monotonic()
+            # reset last_receive_ts on the first ka send after activation
+            if not ka.keep_alives_counter:
+                ka.last_receive_ts = ka.last_send_ts
+            ka.keep_alives_counter += 1
+            self.reschedule(ka)
+            return
+
+        # see if it has been too long w/out an answer
+        if now >= ka.last_receive_ts + ka.timeout and ka.keep_alives_counter:
+            elapsed = now - ka.last_receive_ts
+            logger.info(f"Keep alive for {name} expired after {elapsed:.1f} seconds")
+            kasa.recv_q.put_nowait(KasaStateEvent(name=name, state=False))
+            await mqtt_send_q.put(
+                MqttMsgEvent(topic=kasa.topic, payload=kasa.state_name(False))
+            )
+            # the device is parked once it is off. Until then, keep trying
+            self._push(ka, min(send_due, time.monotonic() + self.task_interval))
+            return
+
+        self.reschedule(ka)
 
 
 async def handle_main_event_mqtt_ka(
     mqtt_msg: MqttMsgEvent, kasa: Kasa, ka: KeepAlive, mqtt_send_q: asyncio.Queue
 ):
-    ka.last_receive_ts = datetime.now()
+    ka.last_receive_ts = time.monotonic()
     if mqtt_msg.payload:
         ka.last_receive_value = mqtt_msg.payload
+    kasa.tighten_polling()
+    if ka.engine and ka.due is not None:
+        # the answer pushes the timeout back
+        ka.engine.reschedule(ka)
 
     if kasa.curr_state:
         logger.debug(f"Received keep alive from {ka.location_name}")
@@ -61,69 +192,5 @@ async def handle_main_event_mqtt_ka(
     logger.info(
         f"Received keep alive for {ka.location_name} triggering device to be turned on"
     )
-    try:
-        kasa.recv_q.put_nowait(KasaStateEvent(name=ka.location_name, state=True))
-        await mqtt_send_q.put(
-            MqttMsgEvent(topic=kasa.topic, payload=kasa.state_name(True))
-        )
-    except asyncio.queues.QueueFull:
-        logger.warning(
-            f"Device {ka.location_name} is too busy to take request to be set as "
-            f"{kasa.state_name(True)}"
-        )
-
-
-async def handle_keep_alives(
-    kasas: Dict[str, Kasa], kas: Dict[str, KeepAlive], mqtt_send_q: asyncio.Queue
-):
-    if not kas:
-        logger.info(
-            "No keep alives to monitor based on config: handle_keep_alives is done."
-        )
-        return
-
-    ka_task_interval = Cfg().keep_alive_task_interval
-    while True:
-        await asyncio.sleep(ka_task_interval)
-
-        for name, ka in kas.items():
-            kasa = kasas[name]
-            if not kasa.curr_state:
-                # if device is not on, we are not interested in it
-                ka.keep_alives_counter = 0
-                continue
-
-            now = datetime.now()
-            # see if it is time to poke keep alive watchdog topic
-            tdelta = now - ka.last_send_ts
-            tdeltaSecs = int(tdelta.total_seconds())
-            interval = max(ka_task_interval * 2, ka.interval)
-            if tdeltaSecs >= interval:
-                if ka.publish_topic:
-                    await mqtt_send_q.put(
-                        MqttMsgEvent(
-                            topic=ka.publish_topic, payload=ka.last_receive_value
-                        )
-                    )
-                ka.last_send_ts = datetime.now()
-                # reset last_send_ts on the first ka send after activation
-                if not ka.keep_alives_counter:
-                    ka.last_receive_ts = ka.last_send_ts
-                ka.keep_alives_counter += 1
-                continue
-
-            # see if it has been too long w/out an answer
-            tdelta = now - ka.last_receive_ts
-            tdeltaSecs = int(tdelta.total_seconds())
-            if tdeltaSecs >= ka.timeout and ka.keep_alives_counter:
-                logger.info(f"Keep alive for {name} expired after {tdeltaSecs} seconds")
-                try:
-                    kasa.recv_q.put_nowait(KasaStateEvent(name=name, state=False))
-                    await mqtt_send_q.put(
-                        MqttMsgEvent(topic=kasa.topic, payload=kasa.state_name(False))
-                    )
-                except asyncio.queues.QueueFull:
-                    logger.warning(
-                        f"Device {name} is too busy to take request to be set as "
-                        f"{kasa.state_name(False)}"
-                    )
+    kasa.recv_q.put_nowait(KasaStateEvent(name=ka.location_name, state=True))
+    await mqtt_send_q.put(MqttMsgEvent(topic=kasa.topic, payload=kasa.state_name(True)))
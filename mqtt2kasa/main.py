@@ -1,35 +1,56 @@
 #!/usr/bin/env python
 import asyncio
-import collections
 from contextlib import AsyncExitStack
-import re
+import functools
 import json
+import signal
+import sys
+import time
 from typing import Dict, Optional
+import yaml
 from aiomqtt import Client, MqttError
 from datetime import datetime, timezone
+from mqtt2kasa import const
 from mqtt2kasa import log
-from mqtt2kasa.config import Cfg
+from mqtt2kasa import metrics
+from mqtt2kasa.config import Cfg, ConfigError, Group, Location
 from mqtt2kasa.events import (
     KasaStateEvent,
     KasaBrightnessEvent,
     KasaEmeterEvent,
     MqttMsgEvent,
+    PRIORITY_TELEMETRY,
 )
+from mqtt2kasa.groups import fan_out, group_command, group_status
+from mqtt2kasa.instrumentation import instrumentation
 from mqtt2kasa.kasa_wrapper import (
     Kasa,
-    handle_kasa_poller,
-    handle_kasa_emeter_poller,
+    apply_polled_states,
+    poll_kasa,
+    poll_kasa_emeter,
     handle_kasa_requests,
 )
 from mqtt2kasa.keep_alive import (
     KeepAlive,
-    handle_keep_alives,
+    KeepAliveEngine,
     handle_main_event_mqtt_ka,
 )
 from mqtt2kasa.mqtt import (
+    PublishQueue,
     handle_mqtt_publish,
     handle_mqtt_messages,
 )
+from mqtt2kasa.scheduler import PollJob, PollScheduler
+from mqtt2kasa.shards import EventShards
+from mqtt2kasa.router import (
+    ACTION_BRIGHTNESS,
+    ACTION_GROUP,
+    ACTION_INSTRUMENTATION,
+    ACTION_KEEP_ALIVE,
+    ACTION_STATE,
+    TopicRouter,
+    topic_matches,
+)
 
 BRIGHTNESS_TOPIC_SUFFIX = "/brightness"
 
@@ -37,9 +58,69 @@ BRIGHTNESS_TOPIC_SUFFIX = "/brightness"
 class RunState:
     def __init__(self):
         self.kasas: dict[str, Kasa] = {}
-        self.topics: dict[str, str] = {}
+        self.router = TopicRouter()
+        self.scheduler = PollScheduler(Cfg().max_concurrent_polls)
+        self.main_events = EventShards(self.router, const.EVENTS_QUEUE_SIZE)
         self.keep_alives: dict[str, KeepAlive] = {}
-        self.keep_alive_topics: dict[str, str] = {}
+        self.groups: dict[str, Group] = {}
+        self.keep_alive_engine = KeepAliveEngine()
+        self.client: Optional[Client] = None
+        self.subscriptions: set[str] = set()
+        self.init_sem = asyncio.Semaphore(Cfg().init_concurrency)
+        # tasks that go away with their device
+        self.device_tasks: dict[str, list[asyncio.Task]] = {}
+
+    async def subscribe(self, topic: str):
+        """Subscribe to topic, unless a filter of this session already covers it."""
+        if not self.client:
+            # not connected. The subscription happens on connect
+            return
+        if any(topic_matches(f, topic) for f in self.subscriptions):
+            return
+        try:
+            await self.client.subscribe(topic)
+        except MqttError as error:
+            # the topic is routed, so the next mqtt session subscribes to it
+            logger.warning(f'Unable to subscribe to {topic}: MQTT error "{error}"')
+            return
+        self.subscriptions.add(topic)
+
+    async def sync_subscriptions(self):
+        """Subscribe to what the routes need now and drop what they no longer do."""
+        if not self.client:
+            return
+        needed = set(
+            self.router.subscriptions(wildcards=Cfg().mqtt_wildcard_subscriptions)
+        )
+        try:
+            # subscribe first, so no message is missed while filters are swapped
+            for topic_filter in sorted(needed - self.subscriptions):
+                await self.client.subscribe(topic_filter)
+                self.subscriptions.add(topic_filter)
+            for topic_filter in sorted(self.subscriptions - needed):
+                await self.client.unsubscribe(topic_filter)
+                self.subscriptions.discard(topic_filter)
+        except MqttError as error:
+            # the next mqtt session subscribes to what the routes need
+            logger.warning(f'Unable to update subscriptions: MQTT error "{error}"')
+
+    def start_device_task(self, name: str, coro) -> asyncio.Task:
+        task = asyncio.create_task(coro)
+        task.add_done_callback(log_task_failure)
+        self.device_tasks.setdefault(name, []).append(task)
+        return task
+
+    async def cancel_device_tasks(self, name: Optional[str] = None):
+        names = [name] if name is not None else list(self.device_tasks)
+        tasks = [task for n in names for task in self.device_tasks.pop(n, [])]
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+
+
+def log_task_failure(task: asyncio.Task):
+    if not task.cancelled() and task.exception():
+        logger.error(f"Task {task.get_name()} failed", exc_info=task.exception())
 
 
 def create_timestamp_dict(data: Optional[Dict] = None) -> Dict:
@@ -105,26 +186,52 @@ async def handle_emeter_event_kasa(
             f"Unable to find device with name {kasa_emeter.name}. Ignoring kasa emeter event"
         )
         return
+    reading = kasa_emeter.emeter
+    if kasa.emeter_windows:
+        for label, aggregate in kasa.emeter_windows.add(time.time(), reading):
+            await mqtt_send_q.put(
+                MqttMsgEvent(
+                    topic=f"{kasa.topic}/emeter/agg/{label}",
+                    payload=json.dumps(aggregate),
+                    priority=PRIORITY_TELEMETRY,
+                )
+            )
+    changed_fields = kasa.emeter_filter.changed_fields(reading)
+    if not changed_fields:
+        logger.debug(f"Kasa emeter event for {kasa_emeter.name} is within deadband")
+        return
+
     emeter_topic = f"{kasa.topic}/emeter"
-    status_payload = kasa_emeter.emeter_status
     await mqtt_send_q.put(
-        MqttMsgEvent(topic=f"{emeter_topic}/status", payload=status_payload)
+        MqttMsgEvent(
+            topic=f"{emeter_topic}/status",
+            payload=str(reading),
+            priority=PRIORITY_TELEMETRY,
+        )
     )
 
     # also publish each value as a topic
     # https://github.com/flavio-fernandes/mqtt2kasa/issues/10
-    matches = re.findall(r"(\w+)=([^\s>]+)", status_payload)
+    # the values are published as strings, as they always have been
     emeter_payload_dict = create_timestamp_dict()
-    for key, value in matches:
+    emeter_payload_dict.update(
+        (key, str(value)) for key, value in reading._asdict().items()
+    )
+    for key in changed_fields:
         iter_emeter_topic = f"{emeter_topic}/{key}"
-        emeter_payload_dict[key] = value
-        await mqtt_send_q.put(MqttMsgEvent(topic=iter_emeter_topic, payload=value))
+        value = emeter_payload_dict[key]
+        await mqtt_send_q.put(
+            MqttMsgEvent(
+                topic=iter_emeter_topic, payload=value, priority=PRIORITY_TELEMETRY
+            )
+        )
 
     # https://github.com/flavio-fernandes/mqtt2kasa/issues/14
     await mqtt_send_q.put(
         MqttMsgEvent(
             topic=f"{emeter_topic}/timestamp",
             payload=emeter_payload_dict.get("timestamp"),
+            priority=PRIORITY_TELEMETRY,
         )
     )
 
@@ -133,110 +240,256 @@ async def handle_emeter_event_kasa(
         f"Kasa emeter event requesting mqtt for {kasa_emeter.name} to publish"
         f" {emeter_topic} as {emeter_json_payload}"
     )
-    await mqtt_send_q.put(MqttMsgEvent(topic=emeter_topic, payload=emeter_json_payload))
+    await mqtt_send_q.put(
+        MqttMsgEvent(
+            topic=emeter_topic,
+            payload=emeter_json_payload,
+            priority=PRIORITY_TELEMETRY,
+        )
+    )
 
 
-async def handle_main_event_mqtt(
-    mqtt_msg: MqttMsgEvent, run_state: RunState, mqtt_send_q: asyncio.Queue
+async def handle_mqtt_keep_alive(
+    mqtt_msg: MqttMsgEvent, kasa: Kasa, run_state: RunState, mqtt_send_q: asyncio.Queue
 ):
-    name = run_state.topics.get(mqtt_msg.topic)
-    is_ka = name is None
-    if not name:
-        # topic is not used directly for a kasa device. Check if it is a keep alive subscribe
-        name = run_state.keep_alive_topics.get(mqtt_msg.topic)
-        if not name:
-            logger.warning(
-                f"Unable to map device from topic {mqtt_msg.topic}. Ignoring mqtt event"
-            )
+    ka = run_state.keep_alives[kasa.name]
+    await handle_main_event_mqtt_ka(mqtt_msg, kasa, ka, mqtt_send_q)
+
+
+async def handle_mqtt_state(
+    mqtt_msg: MqttMsgEvent, kasa: Kasa, run_state: RunState, mqtt_send_q: asyncio.Queue
+):
+    name = kasa.name
+    try:
+        translated, new_state = kasa.state_parse(mqtt_msg.payload)
+        if translated:
+            await mqtt_send_q.put(MqttMsgEvent(topic=mqtt_msg.topic, payload=translated))
             return
-    kasa = run_state.kasas[name]
-    if is_ka:
-        ka = run_state.keep_alives[name]
-        await handle_main_event_mqtt_ka(mqtt_msg, kasa, ka, mqtt_send_q)
+    except ValueError as e:
+        logger.warning(f"Unexpected payload for topic {mqtt_msg.topic}: {e}")
         return
-    if not mqtt_msg.payload:
-        logger.debug(f"No payload for topic {mqtt_msg.topic}. Ignoring mqtt event")
+
+    # a newer request replaces an older one that was not applied yet
+    kasa.recv_q.put_nowait(KasaStateEvent(name=name, state=new_state))
+    msg = f"Mqtt event causing device {name} to be set as {kasa.state_name(new_state)}"
+    if kasa.state_name(new_state) != mqtt_msg.payload:
+        msg += f" ({mqtt_msg.payload})"
+    logger.info(msg)
+
+    # https://github.com/flavio-fernandes/mqtt2kasa/issues/14
+    status_json_topic = f"{kasa.topic}/status"
+    status_payload = create_timestamp_dict(
+        {"name": name, "state": kasa.state_name(new_state)}
+    )
+    await mqtt_send_q.put(
+        MqttMsgEvent(topic=status_json_topic, payload=json.dumps(status_payload))
+    )
+
+
+async def handle_mqtt_brightness(
+    mqtt_msg: MqttMsgEvent, kasa: Kasa, run_state: RunState, mqtt_send_q: asyncio.Queue
+):
+    name = kasa.name
+    try:
+        new_brightness = int(mqtt_msg.payload)
+    except ValueError as e:
+        # TODO AD add test
+        logger.warning(f"Unexpected payload for topic {mqtt_msg.topic}: {e}")
         return
 
-    if mqtt_msg.topic == kasa.topic:
-        try:
-            translated, new_state = kasa.state_parse(mqtt_msg.payload)
-            if translated:
-                await mqtt_send_q.put(
-                    MqttMsgEvent(topic=mqtt_msg.topic, payload=translated)
-                )
-                return
-        except ValueError as e:
-            logger.warning(f"Unexpected payload for topic {mqtt_msg.topic}: {e}")
-            return
+    kasa.recv_q.put_nowait(KasaBrightnessEvent(name=name, brightness=new_brightness))
+    logger.info(
+        f"Mqtt event causing device {name}({mqtt_msg.topic}) to be set as {new_brightness}"
+    )
 
-        try:
-            kasa.recv_q.put_nowait(KasaStateEvent(name=name, state=new_state))
-        except asyncio.queues.QueueFull:
-            logger.warning(
-                f"Device {name} is too busy to take request to be set as "
-                f"{kasa.state_name(new_state)}"
-            )
-            return
-        msg = f"Mqtt event causing device {name} to be set as {kasa.state_name(new_state)}"
-        if kasa.state_name(new_state) != mqtt_msg.payload:
-            msg += f" ({mqtt_msg.payload})"
-        logger.info(msg)
-
-        # https://github.com/flavio-fernandes/mqtt2kasa/issues/14
-        status_json_topic = f"{kasa.topic}/status"
-        status_payload = create_timestamp_dict(
-            {"name": name, "state": kasa.state_name(new_state)}
-        )
-        await mqtt_send_q.put(
-            MqttMsgEvent(topic=status_json_topic, payload=json.dumps(status_payload))
+
+async def handle_mqtt_instrumentation(
+    mqtt_msg: MqttMsgEvent, run_state: RunState, mqtt_send_q: asyncio.Queue
+):
+    logger.info(f"Instrumentation dump requested via {mqtt_msg.topic}")
+    report = instrumentation.dump()
+    await mqtt_send_q.put(
+        MqttMsgEvent(topic=f"{mqtt_msg.topic}/report", payload=json.dumps(report))
+    )
+
+
+async def handle_mqtt_group(
+    mqtt_msg: MqttMsgEvent, group: Group, run_state: RunState, mqtt_send_q: asyncio.Queue
+):
+    kasas = [run_state.kasas[name] for name in group.members]
+    new_state = group_command(kasas, mqtt_msg.payload)
+    if new_state is None:
+        logger.warning(
+            f"Unexpected payload for topic {mqtt_msg.topic}: cannot translate"
+            f" {mqtt_msg.payload}"
         )
         return
+    logger.info(
+        f"Mqtt event causing group {group.name} to be set as"
+        f" {Kasa.state_name(new_state)} ({mqtt_msg.payload})"
+    )
+    # the members publish the state they confirm, like for any other command
+    handled = await fan_out(
+        kasas, new_state, Cfg().group_concurrency, const.KASA_GROUP_APPLY_TIMEOUT
+    )
+    if len(handled) < len(kasas):
+        logger.warning(
+            f"Group {group.name} members not set as {Kasa.state_name(new_state)}:"
+            f" {[kasa.name for kasa in kasas if kasa not in handled]}"
+        )
+    status_payload = create_timestamp_dict(group_status(group.name, kasas))
+    await mqtt_send_q.put(
+        MqttMsgEvent(topic=f"{group.topic}/status", payload=json.dumps(status_payload))
+    )
 
-    if mqtt_msg.topic.endswith(BRIGHTNESS_TOPIC_SUFFIX):
-        try:
-            new_brightness = int(mqtt_msg.payload)
-        except ValueError as e:
-            # TODO AD add test
-            logger.warning(f"Unexpected payload for topic {mqtt_msg.topic}: {e}")
-            return
 
-        try:
-            kasa.recv_q.put_nowait(
-                KasaBrightnessEvent(name=name, brightness=new_brightness)
-            )
-        except asyncio.queues.QueueFull:
-            logger.warning(
-                f"Device {name} is too busy to take request to set '{mqtt_msg.topic}' as "
-                f"{new_brightness}"
-            )
-            return
-        logger.info(
-            f"Mqtt event causing device {name}({mqtt_msg.topic}) to be set as {new_brightness}"
+MQTT_ACTION_HANDLERS = {
+    ACTION_KEEP_ALIVE: handle_mqtt_keep_alive,
+    ACTION_STATE: handle_mqtt_state,
+    ACTION_BRIGHTNESS: handle_mqtt_brightness,
+}
+
+
+async def handle_main_event_mqtt(
+    mqtt_msg: MqttMsgEvent, run_state: RunState, mqtt_send_q: PublishQueue
+):
+    # the topic may have been changed by someone else since we published it
+    mqtt_send_q.observe(mqtt_msg.topic, mqtt_msg.payload)
+    route = run_state.router.match(mqtt_msg.topic)
+    metrics.count_received(route.action if route else "unmapped")
+    if not route:
+        # wildcard subscriptions may bring in topics that are not ours
+        logger.debug(
+            f"Unable to map device from topic {mqtt_msg.topic}. Ignoring mqtt event"
         )
         return
+    if route.action == ACTION_INSTRUMENTATION:
+        await handle_mqtt_instrumentation(mqtt_msg, run_state, mqtt_send_q)
+        return
+    if not mqtt_msg.payload and route.action != ACTION_KEEP_ALIVE:
+        logger.debug(f"No payload for topic {mqtt_msg.topic}. Ignoring mqtt event")
+        return
+    if route.action == ACTION_GROUP:
+        group = run_state.groups[route.name]
+        started = instrumentation.start()
+        await handle_mqtt_group(mqtt_msg, group, run_state, mqtt_send_q)
+        instrumentation.handler_done(handle_mqtt_group, started)
+        return
+    kasa = run_state.kasas[route.name]
+    handler = MQTT_ACTION_HANDLERS[route.action]
+    started = instrumentation.start()
+    await handler(mqtt_msg, kasa, run_state, mqtt_send_q)
+    instrumentation.handler_done(handler, started)
 
 
 async def handle_main_events(
     run_state: RunState, mqtt_send_q: asyncio.Queue, main_events_q: asyncio.Queue
 ):
     handlers = {
-        "KasaStateEvent": handle_main_event_kasa,
-        "KasaBrightnessEvent": handle_brightness_event_kasa,
-        "KasaEmeterEvent": handle_emeter_event_kasa,
-        "MqttMsgEvent": handle_main_event_mqtt,
+        KasaStateEvent: handle_main_event_kasa,
+        KasaBrightnessEvent: handle_brightness_event_kasa,
+        KasaEmeterEvent: handle_emeter_event_kasa,
+        MqttMsgEvent: handle_main_event_mqtt,
     }
     while True:
         main_event = await main_events_q.get()
         logger.debug(f"Handling {main_event.event}...")
-        handler = handlers.get(main_event.event)
+        handler = handlers.get(type(main_event))
         if handler:
+            started = instrumentation.start()
             await handler(main_event, run_state, mqtt_send_q)
+            instrumentation.handler_done(handler, started)
         else:
             logger.error(f"No handler found for {main_event.event}")
         main_events_q.task_done()
 
 
+async def init_kasa(kasa: Kasa, run_state: RunState) -> bool:
+    async with run_state.init_sem:
+        state = await kasa.start(Cfg().init_timeout)
+    if state is None:
+        return False
+    if state.is_dimmable:
+        brightness_topic = f"{kasa.topic}{BRIGHTNESS_TOPIC_SUFFIX}"
+        if brightness_topic not in run_state.router:
+            run_state.router.add(brightness_topic, kasa.name, ACTION_BRIGHTNESS)
+            await run_state.subscribe(brightness_topic)
+    # the first snapshot makes the device ready, without waiting for a poll
+    await apply_polled_states(kasa, run_state.main_events)
+    return True
+
+
+def schedule_polls(run_state: RunState, kasa: Kasa, poll_phase: float = 0.0):
+    kasa.polling = True
+    # outlets are polled by the polls of their strip
+    if not kasa.strip:
+        kasa.poll_job = PollJob(
+            kasa.name,
+            functools.partial(poll_kasa, kasa, run_state.main_events),
+            kasa.poll_interval,
+        )
+        run_state.scheduler.add(kasa.poll_job, poll_phase)
+    schedule_emeter_polls(run_state, kasa, poll_phase)
+
+
+def schedule_emeter_polls(run_state: RunState, kasa: Kasa, poll_phase: float = 0.0):
+    """Start or stop polling the emeter of a device, as its config says."""
+    if kasa.emeter_poll_interval and not kasa.emeter_job:
+        main_events_q = run_state.main_events.queue(kasa.name)
+        kasa.emeter_job = PollJob(
+            f"{kasa.name} emeter",
+            functools.partial(poll_kasa_emeter, kasa, main_events_q),
+            kasa.emeter_poll_interval,
+        )
+        run_state.scheduler.add(kasa.emeter_job, poll_phase)
+    elif not kasa.emeter_poll_interval and kasa.emeter_job:
+        run_state.scheduler.remove(kasa.emeter_job)
+        kasa.emeter_job = None
+
+
+async def handle_kasa_device(
+    kasa: Kasa,
+    initialized: bool,
+    run_state: RunState,
+    started_ts: float,
+    poll_phase: float,
+):
+    retry_interval = Cfg().init_retry_interval
+    while not initialized:
+        logger.info(
+            f"Device {kasa.name} is pending. Retrying in {retry_interval} seconds"
+        )
+        await asyncio.sleep(retry_interval)
+        retry_interval = min(retry_interval * 2, const.KASA_MAX_INIT_RETRY_INTERVAL)
+        initialized = await init_kasa(kasa, run_state)
+        if initialized:
+            logger.info(
+                f"Device {kasa.name} ready after {time.monotonic() - started_ts:.2f}"
+                " seconds"
+            )
+
+    schedule_polls(run_state, kasa, poll_phase)
+    await handle_kasa_requests(kasa, run_state.main_events)
+
+
+async def start_kasa_device(
+    kasa: Kasa,
+    run_state: RunState,
+    init: Optional[asyncio.Task] = None,
+    poll_phase: float = 0.0,
+):
+    """Bring up a device: initialize it, or wait for init to, then serve it."""
+    started_ts = time.monotonic()
+    initialized = await (init or init_kasa(kasa, run_state))
+    await handle_kasa_device(kasa, initialized, run_state, started_ts, poll_phase)
+
+
+async def init_outlet(kasa: Kasa, run_state: RunState, strip_init: asyncio.Task) -> bool:
+    # the first query of the strip takes the snapshots of its outlets
+    await asyncio.wait([strip_init])
+    return await init_kasa(kasa, run_state)
+
+
 async def cancel_tasks(tasks):
     logger.info("Cancelling all tasks")
     for task in tasks:
@@ -249,19 +502,255 @@ async def cancel_tasks(tasks):
             pass
 
 
-async def main_loop():
-    global stop_gracefully
+def add_location(run_state: RunState, location: Location) -> Kasa:
+    kasa = run_state.kasas[location.name] = Kasa(location)
+    route_kasa(run_state, kasa)
+    run_state.main_events.queue(location.name)
+    return kasa
+
+
+def attach_outlets(run_state: RunState):
+    for kasa in run_state.kasas.values():
+        strip = run_state.kasas.get(kasa.location.strip)
+        if strip and kasa.strip is not strip:
+            kasa.attach(strip)
+
+
+def route_kasa(run_state: RunState, kasa: Kasa):
+    run_state.router.add(kasa.topic, kasa.name, ACTION_STATE)
+    if kasa.state and kasa.state.is_dimmable:
+        brightness_topic = f"{kasa.topic}{BRIGHTNESS_TOPIC_SUFFIX}"
+        run_state.router.add(brightness_topic, kasa.name, ACTION_BRIGHTNESS)
+
+
+def unroute_kasa(run_state: RunState, kasa: Kasa):
+    run_state.router.remove(kasa.topic)
+    run_state.router.remove(f"{kasa.topic}{BRIGHTNESS_TOPIC_SUFFIX}")
+
+
+def add_keep_alive(run_state: RunState, name: str, config: Dict):
+    ka = KeepAlive(location_name=name, **config)
+    run_state.router.add(ka.subscribe_topic, name, ACTION_KEEP_ALIVE)
+    run_state.keep_alives[name] = ka
+    if ka.publish_topic:
+        metrics.set_topic_class(ka.publish_topic, "keep_alive")
+    run_state.keep_alive_engine.add(ka, run_state.kasas[name])
+
+
+def remove_keep_alive(run_state: RunState, name: str):
+    ka = run_state.keep_alives.pop(name)
+    run_state.router.remove(ka.subscribe_topic)
+    run_state.keep_alive_engine.remove(ka)
+
+
+def add_group(run_state: RunState, group: Group):
+    run_state.router.add(group.topic, group.name, ACTION_GROUP)
+    run_state.groups[group.name] = group
+    run_state.main_events.queue(group.name)
+
+
+async def remove_group(run_state: RunState, name: str):
+    group = run_state.groups.pop(name)
+    run_state.router.remove(group.topic)
+    run_state.main_events.remove(name)
+    await run_state.cancel_device_tasks(name)
+
+
+def create_run_state() -> RunState:
+    cfg = Cfg()
+    run_state = RunState()
+    # the config loader made sure that names and topics do not clash
+    for location in cfg.locations.values():
+        add_location(run_state, location)
+    attach_outlets(run_state)
+    for name, config in cfg.keep_alives.items():
+        add_keep_alive(run_state, name, config)
+    for group in cfg.groups.values():
+        add_group(run_state, group)
+
+    topic = cfg.instrumentation_topic
+    if cfg.instrumentation and topic:
+        run_state.router.add(topic, "", ACTION_INSTRUMENTATION)
+    return run_state
+
+
+async def start_devices(run_state: RunState):
+    started_ts = time.monotonic()
+    # Bring up all devices concurrently. Each device is polled and takes
+    # commands as soon as its own init is done. A device that cannot be
+    # reached in time is left pending and keeps retrying in the background,
+    # without holding up the ones that are ready
+    kasas = list(run_state.kasas.values())
+    inits = {}
+    for kasa in sorted(kasas, key=lambda kasa: bool(kasa.location.strip)):
+        strip_init = inits.get(kasa.location.strip)
+        inits[kasa.name] = asyncio.create_task(
+            init_outlet(kasa, run_state, strip_init)
+            if strip_init
+            else init_kasa(kasa, run_state)
+        )
+
+    # spread the first polls evenly over the poll interval, so devices are not
+    # all queried at the same time
+    for i, kasa in enumerate(kasas):
+        poll_phase = kasa.poll_interval * i / len(kasas)
+        run_state.start_device_task(
+            kasa.name,
+            start_kasa_device(kasa, run_state, inits[kasa.name], poll_phase),
+        )
+
+    results = await asyncio.gather(*inits.values(), return_exceptions=True)
+    pending = [name for name, ready in zip(inits, results) if ready is not True]
+    logger.info(
+        f"Startup: {len(results) - len(pending)} of {len(results)} devices"
+        f" ready in {time.monotonic() - started_ts:.2f} seconds."
+        f" Pending: {pending or 'none'}"
+    )
+
+
+def start_events_worker(run_state: RunState, name: str, mqtt_send_q: PublishQueue):
+    main_events_q = run_state.main_events.queue(name)
+    run_state.start_device_task(
+        name, handle_main_events(run_state, mqtt_send_q, main_events_q)
+    )
+
+
+async def remove_device(run_state: RunState, name: str):
+    kasa = run_state.kasas.pop(name)
+    unroute_kasa(run_state, kasa)
+    run_state.main_events.remove(name)
+    for job in (kasa.poll_job, kasa.emeter_job):
+        if job:
+            run_state.scheduler.remove(job)
+    await run_state.cancel_device_tasks(name)
+    await kasa.stop()
+
+
+async def retune_device(run_state: RunState, location: Location):
+    kasa = run_state.kasas[location.name]
+    moved = kasa.topic != location.topic
+    kasa.configure(location)
+    if moved:
+        route_kasa(run_state, kasa)
+        if kasa.curr_state is not None:
+            await run_state.main_events.put(
+                KasaStateEvent(name=kasa.name, state=kasa.curr_state)
+            )
+    if kasa.polling:
+        # a device that is still pending picks the new settings up once it starts
+        if kasa.poll_job:
+            kasa.poll_job.reschedule(kasa.poll_interval)
+        schedule_emeter_polls(run_state, kasa)
+
+
+def device_identity(location: Location):
+    return location.host, location.alias, location.strip, location.outlet
+
+
+async def reload_config(run_state: RunState, mqtt_send_q: PublishQueue):
+    """Load the config file again and apply what changed to the devices.
+
+    Devices whose location did not change are left alone, with their
+    connection and state. A device whose host, alias or outlet changed is
+    replaced. Any other change of a location is applied to its device in
+    place.
+    """
+    try:
+        old_info = Cfg.reload()
+    except (ConfigError, OSError, yaml.YAMLError) as e:
+        logger.error(f"Config not reloaded, the current one stays in use. {e}")
+        return
+    cfg = Cfg()
+    old_locations, locations = old_info.locations, cfg.locations
+    kept = [name for name in locations if name in old_locations]
+    removed = [name for name in old_locations if name not in locations]
+    replaced = [
+        name
+        for name in kept
+        if device_identity(old_locations[name]) != device_identity(locations[name])
+    ]
+    retuned = [
+        name
+        for name in kept
+        if name not in replaced and old_locations[name] != locations[name]
+    ]
+    added = [name for name in locations if name not in old_locations]
+
+    # keep alives refer to devices, so they go first and come back last
+    for name, config in old_info.keep_alives.items():
+        if (
+            name in removed
+            or name in replaced
+            or config != cfg.keep_alives.get(name)
+        ):
+            remove_keep_alive(run_state, name)
+    for name, group in old_info.groups.items():
+        if cfg.groups.get(name) != group:
+            await remove_group(run_state, name)
+    for name in removed + replaced:
+        await remove_device(run_state, name)
+    # free every topic that moves before taking any, so devices can swap them
+    for name in retuned:
+        if run_state.kasas[name].topic != locations[name].topic:
+            unroute_kasa(run_state, run_state.kasas[name])
+    for name in retuned:
+        await retune_device(run_state, locations[name])
+    for name in replaced + added:
+        kasa = add_location(run_state, locations[name])
+        start_events_worker(run_state, name, mqtt_send_q)
+        run_state.start_device_task(name, start_kasa_device(kasa, run_state))
+    attach_outlets(run_state)
+    for name, config in cfg.keep_alives.items():
+        if name not in run_state.keep_alives:
+            add_keep_alive(run_state, name, config)
+    for name, group in cfg.groups.items():
+        if name not in run_state.groups:
+            add_group(run_state, group)
+            start_events_worker(run_state, name, mqtt_send_q)
+    await run_state.sync_subscriptions()
+
+    logger.info(
+        f"Config reloaded. Added:{added} removed:{removed} replaced:{replaced}"
+        f" retuned:{retuned}"
+    )
+    restart_needed = cfg.startup_settings_changed(old_info)
+    if restart_needed:
+        logger.warning(f"Restart to apply these changed settings: {restart_needed}")
+
+
+async def handle_config_reloads(run_state: RunState, mqtt_send_q: PublishQueue):
+    reload_requested = asyncio.Event()
+    asyncio.get_running_loop().add_signal_handler(
+        signal.SIGHUP, reload_requested.set
+    )
+    while True:
+        await reload_requested.wait()
+        reload_requested.clear()
+        logger.info("Reloading config on SIGHUP")
+        await reload_config(run_state, mqtt_send_q)
+
 
+async def republish_state(run_state: RunState):
+    for kasa in run_state.kasas.values():
+        if kasa.curr_state is not None:
+            await run_state.main_events.put(
+                KasaStateEvent(name=kasa.name, state=kasa.curr_state)
+            )
+        if kasa.curr_brightness is not None:
+            await run_state.main_events.put(
+                KasaBrightnessEvent(name=kasa.name, brightness=kasa.curr_brightness)
+            )
+
+
+async def main_loop(run_state: RunState, mqtt_send_q: asyncio.Queue):
     # used to be: https://pypi.org/project/asyncio-mqtt/
     # https://pypi.org/project/aiomqtt/
-    logger.debug("Starting main event processing loop")
+    logger.debug("Starting mqtt session")
     cfg = Cfg()
     mqtt_broker_ip = cfg.mqtt_host
     mqtt_client_id = cfg.mqtt_client_id
     mqtt_username = cfg.mqtt_username
     mqtt_password = cfg.mqtt_password
-    mqtt_send_q = asyncio.Queue(maxsize=256)
-    main_events_q = asyncio.Queue(maxsize=256)
 
     # We 💛 context managers. Let's create a stack to help
     # us manage them.
@@ -280,67 +769,49 @@ async def main_loop():
         await stack.enter_async_context(client)
 
         messages = await stack.enter_async_context(client.unfiltered_messages())
-        task = asyncio.create_task(handle_mqtt_messages(messages, main_events_q))
+        task = asyncio.create_task(
+            handle_mqtt_messages(messages, run_state.main_events)
+        )
         tasks.add(task)
 
         task = asyncio.create_task(handle_mqtt_publish(client, mqtt_send_q))
         tasks.add(task)
 
-        run_state = RunState()
-        for name, config in cfg.locations.items():
-            topic = cfg.mqtt_topic(name)
-            if topic in run_state.topics:
-                raise RuntimeError(
-                    f"Topic {topic} assigned to more than one device: "
-                    f"{name} and {run_state.topics[topic]}"
-                )
-
-            kasa = Kasa(name, topic, config)
-            run_state.topics[topic] = name
-            await client.subscribe(topic)
-            if await kasa.is_dimmable:
-                run_state.topics[f"{topic}{BRIGHTNESS_TOPIC_SUFFIX}"] = name
-                await client.subscribe(f"{topic}{BRIGHTNESS_TOPIC_SUFFIX}")
-            run_state.kasas[name] = kasa
-
-        for kasa in run_state.kasas.values():
-            tasks.add(asyncio.create_task(handle_kasa_poller(kasa, main_events_q)))
-            tasks.add(asyncio.create_task(handle_kasa_requests(kasa)))
-            if kasa.emeter_poll_interval:
-                tasks.add(
-                    asyncio.create_task(handle_kasa_emeter_poller(kasa, main_events_q))
-                )
-
-        for name, config in cfg.keep_alives.items():
-            if name not in run_state.kasas:
-                raise RuntimeError(
-                    f"Keep alive {name} must have a corresponding location entry"
-                )
-            config["location_name"] = name
-            ka = KeepAlive(**config)
-            topic = ka.subscribe_topic
-            if topic in run_state.topics or topic in run_state.keep_alive_topics:
-                raise RuntimeError(
-                    f"Subscribe topic {topic} for keep alive {name} is not unique"
-                )
-            run_state.keep_alive_topics[topic] = name
-            await client.subscribe(ka.subscribe_topic)
-            run_state.keep_alives[name] = ka
-
-        task = asyncio.create_task(
-            handle_keep_alives(run_state.kasas, run_state.keep_alives, mqtt_send_q)
+        run_state.client = client
+        run_state.subscriptions = set()
+        stack.callback(setattr, run_state, "client", None)
+        for topic_filter in run_state.router.subscriptions(
+            wildcards=cfg.mqtt_wildcard_subscriptions
+        ):
+            await client.subscribe(topic_filter)
+            run_state.subscriptions.add(topic_filter)
+        logger.info(
+            f"Subscribed to {len(run_state.subscriptions)} topic filters for"
+            f" {len(run_state.router)} topics: {sorted(run_state.subscriptions)}"
         )
-        tasks.add(task)
 
-        task = asyncio.create_task(
-            handle_main_events(run_state, mqtt_send_q, main_events_q)
-        )
-        tasks.add(task)
+        # devices outlive the mqtt session, so let the broker know where they are at
+        mqtt_send_q.forget()
+        await republish_state(run_state)
 
         # Wait for everything to complete (or fail due to, e.g., network errors)
         await asyncio.gather(*tasks)
 
-    logger.debug("all done!")
+    logger.debug("mqtt session is done")
+
+
+async def handle_mqtt_sessions(run_state: RunState, mqtt_send_q: asyncio.Queue):
+    # Run the mqtt session indefinitely. Reconnect automatically
+    # if the connection is lost. Devices are not affected by that.
+    reconnect_interval = Cfg().reconnect_interval
+    while not stop_gracefully:
+        try:
+            await main_loop(run_state, mqtt_send_q)
+        except MqttError as error:
+            logger.warning(
+                f'MQTT error "{error}". Reconnecting in {reconnect_interval} seconds.'
+            )
+        await asyncio.sleep(reconnect_interval)
 
 
 # cfg_globals
@@ -351,33 +822,69 @@ logger = None
 async def main():
     global stop_gracefully
 
-    # Run the advanced_example indefinitely. Reconnect automatically
-    # if the connection is lost.
-    reconnect_interval = Cfg().reconnect_interval
-    while not stop_gracefully:
-        try:
-            await main_loop()
-        except MqttError as error:
-            logger.warning(
-                f'MQTT error "{error}". Reconnecting in {reconnect_interval} seconds.'
+    cfg = Cfg()
+    instrumentation.configure(
+        cfg.instrumentation,
+        cfg.instrumentation_slow_threshold,
+        cfg.instrumentation_lag_interval,
+    )
+    mqtt_send_q = PublishQueue(
+        maxsize=256,
+        dedup_window=cfg.mqtt_dedup_window,
+        telemetry_maxsize=cfg.mqtt_telemetry_queue_size,
+    )
+    metrics.track_queue(mqtt_send_q, "mqtt_send")
+    run_state = create_run_state()
+
+    async with AsyncExitStack() as stack:
+        tasks = set()
+        stack.push_async_callback(cancel_tasks, tasks)
+
+        shared_events_q = run_state.main_events.queue(EventShards.SHARED)
+        tasks.add(
+            asyncio.create_task(
+                handle_main_events(run_state, mqtt_send_q, shared_events_q)
+            )
+        )
+        # device tasks come and go with config reloads, so they are not
+        # gathered below
+        stack.push_async_callback(run_state.cancel_device_tasks)
+        for name in [*run_state.kasas, *run_state.groups]:
+            start_events_worker(run_state, name, mqtt_send_q)
+        tasks.add(asyncio.create_task(run_state.keep_alive_engine.run(mqtt_send_q)))
+        tasks.add(asyncio.create_task(handle_mqtt_sessions(run_state, mqtt_send_q)))
+        tasks.add(asyncio.create_task(run_state.scheduler.run()))
+        tasks.add(asyncio.create_task(instrumentation.run()))
+        tasks.add(
+            asyncio.create_task(handle_config_reloads(run_state, mqtt_send_q))
+        )
+        tasks.add(
+            asyncio.create_task(
+                metrics.serve_metrics(cfg.metrics_host, cfg.metrics_port)
             )
+        )
+        await start_devices(run_state)
+
+        try:
+            await asyncio.gather(*tasks)
         except (KeyboardInterrupt, SystemExit):
             logger.info("got KeyboardInterrupt")
             stop_gracefully = True
-            break
-        await asyncio.sleep(reconnect_interval)
 
 
 if __name__ == "__main__":
     logger = log.getLogger()
     log.initLogger()
 
-    knobs = Cfg().knobs
-    if isinstance(knobs, collections.abc.Mapping):
-        if knobs.get("log_to_console"):
-            log.log_to_console()
-        if knobs.get("log_level_debug"):
-            log.set_log_level_debug()
+    try:
+        knobs = Cfg().knobs
+    except ConfigError as e:
+        logger.error(str(e))
+        sys.exit(1)
+    if knobs.get("log_to_console"):
+        log.log_to_console()
+    if knobs.get("log_level_debug"):
+        log.set_log_level_debug()
 
     logger.debug("mqtt2kasa process started")
     asyncio.run(main())
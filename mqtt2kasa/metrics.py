@@ -0,0 +1,354 @@
+#!/usr/bin/env python
+import asyncio
+from bisect import bisect_left
+from typing import Callable, Dict, List, Sequence, Tuple
+
+from mqtt2kasa import log
+
+logger = log.getLogger()
+
+# Metrics are plain counters updated inline by the code that does the work.
+# Children are looked up once and kept by their users, so updating a metric is
+# an attribute increment. All formatting happens when the endpoint is scraped.
+
+LATENCY_BUCKETS = (
+    0.001,
+    0.005,
+    0.01,
+    0.025,
+    0.05,
+    0.1,
+    0.25,
+    0.5,
+    1.0,
+    2.5,
+    5.0,
+    10.0,
+    30.0,
+)
+
+REGISTRY: List["Family"] = []
+
+
+class Counter:
+    __slots__ = ("value",)
+
+    def __init__(self):
+        self.value = 0
+
+    def inc(self, amount: int = 1):
+        self.value += amount
+
+    def samples(self, name: str, labels: str):
+        yield f"{name}{labels} {self.value}"
+
+
+class GaugeFunction:
+    __slots__ = ("func",)
+
+    def __init__(self, func: Callable[[], float]):
+        self.func = func
+
+    def samples(self, name: str, labels: str):
+        yield f"{name}{labels} {self.func()}"
+
+
+class Histogram:
+    __slots__ = ("buckets", "counts", "sum", "count")
+
+    def __init__(self, buckets: Sequence[float] = LATENCY_BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value: float):
+        self.counts[bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def samples(self, name: str, labels: str):
+        label_prefix = f"{labels[:-1]}," if labels else "{"
+        cumulative = 0
+        for bound, count in zip(self.buckets, self.counts):
+            cumulative += count
+            yield f'{name}_bucket{label_prefix}le="{bound}"}} {cumulative}'
+        yield f'{name}_bucket{label_prefix}le="+Inf"}} {self.count}'
+        yield f"{name}_sum{labels} {self.sum}"
+        yield f"{name}_count{labels} {self.count}"
+
+
+def _escape(value: str) -> str:
+    return value.replace("\\", r"\\").replace('"', r"\"").replace("\n", r"\n")
+
+
+class Family:
+    """A named metric and its children, one per combination of label values."""
+
+    KINDS = {"counter": Counter, "histogram": Histogram, "gauge": None}
+
+    def __init__(
+        self, name: str, documentation: str, kind: str, labelnames: Tuple = ()
+    ):
+        assert kind in self.KINDS
+        self.name = name
+        self.documentation = documentation
+        self.kind = kind
+        self.labelnames = labelnames
+        self.children: Dict[Tuple, object] = {}
+        REGISTRY.append(self)
+
+    def labels(self, *values):
+        child = self.children.get(values)
+        if child is None:
+            child = self.children[values] = self.KINDS[self.kind]()
+        return child
+
+    def set_function(self, func: Callable[[], float], *values):
+        """Gauge whose value is read from func when the metrics are scraped."""
+        assert self.kind == "gauge"
+        self.children[values] = GaugeFunction(func)
+
+    def remove(self, *values):
+        self.children.pop(values, None)
+
+    def render(self, lines: List[str]):
+        lines.append(f"# HELP {self.name} {self.documentation}")
+        lines.append(f"# TYPE {self.name} {self.kind}")
+        for values, child in self.children.items():
+            labels = ",".join(
+                f'{labelname}="{_escape(value)}"'
+                for labelname, value in zip(self.labelnames, values)
+                if value
+            )
+            lines.extend(child.samples(self.name, f"{{{labels}}}" if labels else ""))
+
+
+def render() -> str:
+    lines = []
+    for family in REGISTRY:
+        family.render(lines)
+    lines.append("")
+    return "\n".join(lines)
+
+
+POLL_SECONDS = Family(
+    "mqtt2kasa_poll_duration_seconds",
+    "Time taken to query a device",
+    "histogram",
+    ("device", "kind"),
+)
+POLL_FAILURES = Family(
+    "mqtt2kasa_poll_failures_total",
+    "Device queries that failed",
+    "counter",
+    ("device", "kind"),
+)
+POLL_CONSECUTIVE_FAILURES = Family(
+    "mqtt2kasa_poll_consecutive_failures",
+    "Device queries that failed in a row",
+    "gauge",
+    ("device", "kind"),
+)
+DEVICE_SESSIONS = Family(
+    "mqtt2kasa_device_sessions_opened_total",
+    "Sessions opened to a device",
+    "counter",
+    ("device",),
+)
+DEVICE_REQUESTS = Family(
+    "mqtt2kasa_device_requests_total",
+    "Device requests by result",
+    "counter",
+    ("device", "result"),
+)
+THROTTLE_WAIT_SECONDS = Family(
+    "mqtt2kasa_throttle_wait_seconds",
+    "Time device commands waited for the throttler",
+    "histogram",
+    ("device",),
+)
+QUEUE_DEPTH = Family(
+    "mqtt2kasa_queue_depth", "Items waiting in a queue", "gauge", ("queue", "device")
+)
+QUEUE_HIGH_WATER = Family(
+    "mqtt2kasa_queue_high_water",
+    "Most items ever waiting in a queue",
+    "gauge",
+    ("queue", "device"),
+)
+PUBLISH_SECONDS = Family(
+    "mqtt2kasa_publish_duration_seconds",
+    "Time taken by the broker to take a publish",
+    "histogram",
+)
+PUBLISH_QUEUE_WAIT_SECONDS = Family(
+    "mqtt2kasa_publish_queue_wait_seconds",
+    "Time messages waited to be published",
+    "histogram",
+)
+PUBLISH_FAILURES = Family(
+    "mqtt2kasa_publish_failures_total", "Publishes that failed", "counter"
+)
+PUBLISH_QUEUE_DEPTH = Family(
+    "mqtt2kasa_publish_queue_depth",
+    "Messages waiting to be published by priority",
+    "gauge",
+    ("priority",),
+)
+PUBLISH_DROPPED = Family(
+    "mqtt2kasa_publish_dropped_total",
+    "Messages dropped because publishing fell behind",
+    "counter",
+    ("priority",),
+)
+MESSAGES = Family(
+    "mqtt2kasa_mqtt_messages_total",
+    "Mqtt messages by direction and topic class",
+    "counter",
+    ("direction", "topic_class"),
+)
+
+publish_seconds = PUBLISH_SECONDS.labels()
+publish_queue_wait_seconds = PUBLISH_QUEUE_WAIT_SECONDS.labels()
+publish_failures = PUBLISH_FAILURES.labels()
+
+
+class MeteredQueue(asyncio.Queue):
+    """Queue that remembers the most items it ever held."""
+
+    def __init__(self, maxsize: int = 0):
+        super().__init__(maxsize)
+        self.high_water = 0
+
+    def put_nowait(self, item):
+        super().put_nowait(item)
+        size = self.qsize()
+        if size > self.high_water:
+            self.high_water = size
+
+
+def track_queue(queue: MeteredQueue, name: str, device: str = ""):
+    QUEUE_DEPTH.set_function(queue.qsize, name, device)
+    QUEUE_HIGH_WATER.set_function(lambda: queue.high_water, name, device)
+
+
+def untrack_queue(name: str, device: str = ""):
+    QUEUE_DEPTH.remove(name, device)
+    QUEUE_HIGH_WATER.remove(name, device)
+
+
+class DeviceMetrics:
+    __slots__ = (
+        "poll_seconds",
+        "poll_failures",
+        "emeter_poll_seconds",
+        "emeter_poll_failures",
+        "throttle_wait_seconds",
+        "sessions_opened",
+        "requests_served",
+        "requests_failed",
+        "requests_skipped",
+    )
+
+    def __init__(self, kasa):
+        name = kasa.name
+        self.poll_seconds = POLL_SECONDS.labels(name, "state")
+        self.poll_failures = POLL_FAILURES.labels(name, "state")
+        self.emeter_poll_seconds = POLL_SECONDS.labels(name, "emeter")
+        self.emeter_poll_failures = POLL_FAILURES.labels(name, "emeter")
+        self.throttle_wait_seconds = THROTTLE_WAIT_SECONDS.labels(name)
+        self.sessions_opened = DEVICE_SESSIONS.labels(name)
+        self.requests_served = DEVICE_REQUESTS.labels(name, "served")
+        self.requests_failed = DEVICE_REQUESTS.labels(name, "failed")
+        # not sent, the device was waiting out its reconnect backoff
+        self.requests_skipped = DEVICE_REQUESTS.labels(name, "skipped")
+        POLL_CONSECUTIVE_FAILURES.set_function(lambda: kasa.poll_fails, name, "state")
+        POLL_CONSECUTIVE_FAILURES.set_function(
+            lambda: kasa.emeter_poll_fails, name, "emeter"
+        )
+        track_queue(kasa.recv_q, "recv", name)
+
+    @staticmethod
+    def remove(name: str):
+        """Stop exporting the metrics of a device that is gone."""
+        for kind in ("state", "emeter"):
+            POLL_SECONDS.remove(name, kind)
+            POLL_FAILURES.remove(name, kind)
+            POLL_CONSECUTIVE_FAILURES.remove(name, kind)
+        THROTTLE_WAIT_SECONDS.remove(name)
+        DEVICE_SESSIONS.remove(name)
+        for result in ("served", "failed", "skipped"):
+            DEVICE_REQUESTS.remove(name, result)
+        untrack_queue("recv", name)
+
+
+# messages are counted per topic class. The counter of each topic is looked
+# up once, so counting a message is a dict lookup and an increment
+_received: Dict[str, Counter] = {}
+_published: Dict[str, Counter] = {}
+
+
+def classify_topic(topic: str) -> str:
+    if "/emeter" in topic:
+        return "emeter"
+    if topic.endswith("/status"):
+        return "status"
+    if topic.endswith("/brightness"):
+        return "brightness"
+    return "state"
+
+
+def set_topic_class(topic: str, topic_class: str):
+    _published[topic] = MESSAGES.labels("out", topic_class)
+
+
+def count_published(topic: str):
+    counter = _published.get(topic)
+    if counter is None:
+        counter = _published[topic] = MESSAGES.labels("out", classify_topic(topic))
+    counter.inc()
+
+
+def count_received(topic_class: str):
+    counter = _received.get(topic_class)
+    if counter is None:
+        counter = _received[topic_class] = MESSAGES.labels("in", topic_class)
+    counter.inc()
+
+
+async def _handle_scrape(reader, writer):
+    try:
+        request_line = await asyncio.wait_for(reader.readline(), 5)
+        while True:
+            line = await asyncio.wait_for(reader.readline(), 5)
+            if line in (b"\r\n", b"\n", b""):
+                break
+        parts = request_line.split()
+        path = parts[1].split(b"?")[0] if len(parts) > 1 else b""
+        if parts and parts[0] == b"GET" and path in (b"/", b"/metrics"):
+            status, body = "200 OK", render().encode()
+        else:
+            status, body = "404 Not Found", b"not found\n"
+        writer.write(
+            f"HTTP/1.0 {status}\r\n"
+            "Content-Type: text/plain; version=0.0.4; charset=utf-8\r\n"
+            f"Content-Length: {len(body)}\r\n"
+            "Connection: close\r\n\r\n".encode()
+            + body
+        )
+        await writer.drain()
+    except (asyncio.TimeoutError, ConnectionError):
+        pass
+    finally:
+        writer.close()
+
+
+async def serve_metrics(host: str, port: int):
+    if not port:
+        logger.info("Metrics endpoint is disabled based on config")
+        return
+    server = await asyncio.start_server(_handle_scrape, host, port)
+    logger.info(f"Serving metrics on http://{host}:{port}/metrics")
+    async with server:
+        await server.serve_forever()
@@ -1,39 +1,327 @@
 import asyncio
+import collections
+import json
+import time
+from typing import Dict, List, Tuple
 
+from mqtt2kasa import const
 from mqtt2kasa import log
+from mqtt2kasa import metrics
 from mqtt2kasa.config import Cfg
-from mqtt2kasa.events import MqttMsgEvent
+from mqtt2kasa.events import (
+    MqttMsgEvent,
+    PRIORITY_KEEP_ALIVE,
+    PRIORITY_NAMES,
+    PRIORITY_TELEMETRY,
+)
+from mqtt2kasa.shards import EventShards
 
 logger = log.getLogger()
 
 
-async def handle_mqtt_publish(client, mqtt_send_q: asyncio.Queue):
+class TokenBucket:
+    """Allow up to `burst` messages at once, refilled at `rate` per second."""
+
+    def __init__(self, rate: float, burst: int):
+        self.rate = rate
+        self.burst = max(1, burst)
+        self.tokens = float(self.burst)
+        self.last_ts = time.monotonic()
+
+    def _refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.burst, self.tokens + (now - self.last_ts) * self.rate)
+        self.last_ts = now
+
+    async def acquire(self):
+        while True:
+            self._refill()
+            if self.tokens >= 1:
+                self.tokens -= 1
+                return
+            await asyncio.sleep((1 - self.tokens) / self.rate)
+
+
+class NoTokenBucket:
+    async def acquire(self):
+        pass
+
+
+def dedup_key(payload):
+    """What is compared to decide whether a payload was already published.
+
+    Json objects are compared without their timestamp, so a status that
+    only differs in when it was taken counts as the same status.
+    """
+    if not isinstance(payload, str) or not payload.startswith("{"):
+        return payload
+    try:
+        data = json.loads(payload)
+    except ValueError:
+        return payload
+    if not isinstance(data, dict) or "timestamp" not in data:
+        return payload
+    del data["timestamp"]
+    return json.dumps(data, sort_keys=True)
+
+
+class _PriorityLanes:
+    """One fifo per priority, for asyncio.Queue to keep its items in."""
+
+    __slots__ = ("lanes",)
+
+    def __init__(self):
+        self.lanes = tuple(collections.deque() for _ in PRIORITY_NAMES)
+
+    def __len__(self):
+        return sum(len(lane) for lane in self.lanes)
+
+    def append(self, item):
+        self.lanes[item.priority].append(item)
+
+    def popleft(self):
+        for lane in self.lanes:
+            if lane:
+                return lane.popleft()
+        raise IndexError("pop from empty lanes")
+
+
+class PublishQueue(metrics.MeteredQueue):
+    """Outbound queue that drops messages the broker already has.
+
+    A message is dropped when the same payload was queued for its topic less
+    than dedup_window seconds ago. The window starts when a payload is
+    queued, so repeating it does not keep it suppressed forever. Keep alive
+    pings are heartbeats that often repeat their payload, so they are never
+    dropped as duplicates.
+
+    Messages are published by priority, see PRIORITY_NAMES. Control and keep
+    alive messages wait for room when the queue is full. Telemetry never
+    waits: when the queue is full, or telemetry_maxsize telemetry messages
+    are already waiting, the oldest telemetry is dropped instead.
+    """
+
+    def __init__(
+        self, maxsize: int = 0, dedup_window: float = 0.0, telemetry_maxsize: int = 0
+    ):
+        super().__init__(maxsize)
+        self.dedup_window = dedup_window
+        self.telemetry_maxsize = telemetry_maxsize
+        self.last_published: Dict[str, Tuple[object, float]] = {}
+        self.sent = 0
+        self.suppressed = 0
+        self.dropped = [0] * len(PRIORITY_NAMES)
+        self._dropped_counters = [metrics.PUBLISH_DROPPED.labels(n) for n in PRIORITY_NAMES]
+        for lane, name in zip(self._queue.lanes, PRIORITY_NAMES):
+            metrics.PUBLISH_QUEUE_DEPTH.set_function(lane.__len__, name)
+
+    def _init(self, maxsize):
+        self._queue = _PriorityLanes()
+
+    def _put(self, item):
+        self._queue.append(item)
+
+    def _get(self):
+        return self._queue.popleft()
+
+    def depths(self) -> List[int]:
+        return [len(lane) for lane in self._queue.lanes]
+
+    def _is_duplicate(self, item) -> bool:
+        if self.dedup_window <= 0 or item.priority == PRIORITY_KEEP_ALIVE:
+            return False
+        key = dedup_key(item.payload)
+        now = time.monotonic()
+        last = self.last_published.get(item.topic)
+        if last and last[0] == key and now - last[1] < self.dedup_window:
+            return True
+        self.last_published[item.topic] = (key, now)
+        return False
+
+    def _drop(self, item):
+        self.dropped[item.priority] += 1
+        self._dropped_counters[item.priority].inc()
+        # the broker will not get it, so do not suppress the next one
+        self.forget(item.topic)
+        logger.debug(f"Dropped publish: {item.topic} {item.payload}")
+
+    def _shed_telemetry(self, item) -> bool:
+        """Drop the oldest telemetry to make room for item.
+
+        Returns False when item is telemetry and there is still no room for it.
+        """
+        telemetry = self._queue.lanes[PRIORITY_TELEMETRY]
+        is_telemetry = item.priority == PRIORITY_TELEMETRY
+        while telemetry and (
+            self.full() or (is_telemetry and len(telemetry) >= self.telemetry_maxsize > 0)
+        ):
+            self._drop(telemetry.popleft())
+            self.task_done()
+        return not (is_telemetry and self.full())
+
+    async def put(self, item):
+        if item.priority == PRIORITY_TELEMETRY:
+            self.put_nowait(item)
+            return
+        # make room rather than wait behind telemetry
+        self._shed_telemetry(item)
+        await super().put(item)
+
+    def put_nowait(self, item):
+        if self._is_duplicate(item):
+            self.suppressed += 1
+            logger.debug(f"Suppressed duplicate publish: {item.topic} {item.payload}")
+            return
+        if not self._shed_telemetry(item):
+            self._drop(item)
+            return
+        super().put_nowait(item)
+        self.sent += 1
+
+    def observe(self, topic: str, payload):
+        """Someone published payload on topic, maybe not us."""
+        last = self.last_published.get(topic)
+        if last and last[0] != dedup_key(payload):
+            del self.last_published[topic]
+
+    def forget(self, topic: str = None):
+        if topic is None:
+            self.last_published.clear()
+        else:
+            self.last_published.pop(topic, None)
+
+    def summary(self) -> str:
+        dropped = " ".join(
+            f"{name}:{count}" for name, count in zip(PRIORITY_NAMES, self.dropped)
+        )
+        return f"sent:{self.sent} suppressed:{self.suppressed} dropped {dropped}"
+
+
+class PublishStats:
+    def __init__(self):
+        self.reset()
+
+    def reset(self):
+        self.started_ts = time.monotonic()
+        self.published = 0
+        self.failed = 0
+        self.latency_total = 0.0
+        self.latency_max = 0.0
+        self.queue_wait_total = 0.0
+        self.queue_wait_max = 0.0
+
+    def record(self, queue_wait: float, latency: float, ok: bool):
+        if ok:
+            self.published += 1
+        else:
+            self.failed += 1
+        self.latency_total += latency
+        self.latency_max = max(self.latency_max, latency)
+        self.queue_wait_total += queue_wait
+        self.queue_wait_max = max(self.queue_wait_max, queue_wait)
+
+    @property
+    def due(self) -> bool:
+        return time.monotonic() - self.started_ts >= const.MQTT_PUBLISH_STATS_INTERVAL
+
+    def summary(self) -> str:
+        count = max(1, self.published + self.failed)
+        return (
+            f"published:{self.published} failed:{self.failed}"
+            f" latency avg:{self.latency_total / count * 1000:.1f}ms"
+            f" max:{self.latency_max * 1000:.1f}ms"
+            f" queue wait avg:{self.queue_wait_total / count * 1000:.1f}ms"
+            f" max:{self.queue_wait_max * 1000:.1f}ms"
+        )
+
+
+async def _publish(
+    client,
+    mqtt_msg: MqttMsgEvent,
+    mqtt_send_q: PublishQueue,
+    inflight: asyncio.Semaphore,
+    stats: PublishStats,
+    queue_wait: float,
+    qos: int,
+    retain: bool,
+):
+    topic, payload = mqtt_msg.topic, mqtt_msg.payload
+    started = time.monotonic()
+    ok = False
+    try:
+        await client.publish(topic, payload, timeout=15, qos=qos, retain=retain)
+        ok = True
+        metrics.count_published(topic)
+        logger.debug(f"Published: {topic} {payload}")
+    except Exception as e:
+        metrics.publish_failures.inc()
+        logger.error("client failed publish mqtt %s %s : %s", topic, payload, e)
+        # the broker may not have it, so do not suppress the next attempt
+        mqtt_send_q.forget(topic)
+    finally:
+        latency = time.monotonic() - started
+        stats.record(queue_wait, latency, ok)
+        metrics.publish_seconds.observe(latency)
+        metrics.publish_queue_wait_seconds.observe(queue_wait)
+        inflight.release()
+        mqtt_send_q.task_done()
+
+
+async def handle_mqtt_publish(client, mqtt_send_q: PublishQueue):
     c = Cfg()
     mqtt_qos = c.mqtt_qos
     mqtt_retain = c.mqtt_retain
+    publish_rate = c.mqtt_publish_rate
+    max_inflight = c.mqtt_publish_max_inflight
     logger.info(
         f"handle_mqtt_publish task started. Using retain:{mqtt_retain} and qos:{mqtt_qos}"
+        f" rate:{publish_rate}/s burst:{c.mqtt_publish_burst} inflight:{max_inflight}"
+        f" dedup window:{mqtt_send_q.dedup_window}s"
+        f" telemetry queue:{mqtt_send_q.telemetry_maxsize}"
     )
-    while True:
-        mqtt_msg = await mqtt_send_q.get()
-        topic, payload = mqtt_msg.topic, mqtt_msg.payload
-        # logger.debug(f"Publishing: {topic} {payload}")
-        try:
-            await client.publish(
-                topic, payload, timeout=15, qos=mqtt_qos, retain=mqtt_retain
+    # Dampen publishes. The bucket is a fail-safe against runaway loops and should
+    # not affect anything unless there is a bug lurking somewhere
+    if publish_rate > 0:
+        bucket = TokenBucket(publish_rate, c.mqtt_publish_burst)
+    else:
+        bucket = NoTokenBucket()
+    inflight = asyncio.Semaphore(max_inflight)
+    stats = PublishStats()
+    pending = set()
+    try:
+        while True:
+            mqtt_msg = await mqtt_send_q.get()
+            queue_wait = time.monotonic() - mqtt_msg.created
+            await bucket.acquire()
+            await inflight.acquire()
+            task = asyncio.create_task(
+                _publish(
+                    client,
+                    mqtt_msg,
+                    mqtt_send_q,
+                    inflight,
+                    stats,
+                    queue_wait,
+                    mqtt_qos,
+                    mqtt_retain,
+                )
             )
-            logger.debug(f"Published: {topic} {payload}")
-        except Exception as e:
-            logger.error("client failed publish mqtt %s %s : %s", topic, payload, e)
-        mqtt_send_q.task_done()
-        # Dampen publishes. This is a fail-safe and should not affect anything unless
-        # there is a bug lurking somewhere
-        await asyncio.sleep(0.5)
+            pending.add(task)
+            task.add_done_callback(pending.discard)
+            if stats.due:
+                logger.info(
+                    f"Publish stats: {stats.summary()}"
+                    f" queue {mqtt_send_q.summary()}"
+                )
+                stats.reset()
+    finally:
+        for task in pending:
+            task.cancel()
 
 
-async def handle_mqtt_messages(messages, main_events_q: asyncio.Queue):
+async def handle_mqtt_messages(messages, main_events: EventShards):
     async for message in messages:
         msg_topic = message.topic
         msg_payload = message.payload.decode()
         logger.debug(f"Received mqtt topic:{msg_topic} payload:{msg_payload}")
-        await main_events_q.put(MqttMsgEvent(topic=msg_topic, payload=msg_payload))
+        main_events.put_mqtt(MqttMsgEvent(topic=msg_topic, payload=msg_payload))
@@ -0,0 +1,155 @@
+#!/usr/bin/env python
+from collections import defaultdict, namedtuple
+from typing import Dict, Iterable, List, Optional
+
+ACTION_STATE = "state"
+ACTION_BRIGHTNESS = "brightness"
+ACTION_KEEP_ALIVE = "keep_alive"
+ACTION_INSTRUMENTATION = "instrumentation"
+ACTION_GROUP = "group"
+
+Route = namedtuple("Route", "name action")
+
+WILDCARD_ONE = "+"
+WILDCARD_ALL = "#"
+
+
+def topic_matches(topic_filter: str, topic: str) -> bool:
+    filter_levels = topic_filter.split("/")
+    topic_levels = topic.split("/")
+    for i, level in enumerate(filter_levels):
+        if level == WILDCARD_ALL:
+            return True
+        if i >= len(topic_levels):
+            return False
+        if level != WILDCARD_ONE and level != topic_levels[i]:
+            return False
+    return len(filter_levels) == len(topic_levels)
+
+
+class _Node:
+    __slots__ = ("children", "route")
+
+    def __init__(self):
+        self.children: Dict[str, "_Node"] = {}
+        self.route: Optional[Route] = None
+
+
+class TopicRouter:
+    """Maps mqtt topics to the (device name, action) that handles them.
+
+    Topics are kept in a tree of topic levels, so a lookup costs one step per
+    level regardless of how many topics there are. Routes may use the mqtt
+    '+' and '#' wildcards; a route without wildcards wins over one with them.
+    """
+
+    def __init__(self):
+        self._root = _Node()
+        self._routes: Dict[str, Route] = {}
+
+    def __len__(self):
+        return len(self._routes)
+
+    def __contains__(self, topic_filter: str) -> bool:
+        return topic_filter in self._routes
+
+    def get(self, topic_filter: str) -> Optional[Route]:
+        return self._routes.get(topic_filter)
+
+    def items(self):
+        return self._routes.items()
+
+    def add(self, topic_filter: str, name: str, action: str):
+        if topic_filter in self._routes:
+            raise ValueError(f"Topic {topic_filter} is already routed")
+        node = self._root
+        for level in topic_filter.split("/"):
+            node = node.children.setdefault(level, _Node())
+        node.route = Route(name, action)
+        self._routes[topic_filter] = node.route
+
+    def remove(self, topic_filter: str):
+        if self._routes.pop(topic_filter, None) is None:
+            return
+        path = [self._root]
+        levels = topic_filter.split("/")
+        for level in levels:
+            path.append(path[-1].children[level])
+        path[-1].route = None
+        # prune the branches that no longer lead to a route
+        for level, node, parent in zip(
+            reversed(levels), reversed(path[1:]), reversed(path[:-1])
+        ):
+            if node.route or node.children:
+                break
+            del parent.children[level]
+
+    def match(self, topic: str) -> Optional[Route]:
+        return self._match(self._root, topic.split("/"), 0)
+
+    def _match(self, node: _Node, levels: List[str], i: int) -> Optional[Route]:
+        if i == len(levels):
+            if node.route:
+                return node.route
+            node = node.children.get(WILDCARD_ALL)
+            return node.route if node else None
+        child = node.children.get(levels[i])
+        if child:
+            route = self._match(child, levels, i + 1)
+            if route:
+                return route
+        child = node.children.get(WILDCARD_ONE)
+        if child:
+            route = self._match(child, levels, i + 1)
+            if route:
+                return route
+        child = node.children.get(WILDCARD_ALL)
+        return child.route if child else None
+
+    def subscriptions(self, wildcards: bool = True) -> List[str]:
+        """Topic filters that cover every route.
+
+        With wildcards, routes that differ in a single topic level are folded
+        into one filter with '+' at that level, e.g. /+/switch.
+        """
+        topics = list(self._routes)
+        if not wildcards:
+            return topics
+        return fold_topics(topics)
+
+
+def fold_topics(topics: Iterable[str]) -> List[str]:
+    topics = set(topics)
+    uncovered = set(topics)
+    covered = set()
+    filters = []
+    while uncovered:
+        groups = defaultdict(set)
+        for topic in uncovered:
+            levels = topic.split("/")
+            if WILDCARD_ONE in levels or WILDCARD_ALL in levels:
+                continue
+            for i in range(len(levels)):
+                if not levels[i]:
+                    continue
+                # /strip/+ would also match what is published under /strip
+                if i == len(levels) - 1 and "/".join(levels[:i]) in topics:
+                    continue
+                folded = "/".join(levels[:i] + [WILDCARD_ONE] + levels[i + 1:])
+                groups[folded].add(topic)
+        # filters must not overlap: brokers deliver a message once for every
+        # subscription that matches it
+        for folded in list(groups):
+            if any(topic_matches(folded, topic) for topic in covered):
+                del groups[folded]
+        if not groups:
+            break
+        best_filter, best_topics = max(
+            groups.items(), key=lambda group: (len(group[1]), group[0])
+        )
+        if len(best_topics) < 2:
+            break
+        filters.append(best_filter)
+        uncovered -= best_topics
+        covered |= best_topics
+    return sorted(filters) + sorted(uncovered)
@@ -0,0 +1,149 @@
+#!/usr/bin/env python
+import asyncio
+import heapq
+import itertools
+import time
+from typing import Awaitable, Callable, Optional
+
+from mqtt2kasa import const
+from mqtt2kasa import log
+
+logger = log.getLogger()
+
+
+class PollJob:
+    """A periodic device query, run by the PollScheduler.
+
+    poll is called without arguments and returns how many seconds to wait
+    before it runs again, or None to stop polling. A poll that raises runs
+    again after the last interval it returned, initially interval.
+    """
+
+    __slots__ = ("name", "poll", "interval", "due", "scheduler")
+
+    def __init__(
+        self,
+        name: str,
+        poll: Callable[[], Awaitable[Optional[float]]],
+        interval: float = const.KASA_DEFAULT_POLL_INTERVAL,
+    ):
+        self.name = name
+        self.poll = poll
+        self.interval = interval
+        self.due: Optional[float] = None  # None while running or not scheduled
+        self.scheduler: Optional["PollScheduler"] = None
+
+    def reschedule(self, delay: float):
+        """Run no later than delay seconds from now."""
+        if self.scheduler:
+            self.scheduler.reschedule(self, delay)
+
+
+class SlipStats:
+    def __init__(self):
+        self.reset()
+
+    def reset(self):
+        self.started_ts = time.monotonic()
+        self.polls = 0
+        self.slip_total = 0.0
+        self.slip_max = 0.0
+
+    def record(self, slip: float):
+        self.polls += 1
+        self.slip_total += slip
+        self.slip_max = max(self.slip_max, slip)
+
+    @property
+    def due(self) -> bool:
+        return time.monotonic() - self.started_ts >= const.KASA_POLL_STATS_INTERVAL
+
+    def summary(self) -> str:
+        return (
+            f"polls:{self.polls}"
+            f" slip avg:{self.slip_total / max(1, self.polls) * 1000:.1f}ms"
+            f" max:{self.slip_max * 1000:.1f}ms"
+        )
+
+
+class PollScheduler:
+    """Runs the polls of every device from a single queue ordered by due time.
+
+    A bounded pool of workers runs the polls that are due, which caps how
+    many devices are queried at once. Slip is how late a poll started
+    compared to when it was due.
+    """
+
+    def __init__(self, workers: int):
+        self.workers = max(1, workers)
+        self.stats = SlipStats()
+        self._heap = []
+        self._seq = itertools.count()
+        self._head_changed = asyncio.Event()
+        self._ready_q = asyncio.Queue()
+
+    def __len__(self):
+        return sum(1 for due, _, job in self._heap if job.due == due)
+
+    def add(self, job: PollJob, delay: float = 0.0):
+        job.scheduler = self
+        self._push(job, time.monotonic() + delay)
+
+    def remove(self, job: PollJob):
+        # heap entries of the job are skipped once they are popped
+        job.scheduler = None
+        job.due = None
+
+    def reschedule(self, job: PollJob, delay: float):
+        due = time.monotonic() + delay
+        # a running job is not in the heap. It comes back when it is done
+        if job.due is not None and due < job.due:
+            self._push(job, due)
+
+    def _push(self, job: PollJob, due: float):
+        job.due = due
+        heapq.heappush(self._heap, (due, next(self._seq), job))
+        if self._heap[0][2] is job:
+            self._head_changed.set()
+
+    async def run(self):
+        workers = [self._worker() for _ in range(self.workers)]
+        await asyncio.gather(self._dispatch(), *workers)
+
+    async def _dispatch(self):
+        while True:
+            now = time.monotonic()
+            while self._heap and self._heap[0][0] <= now:
+                due, _, job = heapq.heappop(self._heap)
+                if job.due != due:
+                    # rescheduled or removed since this entry was pushed
+                    continue
+                job.due = None
+                self._ready_q.put_nowait((job, due))
+
+            if self.stats.due:
+                logger.info(f"Poll scheduler stats: {self.stats.summary()}")
+                self.stats.reset()
+
+            timeout = self._heap[0][0] - now if self._heap else None
+            self._head_changed.clear()
+            try:
+                await asyncio.wait_for(self._head_changed.wait(), timeout)
+            except asyncio.TimeoutError:
+                pass
+
+    async def _worker(self):
+        while True:
+            job, due = await self._ready_q.get()
+            slip = time.monotonic() - due
+            self.stats.record(slip)
+            if slip > const.KASA_POLL_SLIP_WARNING:
+                logger.debug(f"Poll of {job.name} started {slip:.2f} seconds late")
+            try:
+                interval = job.interval = await job.poll()
+            except Exception as e:
+                # one bad device must not stop the polls of all the others
+                logger.error(f"Poll of {job.name} failed", exc_info=e)
+                interval = job.interval
+            if interval is not None and job.scheduler is self:
+                self._push(job, time.monotonic() + interval)
@@ -0,0 +1,66 @@
+#!/usr/bin/env python
+import asyncio
+from typing import Dict
+
+from mqtt2kasa import log
+from mqtt2kasa import metrics
+from mqtt2kasa.events import MqttMsgEvent
+from mqtt2kasa.router import TopicRouter
+
+logger = log.getLogger()
+
+
+class EventShards:
+    """Main events, split into one bounded queue per device.
+
+    Each queue has its own worker, so the events of a device are handled in
+    order, and a device whose events are slow to handle, e.g. because
+    publishing is slow, only holds up itself. Events that belong to no
+    device go to the shared queue.
+    """
+
+    SHARED = ""
+
+    def __init__(self, router: TopicRouter, maxsize: int):
+        self.router = router
+        self.maxsize = maxsize
+        self.queues: Dict[str, metrics.MeteredQueue] = {}
+        self.dropped = 0
+        self.queue(self.SHARED)
+
+    def queue(self, name: str) -> metrics.MeteredQueue:
+        queue = self.queues.get(name)
+        if queue is None:
+            queue = self.queues[name] = metrics.MeteredQueue(self.maxsize)
+            metrics.track_queue(queue, "events", name or "shared")
+        return queue
+
+    def remove(self, name: str):
+        """Forget the queue of a device. Events still in it are dropped."""
+        self.queues.pop(name, None)
+        metrics.untrack_queue("events", name)
+
+    def _queue_of(self, name: str) -> metrics.MeteredQueue:
+        # the device may be gone by the time its event shows up
+        return self.queues.get(name) or self.queues[self.SHARED]
+
+    async def put(self, event):
+        """Queue a device event, waiting while the queue of its device is full."""
+        await self._queue_of(event.name).put(event)
+
+    def put_mqtt(self, mqtt_msg: MqttMsgEvent):
+        """Queue an inbound mqtt message without waiting.
+
+        The mqtt reader serves every device, so it must not wait on any one
+        of them. Messages for a device whose queue is full are dropped.
+        """
+        route = self.router.match(mqtt_msg.topic)
+        name = route.name if route else self.SHARED
+        try:
+            self._queue_of(name).put_nowait(mqtt_msg)
+        except asyncio.QueueFull:
+            self.dropped += 1
+            logger.warning(
+                f"Events of {name or 'shared'} queue are backed up."
+                f" Dropping mqtt message for {mqtt_msg.topic}"
+            )
@@ -0,0 +1,256 @@
+#!/usr/bin/env python
+"""End to end benchmark of the bridge against simulated devices.
+
+Starts N simulated plugs (fake_kasa.py) and an mqtt broker stand-in
+(fake_broker.py) on loopback addresses, runs the bridge in this process and
+reports:
+
+- command latency: mqtt command published -> device written
+- status latency: mqtt command published -> <topic>/status published
+- detection latency: device changed outside of mqtt -> new state published
+- commands and broker messages per second during a burst of commands
+
+    python -m mqtt2kasa.tests.bench.e2e_bench --devices 8 --rounds 50
+
+Settings under mqtt, knobs and globals of --config, e.g.
+data/config.yaml.vagrant, are used for the run; locations and addresses are
+always the simulated ones. Any 127.x.y.z address must reach the local host,
+as it does on linux.
+"""
+import argparse
+import asyncio
+import json
+import logging
+import time
+from typing import Callable, Dict, List, Optional
+
+import yaml
+from aiomqtt import Client
+
+from mqtt2kasa import log
+from mqtt2kasa import main as bridge
+from mqtt2kasa.config import Cfg
+from mqtt2kasa.tests.bench.fake_broker import FakeBroker
+from mqtt2kasa.tests.bench.fake_kasa import FakeKasa
+
+BROKER_HOST = "127.0.1.1"
+DEVICE_HOST_FORMAT = "127.0.2.{}"
+TIMEOUT = 30  # [seconds] for anything the bridge is waited on for
+
+
+def bench_config(devices: int, poll_interval: float, base: Optional[Dict] = None):
+    base = base or {}
+    cfg_globals = dict(base.get("globals") or {})
+    cfg_globals.update(
+        {
+            "poll_interval": poll_interval,
+            "alias_cache_file": "",
+            "metrics_port": 0,
+        }
+    )
+    # the device throttler would dominate every number below
+    cfg_globals.setdefault("throttle_rate_limit", 0)
+    mqtt = dict(base.get("mqtt") or {})
+    mqtt.update({"host": BROKER_HOST, "client_id": "mqtt2kasa-bench"})
+    return {
+        "mqtt": mqtt,
+        "knobs": base.get("knobs") or {},
+        "globals": cfg_globals,
+        "locations": {
+            f"dev{i}": {
+                "host": DEVICE_HOST_FORMAT.format(i + 1),
+                "topic": f"/dev{i}/switch",
+            }
+            for i in range(devices)
+        },
+    }
+
+
+def percentile(values: List[float], pct: float) -> float:
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, round(pct / 100 * (len(ordered) - 1)))]
+
+
+def latency_line(label: str, values: List[float]) -> str:
+    return (
+        f"{label:18} p50 {percentile(values, 50) * 1000:8.1f}ms"
+        f"  p99 {percentile(values, 99) * 1000:8.1f}ms  ({len(values)} samples)"
+    )
+
+
+class Observer:
+    """Watches every topic and resolves waiters with the arrival time."""
+
+    def __init__(self):
+        self.waiters = []
+
+    def wait_for(self, topic: str, predicate: Callable[[str], bool]):
+        future = asyncio.get_running_loop().create_future()
+        self.waiters.append((topic, predicate, future))
+        return future
+
+    async def run(self, client: Client, subscribed: asyncio.Event):
+        async with client.messages() as messages:
+            await client.subscribe("#")
+            subscribed.set()
+            async for message in messages:
+                arrived = time.monotonic()
+                payload = message.payload.decode()
+                for waiter in list(self.waiters):
+                    topic, predicate, future = waiter
+                    if topic == message.topic.value and predicate(payload):
+                        self.waiters.remove(waiter)
+                        if not future.done():
+                            future.set_result(arrived)
+
+
+def state_name(relay_state: int) -> str:
+    return "on" if relay_state else "off"
+
+
+def status_is(state: str) -> Callable[[str], bool]:
+    return lambda payload: json.loads(payload).get("state") == state
+
+
+def device_written(device: FakeKasa):
+    future = asyncio.get_running_loop().create_future()
+
+    def on_write(written: FakeKasa):
+        written.on_write = None
+        if not future.done():
+            future.set_result(written.relay_writes[-1])
+
+    device.on_write = on_write
+    return future
+
+
+async def measure_commands(client, observer, devices, topics, rounds):
+    command_latency, status_latency = [], []
+    for i in range(rounds):
+        device, topic = devices[i % len(devices)], topics[i % len(devices)]
+        state = state_name(not device.relay_state)
+        written = device_written(device)
+        status = observer.wait_for(f"{topic}/status", status_is(state))
+        started = time.monotonic()
+        await client.publish(topic, state)
+        command_latency.append(await asyncio.wait_for(written, TIMEOUT) - started)
+        status_latency.append(await asyncio.wait_for(status, TIMEOUT) - started)
+    return command_latency, status_latency
+
+
+async def measure_detection(observer, devices, topics, rounds):
+    detection_latency = []
+    for _ in range(rounds):
+        waiters = []
+        for device, topic in zip(devices, topics):
+            relay_state = int(not device.relay_state)
+            waiters.append(
+                observer.wait_for(topic, lambda p, s=state_name(relay_state): p == s)
+            )
+            device.set_relay_state(relay_state)
+        started = time.monotonic()
+        for arrived in await asyncio.wait_for(asyncio.gather(*waiters), TIMEOUT):
+            detection_latency.append(arrived - started)
+    return detection_latency
+
+
+async def measure_burst(client, broker, devices, topics, per_device):
+    # an odd number of commands per device leaves every device flipped
+    per_device |= 1
+    final_states = [int(not device.relay_state) for device in devices]
+    broker_before = broker.received + broker.delivered
+    started = time.monotonic()
+    for i in range(per_device):
+        for device, topic, final_state in zip(devices, topics, final_states):
+            state = final_state if i % 2 == 0 else int(not final_state)
+            await client.publish(topic, state_name(state))
+    while any(d.relay_state != s for d, s in zip(devices, final_states)):
+        if time.monotonic() - started > TIMEOUT:
+            raise asyncio.TimeoutError("devices did not reach their final state")
+        await asyncio.sleep(0.001)
+    elapsed = time.monotonic() - started
+    commands = per_device * len(devices)
+    broker_messages = broker.received + broker.delivered - broker_before
+    return commands, elapsed, broker_messages
+
+
+async def run(args):
+    base = None
+    if args.config:
+        with open(args.config, "r") as ymlfile:
+            base = yaml.safe_load(ymlfile)
+    Cfg._parse_raw_cfg(bench_config(args.devices, args.poll_interval, base))
+
+    broker = FakeBroker(BROKER_HOST)
+    await broker.start()
+    devices = [
+        FakeKasa(DEVICE_HOST_FORMAT.format(i + 1), f"Bench plug {i}", args.device_latency)
+        for i in range(args.devices)
+    ]
+    for device in devices:
+        await device.start()
+    topics = [f"/dev{i}/switch" for i in range(args.devices)]
+
+    observer = Observer()
+    subscribed = asyncio.Event()
+    async with Client(BROKER_HOST, client_id="mqtt2kasa-bench-driver") as client:
+        observer_task = asyncio.create_task(observer.run(client, subscribed))
+        await subscribed.wait()
+        ready = [observer.wait_for(topic, lambda p: p == "off") for topic in topics]
+        started = time.monotonic()
+        bridge_task = asyncio.create_task(bridge.main())
+        try:
+            await asyncio.wait_for(asyncio.gather(*ready), TIMEOUT)
+            startup = time.monotonic() - started
+            command_latency, status_latency = await measure_commands(
+                client, observer, devices, topics, args.rounds
+            )
+            detection_latency = await measure_detection(
+                observer, devices, topics, args.detections
+            )
+            commands, elapsed, broker_messages = await measure_burst(
+                client, broker, devices, topics, args.burst
+            )
+        finally:
+            bridge_task.cancel()
+            observer_task.cancel()
+            await asyncio.gather(bridge_task, observer_task, return_exceptions=True)
+    for device in devices:
+        device.stop()
+    broker.stop()
+
+    print(f"devices: {args.devices}  poll interval: {args.poll_interval}s")
+    print(f"{'startup':18} {startup * 1000:12.1f}ms")
+    print(latency_line("command latency", command_latency))
+    print(latency_line("status latency", status_latency))
+    print(latency_line("detection latency", detection_latency))
+    print(
+        f"{'burst':18} {commands} commands in {elapsed:.2f}s:"
+        f" {commands / elapsed:,.0f} commands/sec,"
+        f" {broker_messages / elapsed:,.0f} broker messages/sec"
+    )
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--devices", type=int, default=8)
+    parser.add_argument("--rounds", type=int, default=50, help="commands timed")
+    parser.add_argument(
+        "--detections", type=int, default=3, help="outside changes of every device"
+    )
+    parser.add_argument("--burst", type=int, default=5, help="commands per device")
+    parser.add_argument("--poll-interval", type=float, default=1.0)
+    parser.add_argument(
+        "--device-latency", type=float, default=0.0, help="seconds per device reply"
+    )
+    parser.add_argument("--config", help="yaml config to take settings from")
+    parser.add_argument("--verbose", action="store_true")
+    args = parser.parse_args()
+
+    bridge.logger = log.getLogger()
+    logging.basicConfig(level=logging.INFO if args.verbose else logging.WARNING)
+    asyncio.run(run(args))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,79 @@
+#!/usr/bin/env python
+"""Microbenchmark for the event types in mqtt2kasa.events.
+
+Compares the slotted events against the namedtuple-per-instance events they
+replaced, in events created and read per second and in bytes per event.
+
+    python -m mqtt2kasa.tests.bench.events_bench
+"""
+import time
+import tracemalloc
+from collections import namedtuple
+
+from mqtt2kasa.events import MqttMsgEvent
+
+ROUNDS = 50000
+
+
+class LegacyBaseEvent:
+    def __init__(self, expected_attrs, attrs):
+        self.event = self.__class__.__name__
+        self.attrs = self._dict_to_attrs(attrs)
+        self._check_expected_attrs(expected_attrs)
+
+    def __getattr__(self, attr):
+        try:
+            return getattr(self.attrs, attr)
+        except AttributeError as e:
+            raise AttributeError(
+                f"{self.event} object is missing {attr} attribute"
+            ) from e
+
+    def _check_expected_attrs(self, expected_attrs):
+        if expected_attrs:
+            for attr in expected_attrs:
+                getattr(self, attr)
+
+    @staticmethod
+    def _dict_to_attrs(params_dict):
+        cls = namedtuple("Attrs", params_dict)
+        cls.__new__.__defaults__ = tuple(params_dict.values())
+        return cls()
+
+
+class LegacyMqttMsgEvent(LegacyBaseEvent):
+    def __init__(self, **attrs):
+        expected_attrs = "topic", "payload"
+        super().__init__(expected_attrs, attrs)
+
+
+def events_per_sec(event_cls, rounds=ROUNDS) -> float:
+    started = time.perf_counter()
+    for i in range(rounds):
+        event = event_cls(topic="/foo/switch", payload="on")
+        event.topic, event.payload
+    return rounds / (time.perf_counter() - started)
+
+
+def bytes_per_event(event_cls, count=1000) -> float:
+    tracemalloc.start()
+    before, _ = tracemalloc.get_traced_memory()
+    events = [event_cls(topic="/foo/switch", payload="on") for _ in range(count)]
+    after, _ = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    del events
+    return (after - before) / count
+
+
+def main():
+    for label, event_cls in (
+        ("before (namedtuple)", LegacyMqttMsgEvent),
+        ("after (__slots__)", MqttMsgEvent),
+    ):
+        rate = events_per_sec(event_cls)
+        size = bytes_per_event(event_cls)
+        print(f"{label:20} {rate:12,.0f} events/sec {size:10,.0f} bytes/event")
+
+
+if __name__ == "__main__":
+    main()
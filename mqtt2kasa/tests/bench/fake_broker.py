@@ -0,0 +1,142 @@
+#!/usr/bin/env python
+"""Just enough of an mqtt 3.1.1 broker to run the bridge against.
+
+Handles connect, subscribe, unsubscribe, publish with qos 0 and 1, retained
+messages and pings. Messages are forwarded with qos 0.
+"""
+import asyncio
+import struct
+from typing import Dict, Set
+
+from mqtt2kasa.router import topic_matches
+
+CONNECT = 1
+CONNACK = 2
+PUBLISH = 3
+PUBACK = 4
+SUBSCRIBE = 8
+SUBACK = 9
+UNSUBSCRIBE = 10
+UNSUBACK = 11
+PINGREQ = 12
+PINGRESP = 13
+DISCONNECT = 14
+
+
+def _remaining_length(length: int) -> bytes:
+    encoded = bytearray()
+    while True:
+        byte, length = length % 128, length // 128
+        encoded.append(byte | 0x80 if length else byte)
+        if not length:
+            return bytes(encoded)
+
+
+def _packet(packet_type: int, flags: int, body: bytes) -> bytes:
+    return bytes([packet_type << 4 | flags]) + _remaining_length(len(body)) + body
+
+
+def _string(data: bytes, offset: int):
+    (length,) = struct.unpack_from(">H", data, offset)
+    offset += 2
+    return data[offset:offset + length], offset + length
+
+
+class _Session:
+    def __init__(self, writer):
+        self.writer = writer
+        self.subscriptions: Set[str] = set()
+
+    def send_publish(self, topic: bytes, payload: bytes, retain: bool = False):
+        body = struct.pack(">H", len(topic)) + topic + payload
+        self.writer.write(_packet(PUBLISH, 1 if retain else 0, body))
+
+
+class FakeBroker:
+    def __init__(self, host: str, port: int = 1883):
+        self.host = host
+        self.port = port
+        self.sessions: Set[_Session] = set()
+        self.retained: Dict[bytes, bytes] = {}
+        self.received = 0  # publishes from clients
+        self.delivered = 0  # publishes forwarded to subscribers
+        self._server = None
+
+    async def start(self):
+        self._server = await asyncio.start_server(self._serve, self.host, self.port)
+
+    def stop(self):
+        self._server.close()
+
+    async def _read_packet(self, reader):
+        first = (await reader.readexactly(1))[0]
+        length, multiplier = 0, 1
+        while True:
+            byte = (await reader.readexactly(1))[0]
+            length += (byte & 0x7F) * multiplier
+            multiplier *= 128
+            if not byte & 0x80:
+                break
+        body = await reader.readexactly(length) if length else b""
+        return first >> 4, first & 0x0F, body
+
+    async def _serve(self, reader, writer):
+        session = _Session(writer)
+        self.sessions.add(session)
+        try:
+            while True:
+                packet_type, flags, body = await self._read_packet(reader)
+                if packet_type == CONNECT:
+                    writer.write(_packet(CONNACK, 0, b"\x00\x00"))
+                elif packet_type == PUBLISH:
+                    self._publish(session, flags, body)
+                elif packet_type == SUBSCRIBE:
+                    self._subscribe(session, body)
+                elif packet_type == UNSUBSCRIBE:
+                    offset = 2
+                    while offset < len(body):
+                        topic, offset = _string(body, offset)
+                        session.subscriptions.discard(topic.decode())
+                    writer.write(_packet(UNSUBACK, 0, body[:2]))
+                elif packet_type == PINGREQ:
+                    writer.write(_packet(PINGRESP, 0, b""))
+                elif packet_type == DISCONNECT:
+                    break
+                await writer.drain()
+        except (asyncio.IncompleteReadError, ConnectionError, asyncio.CancelledError):
+            pass
+        finally:
+            self.sessions.discard(session)
+            writer.close()
+
+    def _publish(self, session: _Session, flags: int, body: bytes):
+        self.received += 1
+        topic, offset = _string(body, 0)
+        qos = (flags >> 1) & 0x03
+        if qos:
+            packet_id = body[offset:offset + 2]
+            offset += 2
+            session.writer.write(_packet(PUBACK, 0, packet_id))
+        payload = body[offset:]
+        if flags & 0x01:
+            self.retained[topic] = payload
+        topic_str = topic.decode()
+        for subscriber in self.sessions:
+            if any(topic_matches(f, topic_str) for f in subscriber.subscriptions):
+                subscriber.send_publish(topic, payload)
+                self.delivered += 1
+
+    def _subscribe(self, session: _Session, body: bytes):
+        packet_id, offset = body[:2], 2
+        granted = bytearray()
+        topic_filters = []
+        while offset < len(body):
+            topic_filter, offset = _string(body, offset)
+            offset += 1  # requested qos
+            topic_filters.append(topic_filter.decode())
+            granted.append(0)
+        session.subscriptions.update(topic_filters)
+        session.writer.write(_packet(SUBACK, 0, packet_id + bytes(granted)))
+        for topic, payload in self.retained.items():
+            if any(topic_matches(f, topic.decode()) for f in topic_filters):
+                session.send_publish(topic, payload, retain=True)
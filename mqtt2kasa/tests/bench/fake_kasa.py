@@ -0,0 +1,157 @@
+#!/usr/bin/env python
+"""Simulated kasa plugs that speak the legacy python-kasa protocol.
+
+Every device listens on its own loopback address, port 9999, for both the udp
+discovery query and the tcp commands. Requests and responses use the XOR
+autokey cipher, with a 4 byte length prefix on tcp. A device made with outlets
+is a power strip, whose outlets are addressed with a child_ids context.
+"""
+import asyncio
+import json
+import struct
+import time
+from typing import Callable, Dict, List, Optional
+
+KASA_PORT = 9999
+XOR_KEY = 171
+
+NOT_SUPPORTED = {"err_code": -1, "err_msg": "module not support"}
+
+
+def encrypt(plaintext: bytes) -> bytes:
+    key = XOR_KEY
+    ciphertext = bytearray()
+    for byte in plaintext:
+        key ^= byte
+        ciphertext.append(key)
+    return bytes(ciphertext)
+
+
+def decrypt(ciphertext: bytes) -> bytes:
+    key = XOR_KEY
+    plaintext = bytearray()
+    for byte in ciphertext:
+        plaintext.append(key ^ byte)
+        key = byte
+    return bytes(plaintext)
+
+
+class FakeKasa:
+    """One plug. relay_writes records when each set_relay_state arrived."""
+
+    def __init__(self, host: str, alias: str, latency: float = 0.0, outlets: int = 0):
+        self.host = host
+        self.latency = latency
+        self.relay_state = 0
+        self.relay_writes: List[float] = []
+        self.queries = 0
+        self.on_write: Optional[Callable[["FakeKasa"], None]] = None
+        self.sysinfo = {
+            "alias": alias,
+            "dev_name": "Smart Wi-Fi Plug",
+            "deviceId": "8006" + host.replace(".", "").rjust(36, "0"),
+            "err_code": 0,
+            "feature": "TIM",
+            "hwId": "22603EA5E716DEAEA6642A30BE87AFCA",
+            "hw_ver": "1.0",
+            "led_off": 0,
+            "mac": "50:c7:bf:%02x:%02x:%02x" % tuple(map(int, host.split(".")[1:])),
+            "mic_type": "IOT.SMARTPLUGSWITCH",
+            "model": "HS100(US)",
+            "oemId": "FFF22CFF774A0B89F7624BFC6F50D5DE",
+            "on_time": 0,
+            "relay_state": 0,
+            "rssi": -60,
+            "sw_ver": "1.2.5 Build 171213 Rel.101523",
+            "type": "IOT.SMARTPLUGSWITCH",
+            "updating": 0,
+        }
+        if outlets:
+            self.sysinfo["model"] = "HS300(US)"
+            self.sysinfo["children"] = [
+                {
+                    "id": f"{self.sysinfo['deviceId']}{i:02d}",
+                    "state": 0,
+                    "alias": f"Outlet {i}",
+                    "on_time": 0,
+                    "next_action": {"type": -1},
+                }
+                for i in range(outlets)
+            ]
+        self._servers = []
+
+    def set_relay_state(self, state: int, child_ids: Optional[List[str]] = None):
+        """Change the relay without going through the bridge."""
+        for child in self.sysinfo.get("children", []):
+            if child_ids is None or child["id"] in child_ids:
+                child["state"] = state
+        if child_ids is None:
+            self.relay_state = state
+            self.sysinfo["relay_state"] = state
+
+    def handle(self, request: Dict) -> Dict:
+        self.queries += 1
+        response = {}
+        child_ids = request.pop("context", {}).get("child_ids")
+        for target, commands in request.items():
+            if target != "system":
+                response[target] = NOT_SUPPORTED
+                continue
+            result = response[target] = {}
+            for command, args in commands.items():
+                if command == "get_sysinfo":
+                    result[command] = dict(self.sysinfo)
+                elif command == "set_relay_state":
+                    self.set_relay_state(args["state"], child_ids)
+                    self.relay_writes.append(time.monotonic())
+                    if self.on_write:
+                        self.on_write(self)
+                    result[command] = {"err_code": 0}
+                else:
+                    result[command] = NOT_SUPPORTED
+        return response
+
+    async def start(self):
+        loop = asyncio.get_running_loop()
+        transport, _ = await loop.create_datagram_endpoint(
+            lambda: _DiscoveryProtocol(self), local_addr=(self.host, KASA_PORT)
+        )
+        server = await asyncio.start_server(self._serve, self.host, KASA_PORT)
+        self._servers = [transport, server]
+
+    def stop(self):
+        for server in self._servers:
+            server.close()
+
+    async def _serve(self, reader, writer):
+        try:
+            while True:
+                header = await reader.readexactly(4)
+                (length,) = struct.unpack(">I", header)
+                request = json.loads(decrypt(await reader.readexactly(length)))
+                if self.latency:
+                    await asyncio.sleep(self.latency)
+                payload = json.dumps(self.handle(request)).encode()
+                writer.write(struct.pack(">I", len(payload)) + encrypt(payload))
+                await writer.drain()
+        except (asyncio.IncompleteReadError, ConnectionError, asyncio.CancelledError):
+            pass
+        finally:
+            writer.close()
+
+
+class _DiscoveryProtocol(asyncio.DatagramProtocol):
+    def __init__(self, device: FakeKasa):
+        self.device = device
+        self.transport = None
+
+    def connection_made(self, transport):
+        self.transport = transport
+
+    def datagram_received(self, data, addr):
+        try:
+            request = json.loads(decrypt(data))
+        except ValueError:
+            return
+        payload = json.dumps(self.device.handle(request)).encode()
+        self.transport.sendto(encrypt(payload), addr)
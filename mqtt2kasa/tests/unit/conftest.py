@@ -0,0 +1,17 @@
+import pytest
+
+from mqtt2kasa.config import Cfg
+
+
+@pytest.fixture
+def parse():
+    # Cfg is shared by every test module, so leave it as it was found
+    saved = Cfg._info
+    yield Cfg._parse_raw_cfg
+    Cfg._info = saved
+
+
+@pytest.fixture
+def foo_cfg(parse):
+    """A config with a single location, foo."""
+    parse({"locations": {"foo": {"host": "127.0.0.1"}}})
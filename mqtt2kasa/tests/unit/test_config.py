@@ -0,0 +1,185 @@
+import pytest
+
+from mqtt2kasa import const
+from mqtt2kasa.config import Cfg, ConfigError
+
+
+def test_locations_are_resolved(parse):
+    parse(
+        {
+            "globals": {
+                "topic_format": "/{}/switch",
+                "poll_interval": 11,
+                "throttle_rate_limit": 0,
+                "emeter_deadband": {"power": 2, "voltage": 1},
+                "receive_queue_size": 8,
+            },
+            "locations": {
+                "lamp": {"host": "10.0.0.1"},
+                "pantry": {
+                    "alias": "storage",
+                    "topic": "/kitchen/{}",
+                    "poll_interval": 120,
+                    "max_poll_interval": 60,
+                    "emeter_deadband": {"power": 5},
+                    "receive_queue_size": 4,
+                },
+            },
+        }
+    )
+    lamp, pantry = Cfg().locations["lamp"], Cfg().locations["pantry"]
+    assert lamp.topic == "/lamp/switch"
+    assert (lamp.host, lamp.alias) == ("10.0.0.1", None)
+    assert lamp.poll_interval == lamp.max_poll_interval == 11.0
+    assert lamp.throttle_rate_limit == 0.0
+    assert lamp.throttle_period == const.KASA_DEFAULT_THROTTLE_PERIOD
+    assert dict(lamp.emeter_deadband) == {"power": 2.0, "voltage": 1.0}
+    assert pantry.topic == "/kitchen/pantry"
+    assert pantry.poll_interval == pantry.max_poll_interval == 120.0
+    assert dict(pantry.emeter_deadband) == {"power": 5.0, "voltage": 1.0}
+
+    with pytest.raises(AttributeError):
+        lamp.poll_interval = 1
+    with pytest.raises(TypeError):
+        lamp.emeter_deadband["power"] = 1
+
+
+def test_all_errors_are_reported(parse):
+    with pytest.raises(ConfigError) as exc_info:
+        parse(
+            {
+                "mqtt": {"qos": 3},
+                "globals": {"poll_interval": "ten"},
+                "locations": {
+                    "lamp": {"host": "10.0.0.1", "topic": "/lamp"},
+                    "fan": {"host": "10.0.0.2", "topic": "/lamp"},
+                    "heater": {"alias": "heater", "poll_intervall": 3},
+                    "nowhere": {"throttle_period": True},
+                },
+                "keep_alives": {"toaster": {"interval": 10, "timeout": 60}},
+            }
+        )
+    assert exc_info.value.errors == [
+        "mqtt.qos: must be 0, 1 or 2",
+        "globals.poll_interval: must be a number",
+        "locations.heater: unknown attribute poll_intervall",
+        "locations.nowhere.throttle_period: must be a number",
+        "locations.nowhere: needs a host or an alias",
+        "keep_alives.toaster: there is no location named toaster",
+        "keep_alives.toaster: missing attribute publish_topic",
+        "keep_alives.toaster: missing attribute subscribe_topic",
+        "topic /lamp is used by both lamp and fan",
+    ]
+
+
+def test_reload_keeps_config_on_error(parse, tmp_path, monkeypatch):
+    cfg_file = tmp_path / "config.yaml"
+    cfg_file.write_text(
+        "mqtt:\n  host: broker\nlocations:\n  lamp:\n    host: 10.0.0.1\n"
+    )
+    monkeypatch.setattr("sys.argv", ["mqtt2kasa", str(cfg_file)])
+    parse({"mqtt": {"host": "old"}, "locations": {"lamp": {"host": "10.0.0.9"}}})
+
+    old_info = Cfg.reload()
+    assert Cfg().locations["lamp"].host == "10.0.0.1"
+    assert Cfg().startup_settings_changed(old_info) == ["mqtt.host"]
+
+    cfg_file.write_text("locations:\n  lamp:\n    hots: 10.0.0.2\n")
+    with pytest.raises(ConfigError):
+        Cfg.reload()
+    assert Cfg().locations["lamp"].host == "10.0.0.1"
+
+
+def test_outlets_are_nested_under_their_strip(parse):
+    parse(
+        {
+            "locations": {
+                "strip": {"host": "10.0.0.5"},
+                "lamp": {"strip": "strip", "outlet": 2},
+            }
+        }
+    )
+    lamp = Cfg().locations["lamp"]
+    assert (lamp.topic, lamp.strip, lamp.outlet) == ("/kasa/device/strip/lamp", "strip", 2)
+
+    with pytest.raises(ConfigError) as e:
+        parse(
+            {
+                "locations": {
+                    "lamp": {"strip": "strip", "outlet": 0, "host": "10.0.0.6"},
+                    "fan": {"strip": "nowhere", "outlet": "Fan"},
+                    "heater": {"strip": "fan", "outlet": 1},
+                    "radio": {"host": "10.0.0.7", "outlet": 1},
+                }
+            }
+        )
+    assert e.value.errors == [
+        "locations.lamp: an outlet takes host and alias from its strip",
+        "locations.radio: outlet needs the strip it is on",
+        "locations.fan.strip: there is no location named nowhere",
+        "locations.heater.strip: fan is an outlet itself",
+    ]
+
+
+def test_outlets_must_not_take_the_topics_of_their_strip(parse):
+    with pytest.raises(ConfigError) as e:
+        parse(
+            {
+                "locations": {
+                    "strip": {"host": "10.0.0.5"},
+                    "status": {"strip": "strip", "outlet": 0},
+                    "lamp": {"host": "10.0.0.6", "topic": "/kasa/device/strip/emeter/x"},
+                }
+            }
+        )
+    assert e.value.errors == [
+        "topic /kasa/device/strip/status of status collides with the status"
+        " topic of strip",
+        "topic /kasa/device/strip/emeter/x of lamp collides with the emeter"
+        " topic of strip",
+    ]
+
+
+def test_groups(parse):
+    parse(
+        {
+            "locations": {"a": {"host": "10.0.0.1"}, "b": {"host": "10.0.0.2"}},
+            "groups": {"both": ["a", "b"], "one": {"members": ["a"], "topic": "/one"}},
+        }
+    )
+    assert Cfg().groups["both"].topic == "/kasa/device/both"
+    assert Cfg().groups["one"].members == ("a",)
+
+    with pytest.raises(ConfigError) as e:
+        parse(
+            {
+                "locations": {"a": {"host": "10.0.0.1", "topic": "/x"}},
+                "groups": {"a": ["a"], "none": [], "bad": ["c"], "x": {"topic": "/x"}},
+            }
+        )
+    assert e.value.errors == [
+        "groups.a: there is a location with the same name",
+        "groups.none: needs at least one member",
+        "groups.bad: there is no location named c",
+        "groups.x: needs at least one member",
+    ]
+
+
+def test_settings_are_resolved_once(parse):
+    parse(
+        {
+            "mqtt": {"host": "broker", "publish_max_inflight": 0},
+            "knobs": {"instrumentation": True},
+            "globals": {"init_concurrency": 4, "alias_cache_file": ""},
+            "locations": {"lamp": {"host": "10.0.0.1"}},
+        }
+    )
+    settings = Cfg()._get_info().settings
+    assert Cfg().mqtt_host == settings.mqtt_host == "broker"
+    assert Cfg().mqtt_publish_max_inflight == 1
+    assert Cfg().mqtt_qos == 0
+    assert Cfg().instrumentation is True
+    assert Cfg().instrumentation_lag_interval == const.INSTRUMENTATION_DEFAULT_LAG_INTERVAL
+    assert Cfg().init_concurrency == 4
+    assert Cfg().group_concurrency == const.KASA_DEFAULT_GROUP_CONCURRENCY
+    assert Cfg().alias_cache_file is None
@@ -0,0 +1,61 @@
+import math
+
+from mqtt2kasa.emeter import (
+    EmeterFilter,
+    EmeterReading,
+    EmeterRing,
+    EmeterWindows,
+    window_label,
+)
+
+
+def test_deadband_and_max_age():
+    emeter_filter = EmeterFilter({"power": 2.0, "total": 0.01}, max_age=60)
+    reading = EmeterReading(power=10.0, voltage=120.0, current=0.1, total=1.0)
+    assert emeter_filter.changed_fields(reading, now=0) == list(reading._fields)
+
+    reading = reading._replace(power=11.5, total=1.005)
+    # fields without a deadband are always published
+    assert emeter_filter.changed_fields(reading, now=1) == ["voltage", "current"]
+
+    reading = reading._replace(power=12.5)
+    assert emeter_filter.changed_fields(reading, now=2) == [
+        "power",
+        "voltage",
+        "current",
+    ]
+
+    # heartbeat once max_age expires, even without change
+    assert "total" in emeter_filter.changed_fields(reading, now=61)
+    assert emeter_filter.suppressed == 4
+
+
+def test_reading_str_matches_emeter_status():
+    reading = EmeterReading(power=1.5, voltage=120.1, current=0.012, total=0.3)
+    assert str(reading) == (
+        "<EmeterStatus power=1.5 voltage=120.1 current=0.012 total=0.3>"
+    )
+
+
+def test_ring_keeps_the_latest_readings():
+    ring = EmeterRing(3)
+    for ts in range(5):
+        ring.append(ts, EmeterReading(power=ts, voltage=None, current=0, total=0))
+    assert [ring.ts[i] for i in ring.positions()] == [2, 3, 4]
+    assert math.isnan(ring.columns["voltage"][ring.positions()[0]])
+
+
+def test_windows_publish_once_per_window():
+    windows = EmeterWindows([60, 30], poll_interval=10)
+    closed = []
+    for ts in range(0, 130, 10):
+        reading = EmeterReading(power=ts, voltage=120.0, current=None, total=ts / 100)
+        closed += windows.add(ts, reading)
+    assert [label for label, _ in closed] == ["30s", "30s", "1m", "30s", "30s", "1m"]
+    label, minute = closed[5]
+    assert (minute["start"], minute["end"], minute["samples"]) == (60, 120, 6)
+    assert minute["power"] == {"min": 60, "max": 110, "avg": 85}
+    assert "current" not in minute
+    # from the last reading of the minute before
+    assert minute["energy"] == 0.6
+    assert window_label(90) == "90s" and window_label(3600) == "1h"
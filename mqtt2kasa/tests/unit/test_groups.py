@@ -0,0 +1,84 @@
+import asyncio
+
+import pytest
+
+from mqtt2kasa.config import Cfg
+from mqtt2kasa.events import KasaStateEvent
+from mqtt2kasa.groups import fan_out, group_command, group_status
+from mqtt2kasa.kasa_wrapper import Kasa, handle_kasa_requests
+
+pytestmark = pytest.mark.usefixtures("foo_cfg")
+
+
+class SlowDevice:
+    in_flight = 0
+    most_in_flight = 0
+
+    is_dimmable = has_emeter = False
+    brightness = emeter_realtime = None
+    children = []
+
+    def __init__(self, is_on):
+        self.is_on = is_on
+        self.updates = 0
+
+    async def update(self, update_children=True):
+        self.updates += 1
+
+    async def _set(self, is_on):
+        SlowDevice.in_flight += 1
+        SlowDevice.most_in_flight = max(SlowDevice.most_in_flight, SlowDevice.in_flight)
+        await asyncio.sleep(0.01)
+        SlowDevice.in_flight -= 1
+        self.is_on = is_on
+
+    async def turn_on(self):
+        await self._set(True)
+
+    async def turn_off(self):
+        await self._set(False)
+
+
+def _kasas(states):
+    kasas = []
+    for i, state in enumerate(states):
+        kasa = Kasa(Cfg().locations["foo"]._replace(name=f"dev{i}"))
+        kasa._device = SlowDevice(state)
+        kasa.curr_state = state
+        kasas.append(kasa)
+    return kasas
+
+
+class Events(list):
+    async def put(self, event):
+        self.append(event)
+
+
+def test_fan_out_is_concurrent_and_bounded():
+    kasas = _kasas([False] * 6 + [True])
+    assert group_command(kasas, "toggle") is False
+    assert group_command(kasas, "yes") is True
+    assert group_command(kasas, "maybe") is None
+    assert group_status("all", kasas)["state"] == "mixed"
+
+    async def run():
+        events = Events()
+        # an older command still pending loses to the group command
+        kasas[0].recv_q.put_nowait(KasaStateEvent(name="dev0", state=False))
+        workers = [
+            asyncio.create_task(handle_kasa_requests(kasa, events)) for kasa in kasas
+        ]
+        handled = await fan_out(kasas, True, concurrency=4, timeout=1)
+        for worker in workers:
+            worker.cancel()
+        return handled, events
+
+    handled, events = asyncio.run(run())
+    assert handled == kasas
+    assert SlowDevice.most_in_flight == 4
+    assert all(kasa._device.is_on for kasa in kasas)
+    # every write was read back, and the confirmed state published
+    assert [kasa._device.updates for kasa in kasas] == [1] * 6 + [0]
+    assert sorted(event.name for event in events) == [f"dev{i}" for i in range(6)]
+    status = group_status("all", kasas)
+    assert status["state"] == "on" and status["members"]["dev6"] == "on"
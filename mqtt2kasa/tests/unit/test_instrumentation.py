@@ -0,0 +1,60 @@
+import asyncio
+import logging
+import time
+
+from mqtt2kasa.instrumentation import Instrumentation, _SlowCallbackHandler
+
+
+async def handle_foo():
+    await asyncio.sleep(0.01)
+
+
+async def hog_the_loop():
+    time.sleep(0.05)
+
+
+def test_disabled_records_nothing():
+    instrumentation = Instrumentation()
+    started = instrumentation.start()
+    instrumentation.handler_done(handle_foo, started)
+    assert started is None
+    assert not instrumentation.handlers
+
+
+def test_handler_timing_and_slow_coroutines():
+    async def run():
+        instrumentation = Instrumentation()
+        instrumentation.configure(True, slow_threshold=0.02, lag_interval=0.01)
+        task = asyncio.create_task(instrumentation.run())
+        await asyncio.sleep(0.02)
+        for _ in range(3):
+            started = instrumentation.start()
+            await handle_foo()
+            instrumentation.handler_done(handle_foo, started)
+        await asyncio.create_task(hog_the_loop())
+        await asyncio.sleep(0.02)
+        task.cancel()
+        return instrumentation.report()
+
+    report = asyncio.run(run())
+    assert report["handlers"]["handle_foo"]["count"] == 3
+    assert report["handlers"]["handle_foo"]["avg_ms"] >= 10
+    assert report["slow_coroutines"]["hog_the_loop"]["max_ms"] >= 50
+    assert report["loop_lag"]["max_ms"] >= 20
+
+
+def test_unrelated_asyncio_records_are_ignored():
+    instrumentation = Instrumentation()
+    handler = _SlowCallbackHandler(instrumentation)
+    for msg, args in (
+        (ValueError("boom"), ()),
+        ("Executing %s", ("<Task>",)),
+        ("Executing %s took %.3f seconds", {"handle": "<Task>"}),
+    ):
+        handler.emit(logging.makeLogRecord({"msg": msg, "args": args}))
+    handler.emit(
+        logging.makeLogRecord(
+            {"msg": "Executing %s took %.3f seconds", "args": ("<Handle cb()>", 0.2)}
+        )
+    )
+    assert list(instrumentation.slow) == ["<Handle cb()>"]
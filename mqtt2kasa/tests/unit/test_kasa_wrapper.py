@@ -0,0 +1,394 @@
+import asyncio
+
+import pytest
+from kasa import Discover
+from kasa.smartdevice import SmartDeviceException
+
+from mqtt2kasa.alias_cache import AliasCache
+from mqtt2kasa.config import Cfg
+from mqtt2kasa.events import KasaBrightnessEvent, KasaStateEvent
+from mqtt2kasa.kasa_wrapper import (
+    CoalescingQueue,
+    Kasa,
+    apply_polled_states,
+    handle_kasa_requests,
+    poll_kasa,
+)
+
+pytestmark = pytest.mark.usefixtures("foo_cfg")
+
+
+class FakeDevice:
+    def __init__(self, is_on=True, brightness=None, emeter=None):
+        self.is_on = is_on
+        self.is_dimmable = brightness is not None
+        self.brightness = brightness
+        self.has_emeter = emeter is not None
+        self.emeter_realtime = emeter
+        self.children = []
+        self.updates = 0
+        self.disconnects = 0
+        self.unreachable = False
+
+    async def update(self, update_children=True):
+        self.updates += 1
+        if self.unreachable:
+            raise SmartDeviceException("unreachable")
+
+    async def turn_off(self):
+        if self.unreachable:
+            raise SmartDeviceException("unreachable")
+        self.is_on = False
+
+    async def disconnect(self):
+        self.disconnects += 1
+
+
+def _kasa(device):
+    kasa = Kasa(Cfg().locations["foo"])
+    kasa._device = device
+    return kasa
+
+
+def test_refresh_is_single_update():
+    async def run():
+        device = FakeDevice(is_on=True, brightness=42)
+        kasa = _kasa(device)
+        state = await kasa.refresh()
+        assert device.updates == 1
+        assert kasa.queries == 1
+        assert state.is_on and state.is_dimmable and state.brightness == 42
+        # properties read from the snapshot, not from the device
+        assert await kasa.is_on
+        assert await kasa.is_dimmable
+        assert await kasa.brightness == 42
+        assert await kasa.has_emeter is False
+        assert device.updates == 1
+
+    asyncio.run(run())
+
+
+def test_properties_refresh_when_no_snapshot():
+    async def run():
+        device = FakeDevice(is_on=False)
+        kasa = _kasa(device)
+        assert await kasa.is_on is False
+        assert await kasa.brightness is None
+        assert device.updates == 1
+
+    asyncio.run(run())
+
+
+def test_aliases_resolved_by_one_broadcast(monkeypatch, tmp_path):
+    broadcasts = []
+
+    class NamedDevice(FakeDevice):
+        def __init__(self, alias):
+            super().__init__()
+            self.alias = alias
+            self.mac = "00:00:00:00:00:01"
+
+    async def discover():
+        broadcasts.append(1)
+        await asyncio.sleep(0)
+        return {"10.0.0.1": NamedDevice("one"), "10.0.0.2": NamedDevice("two")}
+
+    monkeypatch.setattr(Discover, "discover", discover)
+    monkeypatch.setattr(Kasa, "_aliases", {"one", "two"})
+    monkeypatch.setattr(Kasa, "_devices_by_alias", {})
+    monkeypatch.setattr(
+        Kasa, "_alias_cache", AliasCache(str(tmp_path / "alias_cache.json"))
+    )
+
+    async def run():
+        return await asyncio.gather(
+            Kasa._find_by_alias("a", "one"), Kasa._find_by_alias("b", "two")
+        )
+
+    (host_one, _), (host_two, _) = asyncio.run(run())
+    assert (host_one, host_two) == ("10.0.0.1", "10.0.0.2")
+    assert len(broadcasts) == 1
+    assert AliasCache(str(tmp_path / "alias_cache.json")).host("two") == "10.0.0.2"
+
+
+def test_broadcast_does_not_record_located_aliases(monkeypatch, tmp_path):
+    class NamedDevice(FakeDevice):
+        def __init__(self, alias):
+            super().__init__()
+            self.alias = alias
+            self.mac = "00:00:00:00:00:01"
+
+    network = {"10.0.0.1": NamedDevice("one"), "10.0.0.2": NamedDevice("two")}
+    broadcasts = []
+
+    async def discover():
+        broadcasts.append(1)
+        return dict(network)
+
+    async def discover_single(host):
+        return network[host]
+
+    alias_cache = AliasCache(str(tmp_path / "alias_cache.json"))
+    alias_cache.set("one", "10.0.0.1", "00:00:00:00:00:01")
+    monkeypatch.setattr(Discover, "discover", discover)
+    monkeypatch.setattr(Discover, "discover_single", discover_single)
+    monkeypatch.setattr(Kasa, "_aliases", {"one", "two"})
+    monkeypatch.setattr(Kasa, "_devices_by_alias", {})
+    monkeypatch.setattr(Kasa, "_alias_cache", alias_cache)
+
+    async def run():
+        assert (await Kasa._find_by_alias("a", "one"))[0] == "10.0.0.1"
+        assert (await Kasa._find_by_alias("b", "two"))[0] == "10.0.0.2"
+        assert not Kasa._devices_by_alias
+
+        # one moves, and is looked up again
+        network["10.0.0.3"] = network.pop("10.0.0.1")
+        Kasa._aliases.add("one")
+        alias_cache.discard("one")
+        assert (await Kasa._find_by_alias("a", "one"))[0] == "10.0.0.3"
+        assert len(broadcasts) == 2
+
+    asyncio.run(run())
+
+
+def test_alias_is_located_again_after_moving(monkeypatch, tmp_path):
+    class NamedDevice(FakeDevice):
+        alias = "mover"
+        model = "HS100"
+        mac = "00:00:00:00:00:01"
+
+    old, new = NamedDevice(), NamedDevice()
+    network = {"10.0.0.1": old}
+    broadcasts, singles = [], []
+
+    async def discover():
+        broadcasts.append(1)
+        return dict(network)
+
+    async def discover_single(host):
+        singles.append(host)
+        raise SmartDeviceException(f"{host} unreachable")
+
+    monkeypatch.setattr(Discover, "discover", discover)
+    monkeypatch.setattr(Discover, "discover_single", discover_single)
+    monkeypatch.setattr(Kasa, "_aliases", set())
+    monkeypatch.setattr(Kasa, "_devices_by_alias", {})
+    monkeypatch.setattr(
+        Kasa, "_alias_cache", AliasCache(str(tmp_path / "alias_cache.json"))
+    )
+
+    async def run():
+        location = Cfg().locations["foo"]._replace(name="mover", host=None, alias="mover")
+        kasa = Kasa(location)
+        assert await kasa.refresh(wait_backoff=False)
+        assert kasa.host == "10.0.0.1"
+
+        old.unreachable = True
+        network.clear()
+        for _ in range(3):
+            assert await kasa.refresh(wait_backoff=False) is None
+        # not found anywhere: the request fails, it does not raise
+        assert await kasa.refresh(wait_backoff=False) is None
+        assert kasa.host is None
+
+        network["10.0.0.2"] = new
+        assert await kasa.refresh(wait_backoff=False)
+        assert kasa.host == "10.0.0.2"
+        assert "10.0.0.1" not in singles
+
+    asyncio.run(run())
+
+
+def test_commands_are_coalesced():
+    async def run():
+        recv_q = CoalescingQueue()
+        recv_q.put_nowait(KasaStateEvent(name="foo", state=True))
+        recv_q.put_nowait(KasaBrightnessEvent(name="foo", brightness=10))
+        recv_q.put_nowait(KasaStateEvent(name="foo", state=False))
+        recv_q.put_nowait(KasaBrightnessEvent(name="foo", brightness=90))
+        assert recv_q.qsize() == 2
+        assert recv_q.coalesced == 2
+        first, second = await recv_q.get(), await recv_q.get()
+        assert (first.state, second.brightness) == (False, 90)
+        recv_q.task_done()
+        recv_q.task_done()
+        await asyncio.wait_for(recv_q.join(), 1)
+
+    asyncio.run(run())
+
+
+def test_poll_interval_backs_off_and_tightens():
+    kasa = _kasa(FakeDevice())
+    kasa.poll_interval = kasa.effective_poll_interval = 10
+    kasa.max_poll_interval = 30
+    for _ in range(5):
+        kasa.poll_done(changed=False)
+    assert kasa.effective_poll_interval == 30
+    kasa.poll_done(changed=True)
+    assert kasa.effective_poll_interval == 10
+    kasa.poll_done(changed=False)
+    assert kasa.effective_poll_interval == 15
+    kasa.tighten_polling()
+    assert kasa.effective_poll_interval == 10
+
+
+def test_session_is_reused_and_reopened_after_backoff():
+    async def run():
+        device = FakeDevice()
+        kasa = _kasa(device)
+        for _ in range(3):
+            assert await kasa.refresh()
+        assert (kasa.sessions, kasa.served) == (1, 3)
+
+        device.unreachable = True
+        assert await kasa.refresh() is None
+        assert not kasa.connected and device.disconnects == 1
+        # polls wait out the backoff without reaching the device
+        assert await kasa.refresh() is None
+        await poll_kasa(kasa, Events())
+        assert device.updates == 4
+        # and a poll that was not sent is not a failed poll
+        assert kasa.poll_fails == 0
+
+        device.unreachable = False
+        # commands do not wait
+        await kasa.turn_off()
+        assert kasa.curr_state is False
+        assert (kasa.sessions, kasa.served, kasa.fails) == (2, 4, 0)
+
+    asyncio.run(run())
+
+
+class FakeStrip(FakeDevice):
+    def __init__(self, *outlets):
+        super().__init__(is_on=any(outlet.is_on for outlet in outlets))
+        self.children = list(outlets)
+
+    def get_plug_by_index(self, index):
+        return self.children[index]
+
+    def get_plug_by_name(self, name):
+        for child in self.children:
+            if child.alias == name:
+                return child
+        raise SmartDeviceException(f"Device has no child with {name}")
+
+
+class Events(list):
+    async def put(self, event):
+        self.append(event)
+
+
+def test_strip_poll_covers_its_outlets():
+    async def run():
+        lamp, fan = FakeDevice(is_on=True), FakeDevice(is_on=False)
+        lamp.alias, fan.alias = "Lamp", "Fan"
+        strip_device = FakeStrip(lamp, fan)
+        strip = _kasa(strip_device)
+        foo = Cfg().locations["foo"]
+        outlets = [
+            Kasa(foo._replace(name=name, host=None, strip="foo", outlet=outlet))
+            for name, outlet in (("lamp", 0), ("fan", "Fan"))
+        ]
+        for outlet in outlets:
+            outlet.attach(strip)
+
+        events = Events()
+        await poll_kasa(strip, events)
+        assert strip_device.updates == 1
+        assert lamp.updates == fan.updates == 0
+        assert [(e.name, e.state) for e in events] == [
+            ("foo", True),
+            ("lamp", True),
+            ("fan", False),
+        ]
+        assert outlets[1].started
+
+        await outlets[1].turn_off()
+        assert fan.is_on is False and outlets[1].curr_state is False
+        assert (strip.sessions, strip.served) == (1, 2)
+
+    asyncio.run(run())
+
+
+def test_commands_wait_for_ready_and_writes_are_confirmed():
+    async def run():
+        device = FakeDevice(is_on=True)
+        kasa = _kasa(device)
+        events = Events()
+        requests = asyncio.create_task(handle_kasa_requests(kasa, events))
+        kasa.recv_q.put_nowait(KasaStateEvent(name="foo", state=False))
+        await asyncio.sleep(0)
+        assert not kasa.ready.is_set() and device.is_on
+
+        await kasa.refresh()
+        await apply_polled_states(kasa, events)
+        assert kasa.ready.is_set()
+        await asyncio.wait_for(kasa.recv_q.join(), 1)
+        requests.cancel()
+
+        assert device.is_on is False
+        # the write is read back, and the confirmed state is published
+        assert device.updates == 2
+        assert [(e.name, e.state) for e in events] == [("foo", True), ("foo", False)]
+
+        await kasa.stop()
+        assert not kasa.ready.is_set()
+
+    asyncio.run(run())
+
+
+def test_configure_keeps_what_did_not_change():
+    location = Cfg().locations["foo"]._replace(
+        throttle_rate_limit=5.0, emeter_windows=(60.0,)
+    )
+    kasa = Kasa(location)
+    throttler, emeter_filter, windows = (
+        kasa.throttler,
+        kasa.emeter_filter,
+        kasa.emeter_windows,
+    )
+    kasa.configure(location._replace(brightness_debounce=1.0))
+    assert kasa.brightness_debounce == 1.0
+    assert kasa.throttler is throttler
+    assert kasa.emeter_filter is emeter_filter
+    assert kasa.emeter_windows is windows
+
+    kasa.configure(kasa.location._replace(throttle_rate_limit=0.0))
+    assert kasa.throttler is not throttler
+    assert kasa.emeter_filter is emeter_filter
+
+
+def test_brightness_debounce_does_not_hold_up_other_commands():
+    async def run():
+        device = FakeDevice(is_on=True, brightness=10)
+        kasa = _kasa(device)
+        kasa.brightness_debounce = 0.1
+        written = []
+
+        async def set_brightness(brightness):
+            written.append(brightness)
+            device.brightness = brightness
+
+        device.set_brightness = set_brightness
+        events = Events()
+        await kasa.refresh()
+        await apply_polled_states(kasa, events)
+        requests = asyncio.create_task(handle_kasa_requests(kasa, events))
+
+        applied = asyncio.get_running_loop().create_future()
+        superseded = KasaBrightnessEvent(name="foo", brightness=20, applied=applied)
+        kasa.recv_q.put_nowait(superseded)
+        await asyncio.sleep(0.05)
+        kasa.recv_q.put_nowait(KasaBrightnessEvent(name="foo", brightness=30))
+        kasa.recv_q.put_nowait(KasaStateEvent(name="foo", state=False))
+        await asyncio.sleep(0.02)
+        # the state is not held up by the brightness waiting to settle
+        assert device.is_on is False and not written
+        assert applied.done()
+
+        await asyncio.wait_for(kasa.recv_q.join(), 1)
+        requests.cancel()
+        assert written == [30]
+
+    asyncio.run(run())
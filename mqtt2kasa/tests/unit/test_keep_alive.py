@@ -0,0 +1,53 @@
+import asyncio
+
+import pytest
+
+from mqtt2kasa.config import Cfg
+from mqtt2kasa.keep_alive import KeepAlive, KeepAliveEngine
+from mqtt2kasa.kasa_wrapper import Kasa
+
+pytestmark = pytest.mark.usefixtures("foo_cfg")
+
+
+def test_keep_alive_engine():
+    async def run():
+        kasa = Kasa(Cfg().locations["foo"])
+        ka = KeepAlive(
+            location_name="foo",
+            interval=10,
+            timeout=30,
+            publish_topic="/foo/ping",
+            subscribe_topic="/foo/pong",
+        )
+        engine = KeepAliveEngine()
+        engine.add(ka, kasa)
+        mqtt_send_q = asyncio.Queue()
+        task = asyncio.create_task(engine.run(mqtt_send_q))
+
+        # nothing is scheduled while the device is off
+        kasa.curr_state = False
+        assert ka.due is None
+        kasa.curr_state = True
+        assert ka.due == ka.last_send_ts + 10
+
+        # ping is due
+        ka.last_send_ts -= 10
+        engine.reschedule(ka)
+        await asyncio.sleep(0.01)
+        assert ka.keep_alives_counter == 1
+        assert mqtt_send_q.get_nowait().topic == "/foo/ping"
+        assert ka.due == ka.last_send_ts + 10
+
+        # no answer for too long
+        ka.last_receive_ts -= 30
+        engine.reschedule(ka)
+        await asyncio.sleep(0.01)
+        assert kasa.recv_q.get_nowait().state is False
+        msg = mqtt_send_q.get_nowait()
+        assert (msg.topic, msg.payload) == (kasa.topic, "off")
+
+        kasa.curr_state = False
+        assert ka.due is None and ka.keep_alives_counter == 0
+        task.cancel()
+
+    asyncio.run(run())
@@ -0,0 +1,221 @@
+import asyncio
+import json
+
+import pytest
+import yaml
+from aiomqtt import MqttError
+from kasa import Discover
+from kasa.smartdevice import SmartDeviceException
+
+from mqtt2kasa import log
+from mqtt2kasa import main
+from mqtt2kasa.emeter import EmeterReading
+from mqtt2kasa.events import KasaEmeterEvent
+from mqtt2kasa.kasa_wrapper import Kasa
+from mqtt2kasa.mqtt import PublishQueue
+
+
+class FakeDevice:
+    alias = "plug"
+    model = "HS220"
+    mac = "00:00:00:00:00:01"
+    has_emeter = False
+    emeter_realtime = None
+    children = []
+
+    def __init__(self, is_on=False, brightness=None):
+        self.is_on = is_on
+        self.is_dimmable = brightness is not None
+        self.brightness = brightness
+
+    async def update(self, update_children=True):
+        pass
+
+    async def disconnect(self):
+        pass
+
+
+class FakeClient:
+    def __init__(self, fail=False):
+        self.fail = fail
+        self.subscribed = []
+
+    async def subscribe(self, topic):
+        if self.fail:
+            raise MqttError("connection lost")
+        self.subscribed.append(topic)
+
+    async def unsubscribe(self, topic):
+        if self.fail:
+            raise MqttError("connection lost")
+        self.subscribed.remove(topic)
+
+
+@pytest.fixture
+def network(monkeypatch):
+    """Devices by host. Hosts that are not in it do not answer."""
+    devices = {}
+
+    async def discover_single(host):
+        if host not in devices:
+            raise SmartDeviceException(f"{host} unreachable")
+        return devices[host]
+
+    monkeypatch.setattr(Discover, "discover_single", discover_single)
+    monkeypatch.setattr(main, "logger", log.getLogger())
+    monkeypatch.setattr(Kasa, "_aliases", set())
+    return devices
+
+
+def test_init_survives_a_failed_subscribe(parse, network):
+    parse({"locations": {"lamp": {"host": "10.0.0.1"}}})
+    network["10.0.0.1"] = FakeDevice(brightness=50)
+
+    async def run():
+        run_state = main.create_run_state()
+        run_state.client = FakeClient(fail=True)
+        kasa = run_state.kasas["lamp"]
+        assert await main.init_kasa(kasa, run_state)
+        assert kasa.ready.is_set()
+        # routed, so the next mqtt session subscribes to it
+        assert run_state.router.match("/kasa/device/lamp/brightness")
+        assert not run_state.subscriptions
+
+    asyncio.run(run())
+
+
+def test_pending_device_is_retried(parse, network):
+    parse(
+        {
+            "globals": {"init_retry_interval": 0.01, "init_timeout": 1},
+            "locations": {"lamp": {"host": "10.0.0.1"}},
+        }
+    )
+
+    async def run():
+        run_state = main.create_run_state()
+        kasa = run_state.kasas["lamp"]
+        assert not await main.init_kasa(kasa, run_state)
+        task = asyncio.create_task(
+            main.handle_kasa_device(kasa, False, run_state, 0.0, 0.0)
+        )
+        await asyncio.sleep(0.05)
+        assert not kasa.ready.is_set()
+
+        network["10.0.0.1"] = FakeDevice(is_on=True)
+        await asyncio.wait_for(kasa.ready.wait(), 1)
+        assert kasa.curr_state is True and kasa.polling
+        task.cancel()
+        await asyncio.gather(task, return_exceptions=True)
+
+    asyncio.run(run())
+
+
+def test_reload_applies_only_what_changed(parse, network, tmp_path, monkeypatch, caplog):
+    def config(locations, host="broker"):
+        return {
+            "mqtt": {"host": host, "wildcard_subscriptions": False},
+            "globals": {"alias_cache_file": ""},
+            "locations": locations,
+        }
+
+    cfg_file = tmp_path / "config.yaml"
+    monkeypatch.setattr("sys.argv", ["mqtt2kasa", str(cfg_file)])
+    parse(config({"lamp": {"host": "10.0.0.1"}, "fan": {"host": "10.0.0.2"}}))
+    for i in (1, 2, 3):
+        network[f"10.0.0.{i}"] = FakeDevice()
+
+    async def run():
+        run_state = main.create_run_state()
+        client = run_state.client = FakeClient()
+        await run_state.sync_subscriptions()
+        lamp = run_state.kasas["lamp"]
+        assert await main.init_kasa(lamp, run_state)
+
+        cfg_file.write_text(
+            yaml.safe_dump(
+                config(
+                    {
+                        "lamp": {"host": "10.0.0.1", "poll_interval": 3},
+                        "heater": {"host": "10.0.0.3"},
+                    },
+                    host="new-broker",
+                )
+            )
+        )
+        await main.reload_config(run_state, PublishQueue())
+        assert set(run_state.kasas) == {"lamp", "heater"}
+        # retuned in place, with its state
+        assert run_state.kasas["lamp"] is lamp and lamp.ready.is_set()
+        assert lamp.poll_interval == 3
+        assert sorted(client.subscribed) == ["/kasa/device/heater", "/kasa/device/lamp"]
+        assert run_state.router.match("/kasa/device/fan") is None
+        await asyncio.wait_for(run_state.kasas["heater"].ready.wait(), 1)
+        assert "mqtt.host" in caplog.text
+
+        # losing the broker while resubscribing does not end the reload
+        client.fail = True
+        cfg_file.write_text(yaml.safe_dump(config({"lamp": {"host": "10.0.0.1"}})))
+        await main.reload_config(run_state, PublishQueue())
+        assert set(run_state.kasas) == {"lamp"}
+        await run_state.cancel_device_tasks()
+
+    asyncio.run(run())
+
+
+def test_state_is_published_again_after_reconnect(parse, network):
+    parse({"locations": {"lamp": {"host": "10.0.0.1"}}})
+    network["10.0.0.1"] = FakeDevice(is_on=True, brightness=40)
+
+    async def run():
+        run_state = main.create_run_state()
+        mqtt_send_q = PublishQueue(dedup_window=60)
+        main.start_events_worker(run_state, "lamp", mqtt_send_q)
+        events_q = run_state.main_events.queue("lamp")
+        assert await main.init_kasa(run_state.kasas["lamp"], run_state)
+        await events_q.join()
+
+        def published():
+            messages = []
+            while not mqtt_send_q.empty():
+                message = mqtt_send_q.get_nowait()
+                messages.append((message.topic, message.payload))
+            return sorted(messages)[:2]
+
+        expected = [("/kasa/device/lamp", "on"), ("/kasa/device/lamp/brightness", 40)]
+        assert published() == expected
+        # what the broker already has is not published twice
+        await main.republish_state(run_state)
+        await events_q.join()
+        assert published() == []
+        # a new session starts from scratch, as main_loop does on reconnect
+        mqtt_send_q.forget()
+        await main.republish_state(run_state)
+        await events_q.join()
+        assert published() == expected
+        await run_state.cancel_device_tasks()
+
+    asyncio.run(run())
+
+
+def test_emeter_payload_keeps_its_shape(parse, network):
+    parse({"locations": {"plug": {"host": "10.0.0.1"}}})
+
+    async def run():
+        run_state = main.create_run_state()
+        mqtt_send_q = PublishQueue()
+        reading = EmeterReading(power=12.5, voltage=120.1, current=0.1, total=3.0)
+        await main.handle_emeter_event_kasa(
+            KasaEmeterEvent(name="plug", emeter=reading), run_state, mqtt_send_q
+        )
+        messages = {}
+        while not mqtt_send_q.empty():
+            message = mqtt_send_q.get_nowait()
+            messages[message.topic] = message.payload
+        return messages
+
+    messages = asyncio.run(run())
+    payload = json.loads(messages["/kasa/device/plug/emeter"])
+    assert list(payload) == ["timestamp", "power", "voltage", "current", "total"]
+    assert payload["power"] == "12.5" and payload["total"] == "3.0"
+    assert messages["/kasa/device/plug/emeter/voltage"] == "120.1"
@@ -0,0 +1,52 @@
+import asyncio
+
+from mqtt2kasa import metrics
+
+
+def test_histogram_and_counter_render():
+    family = metrics.Family(
+        "test_duration_seconds", "Test durations", "histogram", ("device",)
+    )
+    histogram = family.labels("foo")
+    for value in (0.002, 0.02, 0.02, 60):
+        histogram.observe(value)
+    counter = metrics.Family("test_total", "Test events", "counter").labels()
+    counter.inc()
+    counter.inc(2)
+    queue = metrics.MeteredQueue()
+    for i in range(3):
+        queue.put_nowait(i)
+    queue.get_nowait()
+    metrics.track_queue(queue, "test")
+
+    lines = metrics.render().splitlines()
+    assert "# TYPE test_duration_seconds histogram" in lines
+    assert 'test_duration_seconds_bucket{device="foo",le="0.001"} 0' in lines
+    assert 'test_duration_seconds_bucket{device="foo",le="0.005"} 1' in lines
+    assert 'test_duration_seconds_bucket{device="foo",le="0.025"} 3' in lines
+    assert 'test_duration_seconds_bucket{device="foo",le="30.0"} 3' in lines
+    assert 'test_duration_seconds_bucket{device="foo",le="+Inf"} 4' in lines
+    assert 'test_duration_seconds_count{device="foo"} 4' in lines
+    assert "test_total 3" in lines
+    assert 'mqtt2kasa_queue_depth{queue="test"} 2' in lines
+    assert 'mqtt2kasa_queue_high_water{queue="test"} 3' in lines
+
+
+def test_scrape():
+    async def run():
+        metrics.count_published("/foo/switch/status")
+        server = await asyncio.start_server(metrics._handle_scrape, "127.0.0.1", 0)
+        port = server.sockets[0].getsockname()[1]
+        async with server:
+            reader, writer = await asyncio.open_connection("127.0.0.1", port)
+            writer.write(b"GET /metrics HTTP/1.1\r\nHost: localhost\r\n\r\n")
+            response = await reader.read()
+            writer.close()
+        head, body = response.split(b"\r\n\r\n", 1)
+        assert head.startswith(b"HTTP/1.0 200 OK")
+        assert (
+            b'mqtt2kasa_mqtt_messages_total{direction="out",topic_class="status"}'
+            in body
+        )
+
+    asyncio.run(run())
@@ -0,0 +1,109 @@
+import asyncio
+import time
+
+from mqtt2kasa.events import MqttMsgEvent, PRIORITY_KEEP_ALIVE, PRIORITY_TELEMETRY
+from mqtt2kasa.mqtt import PublishQueue, TokenBucket
+
+
+def test_token_bucket_burst_then_rate():
+    async def run():
+        bucket = TokenBucket(rate=50, burst=5)
+        started = time.monotonic()
+        for _ in range(5):
+            await bucket.acquire()
+        assert time.monotonic() - started < 0.05
+        for _ in range(5):
+            await bucket.acquire()
+        # five more tokens at 50/s take about 100ms to refill
+        assert time.monotonic() - started >= 0.09
+
+    asyncio.run(run())
+
+
+def test_publish_queue_dedup():
+    async def run():
+        q = PublishQueue(dedup_window=60)
+        status = '{{"name": "lamp", "state": "{}", "timestamp": {}}}'
+        await q.put(MqttMsgEvent(topic="/lamp/status", payload=status.format("on", 1)))
+        # only the timestamp differs
+        await q.put(MqttMsgEvent(topic="/lamp/status", payload=status.format("on", 2)))
+        await q.put(MqttMsgEvent(topic="/lamp/status", payload=status.format("off", 3)))
+        await q.put(MqttMsgEvent(topic="/lamp/switch", payload="off"))
+        await q.put(MqttMsgEvent(topic="/lamp/switch", payload="off"))
+        assert (q.sent, q.suppressed) == (3, 2)
+
+        # someone else changed the topic, so ours must go out again
+        q.observe("/lamp/switch", "on")
+        await q.put(MqttMsgEvent(topic="/lamp/switch", payload="off"))
+        # our own echo does not
+        q.observe("/lamp/switch", "off")
+        await q.put(MqttMsgEvent(topic="/lamp/switch", payload="off"))
+        assert (q.sent, q.suppressed) == (4, 3)
+        assert q.qsize() == 4
+
+    asyncio.run(run())
+
+
+def test_publish_queue_dedup_window():
+    async def run():
+        q = PublishQueue(dedup_window=0.05)
+        await q.put(MqttMsgEvent(topic="/lamp/switch", payload="on"))
+        await asyncio.sleep(0.06)
+        await q.put(MqttMsgEvent(topic="/lamp/switch", payload="on"))
+        assert (q.sent, q.suppressed) == (2, 0)
+
+        q = PublishQueue()
+        await q.put(MqttMsgEvent(topic="/lamp/switch", payload="on"))
+        await q.put(MqttMsgEvent(topic="/lamp/switch", payload="on"))
+        assert (q.sent, q.suppressed) == (2, 0)
+
+    asyncio.run(run())
+
+
+def test_publish_queue_keeps_repeated_pings():
+    async def run():
+        q = PublishQueue(dedup_window=60)
+        for _ in range(3):
+            await q.put(
+                MqttMsgEvent(
+                    topic="/ka/ping", payload="None", priority=PRIORITY_KEEP_ALIVE
+                )
+            )
+        assert (q.sent, q.suppressed) == (3, 0)
+
+    asyncio.run(run())
+
+
+def test_publish_queue_priorities():
+    async def run():
+        q = PublishQueue(maxsize=4, telemetry_maxsize=2)
+        await q.put(MqttMsgEvent("/lamp/emeter/power", "1", PRIORITY_TELEMETRY))
+        await q.put(MqttMsgEvent("/lamp/emeter/power", "2", PRIORITY_TELEMETRY))
+        await q.put(MqttMsgEvent("/lamp/ping", "ka", PRIORITY_KEEP_ALIVE))
+        # telemetry over its own limit drops the oldest telemetry
+        await q.put(MqttMsgEvent("/lamp/emeter/power", "3", PRIORITY_TELEMETRY))
+        assert q.depths() == [0, 1, 2]
+        assert q.dropped == [0, 0, 1]
+        # control makes room by dropping telemetry instead of waiting
+        await q.put(MqttMsgEvent("/lamp/switch", "on"))
+        await asyncio.wait_for(q.put(MqttMsgEvent("/lamp/switch/status", "{}")), 1)
+        assert q.depths() == [2, 1, 1]
+        assert q.dropped == [0, 0, 2]
+        # newer telemetry replaces the oldest when the queue is full
+        await q.put(MqttMsgEvent("/lamp/emeter/power", "4", PRIORITY_TELEMETRY))
+        assert q.dropped == [0, 0, 3]
+
+        payloads = [q.get_nowait().payload for _ in range(q.qsize())]
+        assert payloads == ["on", "{}", "ka", "4"]
+        for _ in payloads:
+            q.task_done()
+        await asyncio.wait_for(q.join(), 1)
+
+        # a full queue without telemetry to drop turns telemetry away
+        q = PublishQueue(maxsize=1, telemetry_maxsize=2)
+        await q.put(MqttMsgEvent("/lamp/switch", "on"))
+        await q.put(MqttMsgEvent("/lamp/emeter/power", "1", PRIORITY_TELEMETRY))
+        assert q.depths() == [1, 0, 0]
+        assert q.dropped == [0, 0, 1]
+
+    asyncio.run(run())
@@ -0,0 +1,64 @@
+from mqtt2kasa.router import (
+    ACTION_BRIGHTNESS,
+    ACTION_STATE,
+    Route,
+    TopicRouter,
+    fold_topics,
+    topic_matches,
+)
+
+
+def test_match_exact_and_wildcards():
+    router = TopicRouter()
+    router.add("/foo/switch", "foo", ACTION_STATE)
+    router.add("/foo/switch/brightness", "foo", ACTION_BRIGHTNESS)
+    router.add("/+/other", "any", ACTION_STATE)
+    router.add("/all/#", "all", ACTION_STATE)
+    assert router.match("/foo/switch") == Route("foo", ACTION_STATE)
+    assert router.match("/foo/switch/brightness") == Route("foo", ACTION_BRIGHTNESS)
+    assert router.match("/bar/other") == Route("any", ACTION_STATE)
+    assert router.match("/all") == Route("all", ACTION_STATE)
+    assert router.match("/all/x/y") == Route("all", ACTION_STATE)
+    assert router.match("/foo/switch/status") is None
+
+
+def test_remove_prunes_routes():
+    router = TopicRouter()
+    router.add("/foo/switch", "foo", ACTION_STATE)
+    router.add("/foo/switch/brightness", "foo", ACTION_BRIGHTNESS)
+    router.remove("/foo/switch")
+    assert router.match("/foo/switch") is None
+    assert router.match("/foo/switch/brightness") == Route("foo", ACTION_BRIGHTNESS)
+    router.remove("/foo/switch/brightness")
+    assert not router._root.children
+    assert len(router) == 0
+
+
+def test_fold_topics():
+    topics = [
+        "/a/switch",
+        "/b/switch",
+        "/c/switch",
+        "/a/switch/brightness",
+        "/b/switch/brightness",
+        "/kitchen/light",
+    ]
+    filters = fold_topics(topics)
+    assert filters == ["/+/switch", "/+/switch/brightness", "/kitchen/light"]
+    for topic in topics:
+        assert any(topic_matches(f, topic) for f in filters)
+
+
+def test_fold_topics_do_not_overlap():
+    topics = ["/a/s", "/b/s", "/c/s", "/a/x", "/a/y"]
+    filters = fold_topics(topics)
+    assert len(filters) == 3
+    for topic in topics:
+        assert sum(topic_matches(f, topic) for f in filters) == 1
+
+
+def test_fold_topics_keep_off_the_topics_of_a_device():
+    topics = ["/strip", "/strip/brightness", "/strip/lamp", "/strip/fan"]
+    filters = fold_topics(topics)
+    assert filters == sorted(topics)
+    assert not any(topic_matches(f, "/strip/status") for f in filters)
@@ -0,0 +1,80 @@
+import asyncio
+
+from mqtt2kasa.scheduler import PollJob, PollScheduler
+
+
+def test_polls_run_in_due_order_with_capped_concurrency():
+    async def run():
+        scheduler = PollScheduler(workers=2)
+        running = []
+        max_running = 0
+        polled = []
+
+        def make_poll(name):
+            async def poll():
+                nonlocal max_running
+                running.append(name)
+                max_running = max(max_running, len(running))
+                polled.append(name)
+                await asyncio.sleep(0.01)
+                running.remove(name)
+                return None
+
+            return poll
+
+        for i, name in enumerate("abcd"):
+            scheduler.add(PollJob(name, make_poll(name)), delay=0.01 * (4 - i))
+        task = asyncio.create_task(scheduler.run())
+        await asyncio.sleep(0.2)
+        task.cancel()
+        assert polled == ["d", "c", "b", "a"]
+        assert max_running <= 2
+        assert scheduler.stats.polls == 4
+
+    asyncio.run(run())
+
+
+def test_reschedule_pulls_poll_in():
+    async def run():
+        scheduler = PollScheduler(workers=1)
+        polled = asyncio.Event()
+
+        async def poll():
+            polled.set()
+            return 60
+
+        job = PollJob("slow", poll)
+        scheduler.add(job, delay=60)
+        task = asyncio.create_task(scheduler.run())
+        await asyncio.sleep(0.01)
+        assert not polled.is_set()
+        job.reschedule(0)
+        await asyncio.wait_for(polled.wait(), 1)
+        # back in the heap with the interval the poll returned
+        assert len(scheduler) == 1
+        task.cancel()
+
+    asyncio.run(run())
+
+
+def test_failing_poll_is_retried_without_stopping_others():
+    async def run():
+        scheduler = PollScheduler(workers=1)
+        polled = []
+
+        async def broken():
+            polled.append("broken")
+            raise KeyError("no such outlet")
+
+        async def fine():
+            polled.append("fine")
+            return 0.01
+
+        scheduler.add(PollJob("broken", broken, interval=0.01))
+        scheduler.add(PollJob("fine", fine))
+        task = asyncio.create_task(scheduler.run())
+        await asyncio.sleep(0.1)
+        task.cancel()
+        assert polled.count("broken") > 2 and polled.count("fine") > 2
+
+    asyncio.run(run())
@@ -0,0 +1,41 @@
+import asyncio
+
+from mqtt2kasa.events import KasaStateEvent, MqttMsgEvent
+from mqtt2kasa.router import ACTION_STATE, TopicRouter
+from mqtt2kasa.shards import EventShards
+
+
+def test_events_go_to_device_queue():
+    router = TopicRouter()
+    router.add("/foo/switch", "foo", ACTION_STATE)
+    shards = EventShards(router, maxsize=2)
+    shards.queue("foo")
+
+    async def put_events():
+        await shards.put(KasaStateEvent(name="foo", state=True))
+        # the device may be gone by the time its event shows up
+        await shards.put(KasaStateEvent(name="gone", state=True))
+        shards.put_mqtt(MqttMsgEvent(topic="/foo/switch", payload="on"))
+        shards.put_mqtt(MqttMsgEvent(topic="/unknown", payload="on"))
+
+    asyncio.run(put_events())
+    assert shards.queue("foo").qsize() == 2
+    assert shards.queue(EventShards.SHARED).qsize() == 2
+    assert "gone" not in shards.queues
+    assert shards.dropped == 0
+
+
+def test_full_device_queue_drops_only_its_messages():
+    router = TopicRouter()
+    router.add("/foo/switch", "foo", ACTION_STATE)
+    router.add("/bar/switch", "bar", ACTION_STATE)
+    shards = EventShards(router, maxsize=1)
+    shards.queue("foo")
+    shards.queue("bar")
+
+    shards.put_mqtt(MqttMsgEvent(topic="/foo/switch", payload="on"))
+    shards.put_mqtt(MqttMsgEvent(topic="/foo/switch", payload="off"))
+    shards.put_mqtt(MqttMsgEvent(topic="/bar/switch", payload="on"))
+    assert shards.dropped == 1
+    assert shards.queue("foo").get_nowait().payload == "on"
+    assert shards.queue("bar").get_nowait().payload == "on"